@@ -32,13 +32,13 @@ class ChromeUI:
 with gr.Blocks() as demo:
     gr.Markdown("# IGIGI")
     with gr.Column():
-        _path = os.path.join(HPARAMS["robot_data_dir"], "image.png") # HPARAMS["image_filename"])
-        img = gr.Image(_path, type="filepath", every=1, show_download_button=False, show_label=False)
+        # Frames are pushed by the robot loop (liveview.py), the browser keeps the mjpeg stream open
+        _url = f"http://localhost:{HPARAMS['liveview_port']}/stream.mjpg"
+        gr.HTML(f'<img src="{_url}" style="width:100%">')
         # _path = os.path.join(HPARAMS["robot_data_dir"], HPARAMS["robotlog_filename"])
         # with open(_path, "r") as f:
         #     text = f.read()
         # gr.Textbox(text, label="Text")
-        img.change(fn=lambda x: x, inputs=[img], outputs=[img])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+from hparams import HPARAMS
+from telemetry import OUTCOMES, TELEMETRY, load_jsonl
+
+
+def offline_hparams(data_dir: str) -> None:
+    """Point both nodes at a scratch dir and at each other on localhost.
+
+    Must run before robot, brain, cam or servos are imported, their defaults read HPARAMS at import.
+    """
+    HPARAMS["robot_data_dir"] = os.path.join(data_dir, "robot")
+    HPARAMS["brain_data_dir"] = os.path.join(data_dir, "brain")
+    HPARAMS["brain_ip"] = "localhost"
+    HPARAMS["viewr_ip"] = "localhost"
+
+
+def metrics(duration: float) -> Dict[str, float]:
+    """Flat name -> value dict, comparable between runs."""
+    summary = TELEMETRY.summary()
+    out: Dict[str, float] = {}
+    for name, stats in summary.items():
+        for key in ("p50", "p95", "p99"):
+            if key in stats:
+                out[f"{name}.{key}"] = stats[key]
+        # ok spans only, a cancelled one did not get its work done either
+        out[f"{name}.rate"] = (stats["count"] - sum(stats[outcome] for outcome in OUTCOMES[1:])) / duration
+    return out
+
+
+def cpu_times() -> List[Tuple[int, int]]:
+    """(busy, total) clock ticks per core since boot, linux only."""
+    out: List[Tuple[int, int]] = []
+    with open("/proc/stat", "r") as f:
+        for line in f:
+            if line.startswith("cpu") and not line.startswith("cpu "):
+                ticks = [int(value) for value in line.split()[1:]]
+                # idle and iowait
+                out.append((sum(ticks) - ticks[3] - ticks[4], sum(ticks)))
+    return out
+
+
+def process_time(pid: int) -> float:
+    """Seconds of user and system cpu used by a process, linux only."""
+    with open(f"/proc/{pid}/stat", "r") as f:
+        # the command name may hold spaces, fields are counted after it
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def cpu_metrics(before: List[Tuple[int, int]], after: List[Tuple[int, int]], processes: Dict[str, float], duration: float) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for core, ((busy0, total0), (busy1, total1)) in enumerate(zip(before, after)):
+        out[f"cpu.core{core}"] = 100 * (busy1 - busy0) / max(total1 - total0, 1)
+    for name, seconds in processes.items():
+        out[f"cpu.{name}"] = 100 * seconds / duration
+    return out
+
+
+def compare(current: Dict[str, float], baseline: Dict[str, float]) -> str:
+    lines = [f"{HPARAMS['time_token']} compared to baseline"]
+    for name in sorted(current):
+        if name not in baseline or baseline[name] == 0:
+            continue
+        change = 100 * (current[name] - baseline[name]) / baseline[name]
+        lines.append(f"  {name}: {baseline[name]:.4f} -> {current[name]:.4f} ({change:+.1f}%)")
+    return "\n".join(lines)
+
+
+async def run_bench(
+    duration: float = 30,
+    warmup: float = 5,
+    bus_latency: float = HPARAMS["fake_bus_latency"],
+    fps: float = HPARAMS["video_fps"],
+    vlm_delay: float = HPARAMS["vlm_stub_delay"],
+    llm_first_token_delay: float = HPARAMS["llm_stub_first_token_delay"],
+    llm_token_delay: float = HPARAMS["llm_stub_token_delay"],
+    cache: bool = False,
+    report: bool = False,
+    processes: bool = False,
+) -> Dict[str, Any]:
+    """Both loops end to end. With processes the robot runs as runtime.Runtime, one process each
+    for capture, servos and network/llm, instead of in this process."""
+    import openai
+
+    import brain
+    import robot
+    from cam import OpenCVCam
+    from servos import Servos
+    from runtime import Runtime
+    from stubs import CogStub, FakeCapture, FakePortHandler, OpenAIStub
+    from vlm import VLMClient
+
+    cog = CogStub(delay=vlm_delay)
+    llm = OpenAIStub(first_token_delay=llm_first_token_delay, token_delay=llm_token_delay)
+    await cog.start()
+    await llm.start()
+    openai.api_base, openai.api_key = llm.url, "stub"
+    loops = [asyncio.create_task(brain._loop(report, docker=False, vlm_client=VLMClient(cog.url), cache=cache, batched=True))]
+    if processes:
+        # Spawned workers pick up the stub from the environment
+        os.environ["OPENAI_API_BASE"], os.environ["OPENAI_API_KEY"] = llm.url, "stub"
+        runtime = Runtime(
+            report,
+            capture_factory=functools.partial(FakeCapture, fps=fps),
+            port_handler_factory=functools.partial(FakePortHandler, latency=bus_latency),
+        )
+        loops.append(asyncio.create_task(runtime.run()))
+    else:
+        servos = Servos(port_handler=FakePortHandler(latency=bus_latency))
+        camera = OpenCVCam(capture=FakeCapture(fps=fps))
+        loops.append(asyncio.create_task(robot._loop(report, servos=servos, camera=camera)))
+    print(f"{HPARAMS['time_token']} warming up for {warmup}s then measuring for {duration}s")
+    await asyncio.sleep(warmup)
+    pids: Dict[str, int] = {"bench": os.getpid()}
+    if processes:
+        pids.update(runtime.supervisor.pids())
+    TELEMETRY.clear()
+    cpu_before, process_before = cpu_times(), {name: process_time(pid) for name, pid in pids.items()}
+    start_time = time.time()
+    await asyncio.sleep(duration)
+    elapsed = time.time() - start_time
+    cpu_after, process_used = cpu_times(), {}
+    for name, pid in pids.items():
+        try:
+            process_used[name] = process_time(pid) - process_before[name]
+        except FileNotFoundError:
+            # restarted while measuring
+            pass
+    for loop in loops:
+        loop.cancel()
+    await asyncio.gather(*loops, return_exceptions=True)
+    await cog.stop()
+    await llm.stop()
+    if processes:
+        # The robot spans were recorded in the io worker, flushed to its telemetry file on exit
+        load_jsonl(os.path.join(HPARAMS["robot_data_dir"], HPARAMS["telemetry_filename"]), TELEMETRY, since=start_time)
+    else:
+        camera.close()
+        print(servos.bus_stats())
+    print(TELEMETRY.report())
+    return {
+        "config": {
+            "duration": elapsed,
+            "bus_latency": bus_latency,
+            "fps": fps,
+            "vlm_delay": vlm_delay,
+            "llm_first_token_delay": llm_first_token_delay,
+            "llm_token_delay": llm_token_delay,
+            "cache": cache,
+            "processes": processes,
+        },
+        "metrics": {**metrics(elapsed), **cpu_metrics(cpu_before, cpu_after, process_used, elapsed)},
+    }
+
+
+async def load_test(
+    num_robots: List[int] = [1, 2, 4, 8, 16],
+    duration: float = 10,
+    fps: float = HPARAMS["video_fps"],
+    vlm_delay: float = HPARAMS["vlm_stub_delay"],
+) -> Dict[int, List[float]]:
+    """One brain, N simulated robots streaming frames, per-robot reply rate for each N."""
+    import cv2
+
+    import brain
+    from stubs import CogStub, FakeCapture
+    from transport import Transport
+    from vlm import VLMClient
+
+    cog = CogStub(delay=vlm_delay)
+    await cog.start()
+    _, frame = FakeCapture().read()
+    image: bytes = cv2.imencode(".jpg", frame)[1].tobytes()
+    results: Dict[int, List[float]] = {}
+
+    async def _robot(robot_id: str, replies: Dict[str, int]) -> None:
+        transport = Transport("robot", "brain", local_id=robot_id)
+        await transport.connect("localhost")
+
+        async def _send() -> None:
+            # Frames stream at the camera rate whether or not the brain keeps up
+            while True:
+                await transport.send("image", image, hops=[("capture", time.time())])
+                await asyncio.sleep(1 / fps)
+
+        sender = asyncio.create_task(_send())
+        try:
+            while True:
+                await transport.recv("vlmout")
+                replies[robot_id] += 1
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            await transport.close()
+
+    for num in num_robots:
+        cog.requests, cog.predictions = 0, 0
+        brain_loop = asyncio.create_task(brain._loop(docker=False, vlm_client=VLMClient(cog.url), cache=False, batched=True))
+        replies: Dict[str, int] = {f"robot{i}": 0 for i in range(num)}
+        robots = [asyncio.create_task(_robot(robot_id, replies)) for robot_id in replies]
+        await asyncio.sleep(duration)
+        for task in robots + [brain_loop]:
+            task.cancel()
+        await asyncio.gather(*robots, brain_loop, return_exceptions=True)
+        rates = [count / duration for count in replies.values()]
+        # Jain's index, 1.0 when every robot gets the same share of the VLM
+        fairness = sum(rates) ** 2 / (len(rates) * sum(rate ** 2 for rate in rates)) if any(rates) else 0.0
+        results[num] = rates
+        print(
+            f"{HPARAMS['brain_token']} {num:2d} robots: per-robot loop rate min={min(rates):.2f}/s "
+            f"mean={sum(rates) / num:.2f}/s max={max(rates):.2f}/s total={sum(rates):.2f}/s "
+            f"fairness={fairness:.3f} mean batch={cog.requests / max(cog.predictions, 1):.2f}"
+        )
+    await cog.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="robot and brain end to end against local stand-ins")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before measuring")
+    parser.add_argument("--bus-latency", type=float, default=HPARAMS["fake_bus_latency"], help="seconds per servo packet")
+    parser.add_argument("--fps", type=float, default=HPARAMS["video_fps"], help="synthetic camera frame rate")
+    parser.add_argument("--vlm-delay", type=float, default=HPARAMS["vlm_stub_delay"], help="seconds of fake inference")
+    parser.add_argument("--llm-delay", type=float, default=HPARAMS["llm_stub_first_token_delay"], help="seconds to first llm token")
+    parser.add_argument("--cache", action="store_true", help="let the brain reuse replies for similar frames")
+    parser.add_argument("--report", action="store_true", help="also print per-stage throughput while running")
+    parser.add_argument("--save", type=str, default=None, help="write results to this json file")
+    parser.add_argument("--baseline", type=str, default=None, help="compare against results saved with --save")
+    parser.add_argument("--processes", action="store_true", help="run the robot as one process each for capture, servos and io")
+    parser.add_argument("--robots", type=str, default=None, help="load test one brain with these robot counts, e.g. 1,2,4,8,16")
+    args = parser.parse_args()
+    offline_hparams(tempfile.mkdtemp(prefix="igigi.bench."))
+    if args.robots:
+        asyncio.run(load_test(
+            [int(num) for num in args.robots.split(",")],
+            duration=args.duration,
+            fps=args.fps,
+            vlm_delay=args.vlm_delay,
+        ))
+        exit()
+    results = asyncio.run(run_bench(
+        duration=args.duration,
+        warmup=args.warmup,
+        bus_latency=args.bus_latency,
+        fps=args.fps,
+        vlm_delay=args.vlm_delay,
+        llm_first_token_delay=args.llm_delay,
+        cache=args.cache,
+        report=args.report,
+        processes=args.processes,
+    ))
+    # Per hop breakdown of capture to actuation, from the traces
+    hops = list(dict.fromkeys(key.rsplit(".", 1)[0] for key in results["metrics"] if key.startswith("robot.hop.")))
+    for name in ["robot.capture_to_actuation"] + hops + ["robot.take_image", "robot.set_servos", f"brain.run_vlm.{HPARAMS['robot_id']}", "cpu"]:
+        stats = {key: value for key, value in results["metrics"].items() if key.startswith(f"{name}.")}
+        print(f"  {name}: " + " ".join(f"{key.rsplit('.', 1)[1]}={value:.3f}" for key, value in stats.items()))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            print(compare(results["metrics"], json.load(f)["metrics"]))
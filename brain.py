@@ -1,39 +1,175 @@
+import argparse
 import asyncio
 import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
 
 from hparams import HPARAMS, Task
-from utils import find_file, send_file, task_batch, write_log, clear_data
-from vlm import VLMDocker, run_vlm
-
-
-def _loop():
-    docker_proc = VLMDocker()
-    tasks = [Task("clear_data", clear_data("brain"))]
-    while True:
-        state = asyncio.run(task_batch(tasks, "brain"))
-        # Reset tasks
-        tasks = []
-        # if log hasn't been saved in a while
-        if state.get("brainlog", None) is None:
-            _clean = (state.get("brainlog_age", 0) > HPARAMS["brainlog_max_age"])
-            tasks.append(Task("write_log", write_log(state["log"], "brain", clean=_clean)))
-        # always check for brainlog
-        tasks.append(Task("find_file", find_file("brainlog", "brain", read=True)))
-        # if there is an image, run VLM
-        if state.get("image_path", None) is not None:
-            tasks.append(Task("run_vlm", run_vlm(), HPARAMS["vlm_timeout"]))
-        else:
-            tasks.append(Task("find_file", find_file("image", "brain")))
-        # if there is a VLM output, write and send
-        if state.get("reply", None) is not None:
-            _path = os.path.join(HPARAMS["brain_data_dir"], HPARAMS["vlmout_filename"])
-            # TODO: check if path exists, if it is abve a certain size, delete it
-            with open(_path, "w") as f:
-                f.write(state["reply"])
-            tasks.append(Task("send_file", send_file("vlmout", "brain", "robot")))
+from utils import task_graph, write_log, write_telemetry, clear_data
+from vlm import VLMBatcher, VLMCache, VLMClient, VLMDocker, run_vlm
+from transport import Hub, Transport
+from logwriter import LogWriter, get_log_writer, close_log_writer, close_log_writers
+from pipeline import Pipeline, Stage
+from telemetry import TELEMETRY
+from profiler import Profiler
+
+
+@dataclass
+class RobotSession:
+    """Everything the brain keeps for one robot, isolated from the other robots."""
+    robot_id: str
+    transport: Transport  # its inbox is the latest-frame slot, stale frames are dropped
+    cache: Optional[VLMCache]
+    vlmout_log: LogWriter
+    pipeline: Optional[Pipeline] = None
+    runner: Optional[asyncio.Task] = None
+
+
+async def _loop(
+    report: bool = HPARAMS["pipeline_report"],
+    docker: bool = True,
+    vlm_client: VLMClient = None,
+    cache: bool = True,
+    batched: bool = HPARAMS["vlm_batched"],
+    hub: Hub = None,
+    profiler: Profiler = None,
+):
+    # Off unless asked for by flag or signal, when on from the start setup is in the samples too
+    profiler = profiler or Profiler("brain")
+    profiler.install()
+    vlm_client = vlm_client or VLMClient()
+    # Requests from all robots share the GPU, batched with at most one request per robot
+    vlm_batcher = VLMBatcher(vlm_client, batched=batched)
+    hub = hub or Hub("brain", "robot")
+    tasks = [
+        Task("clear_data", clear_data("brain")),
+        Task("serve", hub.serve()),
+    ]
+    # Without docker the client must point at a running VLM, e.g. stubs.CogStub in bench.py
+    if docker:
+        tasks.append(Task("vlm", VLMDocker().start(vlm_client), HPARAMS["vlm_ready_timeout"]))
+    state = await task_graph(tasks, "brain")
+    await write_log(state["log"], "brain")
+    sessions: Dict[str, RobotSession] = {}
+
+    def _robot_pipeline(session: RobotSession) -> Pipeline:
+        transport = session.transport
+
+        async def _recv_image(state: Dict[str, Any]) -> Dict[str, Any]:
+            out = await transport.recv("image")
+            meta = out["image_meta"]
+            # Trace hops stay in the robot clock, the clock offset converts ours
+            if meta.get("hops", None):
+                out["trace"], out["hops"] = meta.get("trace", None), meta["hops"] + [("recv", transport.to_remote(meta["received"]))]
+                out["expires"] = transport.to_local(meta["hops"][0][1]) + HPARAMS["brain_max_frame_age"]
+            return out
+
+        async def _run_vlm(state: Dict[str, Any]) -> Dict[str, Any]:
+            hops = state.get("hops", None)
+            if hops:
+                hops.append(("vlm_start", transport.to_remote(time.time())))
+            out = await run_vlm(
+                state["image"], client=vlm_client, cache=session.cache, batcher=vlm_batcher, key=session.robot_id
+            )
+            if hops:
+                hops.append(("vlm_end", transport.to_remote(time.time())))
+                TELEMETRY.record_trace([(name, transport.to_local(stamp)) for name, stamp in hops], "brain")
+                # Once the vlm has spent time on it the reply is always sent, the robot judges its age
+                out["expires"] = None
+            return out
+
+        async def _send_reply(state: Dict[str, Any]) -> Dict[str, Any]:
+            # History of replies, size capped by rotation
+            session.vlmout_log.write(f"{time.strftime(HPARAMS['time_format'])} {state['reply']!r}\n")
+            return await transport.send(
+                "vlmout", state["reply"].encode("utf-8"), trace=state.get("trace", None), hops=state.get("hops", None)
+            )
+
+        # The next image is received while the VLM is busy, the VLM always gets the freshest one
+        return Pipeline(
+            [[
+                Stage(f"recv.{session.robot_id}", _recv_image, None),
+                Stage(f"run_vlm.{session.robot_id}", _run_vlm, HPARAMS["vlm_timeout"]),
+                Stage(f"send.{session.robot_id}", _send_reply),
+            ]],
+            "brain",
+            report=report,
+        )
+
+    async def _accept(state: Dict[str, Any]) -> Dict[str, Any]:
+        robot_id, transport = await hub.accept()
+        # A robot without a hello may be gone before it gets here
+        if hub.sessions.get(robot_id, None) is not transport:
+            return {"log": ""}
+        data_dir = os.path.join(HPARAMS["brain_data_dir"], robot_id)
+        session = RobotSession(
+            robot_id,
+            transport,
+            VLMCache() if cache else None,
+            get_log_writer(os.path.join(data_dir, HPARAMS["vlmout_filename"])),
+        )
+        session.pipeline = _robot_pipeline(session)
+        profiler.wrap(session.pipeline)
+        sessions[robot_id] = session
+        session.runner = asyncio.create_task(session.pipeline.run())
+        return {"log": f"{HPARAMS['brain_token']} new session for {HPARAMS['robot_token']} {robot_id}, {len(sessions)} robots"}
+
+    async def _drop(state: Dict[str, Any]) -> Dict[str, Any]:
+        robot_id = await hub.gone()
+        session = sessions.pop(robot_id, None)
+        if session is None:
+            return {"log": ""}
+        session.runner.cancel()
+        await asyncio.gather(session.runner, return_exceptions=True)
+        # joins the writer thread, which flushes to disk
+        await asyncio.to_thread(close_log_writer, session.vlmout_log.path)
+        return {
+            "log": session.pipeline.drain_log()
+            + f"{HPARAMS['brain_token']} closed session for {HPARAMS['robot_token']} {robot_id}, {len(sessions)} robots"
+        }
+
+    async def _write_log(state: Dict[str, Any]) -> Dict[str, Any]:
+        await write_telemetry("brain")
+        logs = [pipeline.drain_log()] + [session.pipeline.drain_log() for session in sessions.values()]
+        return await write_log("".join(logs), "brain")
+
+    pipeline = Pipeline(
+        [
+            [Stage("accept", _accept, None)],
+            [Stage("drop", _drop, None)],
+            [Stage("write_log", _write_log, period=HPARAMS["log_period"])],
+        ],
+        "brain",
+        report=report,
+    )
+    profiler.wrap(pipeline)
+    try:
+        await pipeline.run()
+    finally:
+        profiler.close()
+        runners = [session.runner for session in sessions.values()]
+        for runner in runners:
+            runner.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+        # flush whatever the log writers still hold, spans since the last write_log included
+        await write_telemetry("brain")
+        close_log_writers()
+        await hub.close()
+        await vlm_client.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--report", action="store_true", help="print per-stage throughput")
+    parser.add_argument("--profile", action="store_true", help="sample stacks from the start, SIGUSR1 toggles")
+    parser.add_argument("--profile-stage", type=str, default=HPARAMS["profile_stage"], help="cProfile this stage, e.g. run_vlm")
+    parser.add_argument("--profile-iterations", type=int, default=HPARAMS["profile_iterations"], help="calls of the stage to profile")
+    args = parser.parse_args()
     print("Starting brain main loop.")
-    _loop()
-
+    asyncio.run(_loop(
+        report=args.report or HPARAMS["pipeline_report"],
+        profiler=Profiler(
+            "brain", stage=args.profile_stage, iterations=args.profile_iterations, sample=args.profile or HPARAMS["profile"]
+        ),
+    ))
@@ -1,21 +1,170 @@
+import argparse
 import asyncio
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
-from typing import Any, Dict
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 from hparams import HPARAMS, Camera
 from utils import clear_data
 
+# Encoding runs in its own threads so it never blocks the event loop
+_encode_pool = ThreadPoolExecutor(HPARAMS["encode_workers"], thread_name_prefix="encode")
+# Each encode thread packs the stereo pair into its own reusable buffer
+_encode_local = threading.local()
+
+
+def crop_views(
+    frame: np.ndarray,
+    stereo_focus: np.ndarray = HPARAMS["stereo_focus"],
+    flip_vertical: bool = True,
+) -> List[np.ndarray]:
+    """Numpy views of the stereo crops, nothing is copied."""
+    if flip_vertical:  # Flip the image if needed
+        frame = frame[::-1]
+    if stereo_focus is None:
+        return [frame]
+    # Calculate the bounding boxes for both eyes
+    w, h = stereo_focus[0]
+    half_h = h//2
+    half_w = w//2
+    return [frame[y-half_h:y+half_h, x-half_w:x+half_w] for x, y in stereo_focus[1:]]
+
+
+def _encode_params(image_format: str, quality: int) -> List[int]:
+    if image_format == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if image_format == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    if image_format == "png":
+        # png is lossless, quality maps onto compression effort (100 is fastest)
+        return [cv2.IMWRITE_PNG_COMPRESSION, round((100 - quality) * 9 / 100)]
+    raise ValueError(f"unknown image format {image_format}")
+
+
+def _encode(views: List[np.ndarray], image_format: str, quality: int, output_path: Optional[str]) -> bytes:
+    if len(views) == 1:
+        packed = np.ascontiguousarray(views[0])
+    else:
+        # Single copy of the crops side by side into this thread's buffer
+        h = views[0].shape[0]
+        w = sum(view.shape[1] for view in views)
+        packed = getattr(_encode_local, "packed", None)
+        if packed is None or packed.shape != (h, w) + views[0].shape[2:]:
+            packed = np.empty((h, w) + views[0].shape[2:], dtype=views[0].dtype)
+            _encode_local.packed = packed
+        x = 0
+        for view in views:
+            packed[:, x:x + view.shape[1]] = view
+            x += view.shape[1]
+    ok, buffer = cv2.imencode(f".{image_format}", packed, _encode_params(image_format, quality))
+    if not ok:
+        raise ValueError(f"failed to encode {image_format}")
+    image: bytes = buffer.tobytes()
+    if output_path is not None:
+        with open(output_path, "wb") as f:
+            f.write(image)
+    return image
+
+
+async def encode_image(
+    views: List[np.ndarray],
+    image_format: str = HPARAMS["image_format"],
+    quality: int = HPARAMS["image_quality"],
+    output_path: Optional[str] = None,
+) -> bytes:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_encode_pool, _encode, views, image_format, quality, output_path)
+
+
 class OpenCVCam:
-    def __init__(self, camera: Camera = HPARAMS["camera"]):
+    def __init__(
+        self,
+        camera: Camera = HPARAMS["camera"],
+        threaded: bool = HPARAMS["camera_threaded"],
+        buffer_size: int = HPARAMS["camera_buffer_size"],
+        capture: Any = None,
+        retry: float = HPARAMS["camera_retry"],
+        retry_max: float = HPARAMS["camera_retry_max"],
+        max_failures: int = HPARAMS["camera_max_failures"],
+    ):
         self.camera: Camera = camera
-        self.cap = cv2.VideoCapture(camera.device)
+        # anything with the VideoCapture read/set/isOpened/release methods, e.g. stubs.FakeCapture.
+        # One that knows when its last frame was captured has it in stamp, e.g. runtime.RingCapture
+        self.cap = capture if capture is not None else cv2.VideoCapture(camera.device)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera.width)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera.height)
         if not self.cap.isOpened():
             raise ValueError(f"Error opening camera {camera.device}")
+        self.threaded: bool = threaded
+        self.retry, self.retry_max, self.max_failures = retry, retry_max, max_failures
+        # consecutive failed reads, the capture thread gives up after max_failures
+        self.failures: int = 0
+        # Ring buffer of (timestamp, frame), newest on the right
+        self.frames: Deque[Tuple[float, np.ndarray]] = deque(maxlen=buffer_size)
+        self._last_stamp: float = 0.0
+        self._arrived: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._running: bool = threaded
+        if threaded:
+            # Keep the driver queue short, the thread drains it anyway
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            self._thread = threading.Thread(target=self._capture, daemon=True)
+            self._thread.start()
+
+    def _stamp(self) -> float:
+        # Right after a read, so the capture's stamp is the one of the frame just read
+        stamp = getattr(self.cap, "stamp", None)
+        return stamp if stamp is not None else time.time()
+
+    def _capture(self) -> None:
+        # Runs in its own thread, cap.read() blocks until the next frame from the device
+        retry: float = self.retry
+        while self._running:
+            ret, frame = self.cap.read()
+            if not ret:
+                # Unplugged or erroring, back off instead of spinning on read
+                self.failures += 1
+                if self.failures >= self.max_failures:
+                    print(f"{HPARAMS['image_token']}{HPARAMS['fail_token']} camera {self.camera.device} stopped after {self.failures} failed reads")
+                    self._running = False
+                    break
+                time.sleep(retry)
+                retry = min(2 * retry, self.retry_max)
+                continue
+            self.failures, retry = 0, self.retry
+            self.frames.append((self._stamp(), frame))
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._arrived.set)
+        # wake a take_image waiting for a frame that will not come
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._arrived.set)
 
+    async def _read_frame(self, fresh: bool = True) -> Tuple[Optional[float], Optional[np.ndarray]]:
+        if not self.threaded:
+            ret, frame = self.cap.read()
+            if not ret:
+                return None, None
+            # kept in the buffer too, the live view reads the newest frame from there
+            self.frames.append((self._stamp(), frame))
+            return self.frames[-1]
+        if self._loop is None:
+            # the event must exist before the capture thread can see the loop
+            self._arrived = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+        # Newest frame right away, only wait if it was already handed out
+        while not self.frames or (fresh and self.frames[-1][0] == self._last_stamp):
+            if not self._running:
+                return None, None
+            self._arrived.clear()
+            await self._arrived.wait()
+        stamp, frame = self.frames[-1]
+        self._last_stamp = stamp
+        return stamp, frame
 
     async def take_image(
         self,
@@ -23,36 +172,28 @@ class OpenCVCam:
         output_dir: str = HPARAMS["robot_data_dir"],
         flip_vertical: bool = True,
         stereo_focus: np.ndarray = HPARAMS["stereo_focus"],
+        fresh: bool = True,
+        image_format: str = HPARAMS["image_format"],
+        quality: int = HPARAMS["image_quality"],
+        save: bool = HPARAMS["image_save"],
     ) -> Dict[str, Any]:
         output_path: str = os.path.join(output_dir, filename)
         if not self.cap.isOpened():
             return {"log": f"{HPARAMS['image_token']}{HPARAMS['fail_token']} camera not open"}
         
-        ret, frame = self.cap.read()
-        if ret:
-            if flip_vertical:  # Flip the image if needed
-                frame = cv2.flip(frame, 0)
-            h, w, _ = frame.shape
-            if stereo_focus is not None:
-                # Calculate the bounding boxes for both eyes
-                w, h = stereo_focus[0]
-                x1, y1 = stereo_focus[1]
-                x2, y2 = stereo_focus[2]
-                half_h = h//2
-                half_w = w//2
-                left_clipped = frame[y1-half_h:y1+half_h, x1-half_w:x1+half_w]
-                right_clipped = frame[y2-half_h:y2+half_h, x2-half_w:x2+half_w] 
-                print(f"left: {x1}, {y1}, {w}, {h}")
-                print(f"right: {x2}, {y2}, {w}, {h}")
-                print(f"left clipped: {left_clipped.shape}")
-                print(f"right clipped: {right_clipped.shape}")
-                cv2.imwrite(output_path, cv2.hconcat([left_clipped, right_clipped]))
-            else:
-                cv2.imwrite(output_path, frame)
+        stamp, frame = await self._read_frame(fresh)
+        if frame is not None:
+            views = crop_views(frame, stereo_focus, flip_vertical)
+            # Encode once in memory off the event loop, the bytes are sent as-is over the transport
+            image: bytes = await encode_image(views, image_format, quality, output_path if save else None)
             return {
-                "log": f"{HPARAMS['image_token']} image captured",
+                "log": f"{HPARAMS['image_token']} image captured {time.time() - stamp:.3f}s ago, {len(image)} bytes {image_format}",
                 "image_path" : output_path,
+                "image": image,
+                "image_time": stamp,
             }
+        elif self.failures >= self.max_failures:
+            return {"log": f"{HPARAMS['image_token']}{HPARAMS['fail_token']} camera stopped after {self.failures} failed reads"}
         else:
             return {"log": f"{HPARAMS['image_token']}{HPARAMS['fail_token']} frame empty"}
 
@@ -67,9 +208,14 @@ class OpenCVCam:
     ) -> Dict[str, Any]:
         pass
 
-    def __del__(self):
+    def close(self) -> None:
+        self._running = False
+        if self.threaded:
+            self._thread.join(timeout=1)
         self.cap.release()
-        pass
+
+    def __del__(self):
+        self.close()
 
 async def test():
     print("testing camera")
@@ -80,5 +226,32 @@ async def test():
     # result = await cam.record_video("test.mp4")
     # print(result)
 
+async def benchmark(
+    num_frames: int = 50,
+    camera: Camera = HPARAMS["camera"],
+    quality: int = HPARAMS["image_quality"],
+) -> None:
+    print(f"{HPARAMS['time_token']} benchmarking encode of {camera.width}x{camera.height} stereo frames")
+    # Smooth gradient plus noise, closer to a real scene than pure noise
+    gradient = np.linspace(0, 255, camera.width, dtype=np.float32)[None, :, None]
+    noise = np.random.default_rng(HPARAMS["seed"]).normal(0, 8, (camera.height, camera.width, 3))
+    frame = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+    for image_format in ["jpg", "webp", "png"]:
+        durations: List[float] = []
+        for _ in range(num_frames):
+            start_time = time.time()
+            image = await encode_image(crop_views(frame), image_format, quality)
+            durations.append(time.time() - start_time)
+        durations.sort()
+        print(
+            f"{HPARAMS['image_token']} {image_format} q={quality}: {len(image)} bytes/frame, "
+            f"encode mean={1000 * sum(durations) / num_frames:.2f}ms "
+            f"p95={1000 * durations[int(0.95 * (num_frames - 1))]:.2f}ms"
+        )
+
+
 if __name__ == "__main__":
-    asyncio.run(test())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", action="store_true", help="benchmark image encoding")
+    args = parser.parse_args()
+    asyncio.run(benchmark() if args.bench else test())
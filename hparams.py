@@ -97,7 +97,16 @@ HPARAMS["stereo_focus"] = [
     [320,240], # center point left
     [960,240], # center points right
 ]
-HPARAMS["image_filename"]: str = "image.png"
+HPARAMS["camera_threaded"]: bool = True # drain the camera in a background thread
+HPARAMS["camera_buffer_size"]: int = 4 # timestamped frames kept by the capture thread
+HPARAMS["camera_retry"]: float = 0.05 # seconds before reading again after a failed read, doubles
+HPARAMS["camera_retry_max"]: float = 1.0 # seconds between failed reads at most
+HPARAMS["camera_max_failures"]: int = 20 # consecutive failed reads before the capture thread gives up
+HPARAMS["image_format"]: str = "jpg" # jpg, webp or png
+HPARAMS["image_quality"]: int = 90 # 0-100, for png higher is faster and larger
+HPARAMS["image_save"]: bool = False # also write each image to the data dir, the kiosk streams from memory
+HPARAMS["encode_workers"]: int = 2 # threads for image encoding
+HPARAMS["image_filename"]: str = f"image.{HPARAMS['image_format']}"
 HPARAMS["video_filename"]: str = "video.mp4"
 HPARAMS["video_duration"]: int = 1 # seconds
 HPARAMS["video_fps"]: int = 30 # frames per second
@@ -108,37 +117,83 @@ Coroutine = Any
 @dataclass
 class Task:
     name: str
-    coro: Coroutine
-    timeout: int = 2 # seconds
+    coro: Coroutine # or a callable taking the results of deps by name, returning one
+    timeout: float = 2 # seconds once started
+    deps: Tuple[str, ...] = () # names of tasks that must succeed first
+    priority: int = 0 # higher starts first when several are ready
+    deadline: float = None # seconds after the batch started, later work is cancelled
 
 # Brain is the main computer that runs the VLM on a GPU
 HPARAMS["brain_ip"]: str = "192.168.1.44"
 HPARAMS["brain_username"]: str = "oop"
 HPARAMS["brain_data_dir"]: str = "/home/oop/dev/data/"
 HPARAMS["brainlog_filename"]: str = f"log.{HPARAMS['brain_token']}.txt"
-HPARAMS["brainlog_max_age"]: int = 6 # seconds
 HPARAMS["vlm_prompt"]: str = "Where is the image is the person? Reply UP, DOWN, LEFT, RIGHT, or UNSURE"
 HPARAMS["vlm_docker_url"]: str = "http://localhost:5000/predictions"
 HPARAMS["vlmout_filename"]: str = "vlmout.txt"
 HPARAMS["vlm_timeout"]: int = 4 # seconds
+HPARAMS["vlm_pool_size"]: int = 4 # keep-alive connections to the VLM container
+HPARAMS["vlm_cache_size"]: int = 64 # replies kept for near-identical images
+HPARAMS["vlm_cache_ttl"]: float = 5 # seconds a cached reply stays valid
+HPARAMS["vlm_cache_threshold"]: int = 4 # max differing bits between image hashes
+HPARAMS["vlm_cache_hash_size"]: int = 8 # image hash is hash_size**2 bits
+HPARAMS["vlm_batch_window"]: float = 0.01 # seconds to gather requests into one batch
+HPARAMS["vlm_batch_max"]: int = 4 # requests per batch
+HPARAMS["vlm_batched"]: bool = False # the llava cog container takes one image per prediction
+HPARAMS["vlm_batch_inflight"]: int = 1 # batches at the backend at once, one GPU
+HPARAMS["vlm_docker_image"]: str = "llava13b"
+HPARAMS["vlm_docker_label"]: str = "igigi.vlm" # containers we started, the only ones we stop
+HPARAMS["vlm_ready_timeout"]: float = 300 # seconds for the model to load
+HPARAMS["vlm_ready_backoff"]: float = 0.5 # seconds before the first health re-check, doubles
+HPARAMS["vlm_ready_backoff_max"]: float = 5 # seconds between health checks at most
+HPARAMS["vlm_warmup_timeout"]: float = 60 # seconds for the first prediction, it pays for lazy init on the GPU
+HPARAMS["vlm_stub_port"]: int = 5050 # local stand-in for the VLM container
+HPARAMS["vlm_stub_startup"]: float = 0 # seconds the stub reports STARTING
+HPARAMS["vlm_stub_delay"]: float = 0.5 # seconds of fake inference
+HPARAMS["vlm_stub_batch_delay"]: float = 0.05 # extra seconds per additional image in a batch
 
 # Robot is the Raspberry Pi that controls the Servos, Cameras
 HPARAMS["robot_ip"]: str = "192.168.1.10"
 HPARAMS["robot_username"]: str = "pi"
+HPARAMS["robot_id"]: str = f"{HPARAMS['robot_username']}@{HPARAMS['robot_ip']}" # brain keeps one session per id
 HPARAMS["robot_data_dir"]: str = "/home/pi/dev/data/"
 HPARAMS["robotlog_filename"]: str = f"log.{HPARAMS['robot_token']}.txt"
-HPARAMS["robotlog_max_age"]: int = 6 # seconds
 HPARAMS["robot_llm_prompt"]: str = "Choose the best action based on the user description. Return only the name. Here are the available actions: \n"
 HPARAMS["robot_llm_model"]: str = "gpt-3.5-turbo"
 HPARAMS["robot_llm_temperature"]: float = 0.2
 HPARAMS["robot_llm_max_tokens"]: int = 8
 HPARAMS["robot_llm_timeout"]: int = 4 # seconds
+# Clear vlm replies map straight onto actions without asking the llm
+HPARAMS["vlm_actions"]: Dict[str, str] = {
+    "UP": HPARAMS["up_token"],
+    "DOWN": HPARAMS["down_token"],
+    "LEFT": HPARAMS["left_token"],
+    "RIGHT": HPARAMS["right_token"],
+    "UNSURE": HPARAMS["home_token"],
+}
+HPARAMS["llm_memo_size"]: int = 256 # llm answers remembered for free-form vlm replies
+HPARAMS["llm_stub_port"]: int = 5051 # local stand-in for the openai api
+HPARAMS["llm_stub_first_token_delay"]: float = 0.3 # seconds
+HPARAMS["llm_stub_token_delay"]: float = 0.05 # seconds between streamed tokens
 
 # Movement parameters
 HPARAMS["default_pose"]: str = HPARAMS["home_token"]
 HPARAMS["set_servo_speed"]: int = 64 # degrees per move duration
 HPARAMS["set_servo_timeout"]: float = 3 # seconds
 HPARAMS["set_servo_sleep"]: float = 0.01 # seconds
+HPARAMS["set_servo_duration"]: float = 2 # max seconds for a trajectory to reach its goal
+HPARAMS["set_servo_tolerance"]: float = 2 # degrees from the goal for a move to count as settled
+HPARAMS["servo_speed"]: float = 90 # average degrees per second along a trajectory
+HPARAMS["servo_min_duration"]: float = 0.2 # seconds, shortest trajectory
+HPARAMS["servo_control_hz"]: float = 30 # rate of the servo control thread, one sync write+read is ~18ms at 57600 baud
+HPARAMS["servo_profile"]: str = "min_jerk" # min_jerk, trapezoid or linear
+HPARAMS["servo_trapezoid_accel"]: float = 0.25 # fraction of the move spent accelerating
+HPARAMS["servo_history"]: float = 10 # seconds of head poses kept, moves are relative to the pose when their frame was captured
+HPARAMS["servo_latency_comp"]: bool = True # moves start from the head pose at capture time instead of the present one
+HPARAMS["servo_extrapolate"]: bool = False # also lead the target by its estimated velocity times the pipeline delay
+HPARAMS["servo_extrapolate_window"]: float = 3 # seconds of past moves the target velocity is fitted to
+HPARAMS["servo_extrapolate_max"]: float = 30 # degrees of lead at most
+HPARAMS["servo_error_interval"]: float = 5 # seconds between control loop error prints, errors in between are only counted
 # Raw servo parameters
 HPARAMS["protocol_version"]: float = 2.0
 HPARAMS["baudrate"]: int = 57600
@@ -148,14 +203,68 @@ HPARAMS["addr_goal_position"]: int = 116
 HPARAMS["addr_present_position"]: int = 132
 HPARAMS["torque_enable"]: int = 1
 HPARAMS["torque_disable"]: int = 0
+HPARAMS["fake_bus_latency"]: float = 0.0005 # seconds of servo return delay per packet on the fake bus
+HPARAMS["fake_servo_speed"]: float = 2000 # units per second a fake servo moves towards its goal
 
 # Viewer is a secondary computer that runs a VR WebXR visualization tool
 HPARAMS["viewr_ip"]: str = "192.168.1.10"
 HPARAMS["viewr_username"]: str = "ook"
 HPARAMS["viewr_data_dir"]: str = "/home/ook/dev/data/"
+HPARAMS["viewr"]: bool = True # robot publishes its frames and head pose to viewr
+HPARAMS["viewr_port"]: int = 5556 # transport from the robot
+HPARAMS["viewr_ws_port"]: int = 8082 # websocket for WebXR clients
+HPARAMS["viewr_client_queue"]: int = 2 # frames queued per client, a slow client loses the oldest
+HPARAMS["viewr_client_window"]: int = 1 # frames sent to a client ahead of its acks
+
+# Live view streams the capture buffer to the kiosk as mjpeg
+HPARAMS["liveview"]: bool = True
+HPARAMS["liveview_port"]: int = 8081
+HPARAMS["liveview_fps"]: float = 10 # max frames per second pushed
+HPARAMS["liveview_quality"]: int = 70 # jpeg quality
+
+# Transport is a persistent socket between robot and brain (brain serves)
+HPARAMS["transport_port"]: int = 5555
+HPARAMS["transport_max_msg"]: int = 2**24 # bytes
+HPARAMS["transport_retry"]: float = 1.0 # seconds between connection attempts, doubles while the remote is down
+HPARAMS["transport_retry_max"]: float = 10.0 # seconds between connection attempts at most
+HPARAMS["transport_connect_timeout"]: int = 60 # seconds to wait for the brain at startup
+HPARAMS["transport_max_sessions"]: int = 16 # remotes the brain serves at once, more are turned away
+HPARAMS["transport_ping_interval"]: float = 1.0 # seconds between clock sync pings
+HPARAMS["transport_clock_samples"]: int = 8 # pings kept, the shortest round trip sets the clock offset
+
+# Pipeline connects the stages of the robot and brain main loops
+HPARAMS["pipeline_queue_size"]: int = 1 # items between stages, oldest is dropped
+HPARAMS["pipeline_report"]: bool = False # periodically print per-stage throughput
+HPARAMS["brain_max_frame_age"]: float = 1.0 # seconds since capture, older frames never reach the vlm
+HPARAMS["robot_max_action_age"]: float = 8.0 # seconds since capture, older actions are not acted on
+HPARAMS["profile"]: bool = False # sample stacks from the start, SIGUSR1 toggles it at any time
+HPARAMS["profile_interval"]: float = 0.01 # seconds between stack samples
+HPARAMS["profile_stage"]: str = None # stage to run under cProfile, e.g. take_image, SIGUSR2 re-arms it
+HPARAMS["profile_iterations"]: int = 20 # calls of profile_stage that are profiled
+HPARAMS["profile_top"]: int = 25 # functions listed in the hot function reports
+
+# Multi-process robot runtime, capture, servos and network/llm each get a process
+HPARAMS["runtime_frame_slots"]: int = 16 # frames in the shared memory ring, a reader copies the newest one out
+HPARAMS["runtime_joint_slots"]: int = 320 # joint states in the shared memory ring, about servo_history seconds at servo_control_hz
+HPARAMS["runtime_poll"]: float = 0.002 # seconds between checks for a new frame
+HPARAMS["runtime_check_interval"]: float = 0.5 # seconds between supervisor checks on the workers
+HPARAMS["runtime_backoff"]: float = 0.5 # seconds before restarting a crashed worker, doubles
+HPARAMS["runtime_backoff_max"]: float = 10 # seconds before a restart at most
+HPARAMS["runtime_stable"]: float = 30 # seconds a worker must run for its backoff to reset
+HPARAMS["pipeline_report_interval"]: float = 10 # seconds
+HPARAMS["log_period"]: float = 1 # seconds between log writes
+HPARAMS["log_flush_interval"]: float = 1 # seconds between batched writes to disk
+HPARAMS["log_max_bytes"]: int = 2**22 # rotate log files past this size
+HPARAMS["log_max_age"]: float = 3600 # rotate log files after this many seconds
+HPARAMS["log_compress"]: bool = True # gzip rotated segments
+HPARAMS["log_keep"]: int = 8 # rotated segments kept per log file
+
+# Telemetry records every task and stage as a span in a ring buffer
+HPARAMS["telemetry_size"]: int = 2**16 # spans kept in memory
+HPARAMS["telemetry_num_fields"]: int = 4 # numeric fields per span
+HPARAMS["telemetry_filename"]: str = "telemetry.jsonl"
 
 # Misc
-HPARAMS["find_file_sleep"]: float = 0.1
 HPARAMS['time_format']: str = "%H:%M:%S"
 
 # Misc
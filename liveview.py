@@ -0,0 +1,183 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from aiohttp import web
+
+from hparams import HPARAMS
+from cam import OpenCVCam, encode_image
+
+BOUNDARY: str = "frame"
+# cv2 fonts are ascii only, actions are shown by name
+ACTION_NAMES: Dict[str, str] = {token: word for word, token in HPARAMS["vlm_actions"].items()}
+ACTION_NAMES[HPARAMS["default_pose"]] = "HOME"
+
+
+class LiveView:
+    """Pushes the newest camera frame as an mjpeg stream, served from the robot process.
+
+    Frames come straight from the capture buffer, annotated with the servo pose and last action.
+    One producer encodes at most fps frames per second, and only when the frame or the overlay
+    changed and someone is watching. Every client is sent each new frame once.
+    """
+
+    def __init__(
+        self,
+        camera: OpenCVCam,
+        servos: Any = None,
+        port: int = HPARAMS["liveview_port"],
+        fps: float = HPARAMS["liveview_fps"],
+        quality: int = HPARAMS["liveview_quality"],
+        flip_vertical: bool = True,
+    ):
+        self.camera, self.servos = camera, servos
+        self.port, self.fps, self.quality, self.flip_vertical = port, fps, quality, flip_vertical
+        self.last_action: Optional[str] = None
+        self.jpeg: Optional[bytes] = None
+        self.version: int = 0
+        self.clients: int = 0
+        self.frames_sent: int = 0
+        self._changed: Optional[asyncio.Condition] = None
+        self._producer: Optional[asyncio.Task] = None
+        self._key: Optional[Tuple] = None
+        self._closing: bool = False
+        self.app = web.Application()
+        self.app.router.add_get("/", self._index)
+        self.app.router.add_get("/stream.mjpg", self._stream)
+        self.runner = web.AppRunner(self.app)
+
+    @property
+    def url(self) -> str:
+        return f"http://localhost:{self.port}/stream.mjpg"
+
+    def _pose(self) -> Optional[List[int]]:
+        return [int(round(angle)) for angle in self.servos.present_pos] if self.servos is not None else None
+
+    def _overlay(self, frame: np.ndarray, pose: Optional[List[int]]) -> np.ndarray:
+        frame = frame[::-1].copy() if self.flip_vertical else frame.copy()
+        lines: List[str] = []
+        if pose is not None:
+            lines.append(f"pose {pose}")
+        if self.last_action is not None:
+            lines.append(f"action {ACTION_NAMES.get(self.last_action, self.last_action)}")
+        for i, line in enumerate(lines):
+            y = 30 + 30 * i
+            cv2.putText(frame, line, (10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 4, cv2.LINE_AA)
+            cv2.putText(frame, line, (10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2, cv2.LINE_AA)
+        return frame
+
+    async def _produce(self) -> None:
+        period: float = 1.0 / self.fps
+        while True:
+            await asyncio.sleep(period)
+            if self.clients == 0 or not self.camera.frames:
+                continue
+            stamp, frame = self.camera.frames[-1]
+            pose = self._pose()
+            key = (stamp, tuple(pose) if pose else None, self.last_action)
+            if key == self._key:
+                continue
+            self._key = key
+            self.jpeg = await encode_image([self._overlay(frame, pose)], "jpg", self.quality)
+            async with self._changed:
+                self.version += 1
+                self._changed.notify_all()
+
+    async def _index(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text='<html><body style="margin:0;background:#000"><img src="/stream.mjpg" style="width:100%"></body></html>',
+            content_type="text/html",
+        )
+
+    async def _stream(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={
+            "Content-Type": f"multipart/x-mixed-replace; boundary={BOUNDARY}",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+        self.clients += 1
+        seen: int = 0
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.version != seen or self._closing)
+                if self._closing:
+                    break
+                seen, jpeg = self.version, self.jpeg
+                await response.write(
+                    f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode("utf-8")
+                    + jpeg + b"\r\n"
+                )
+                self.frames_sent += 1
+        except ConnectionResetError:
+            pass
+        finally:
+            self.clients -= 1
+        return response
+
+    async def start(self) -> Dict[str, Any]:
+        self._changed = asyncio.Condition()
+        self._producer = asyncio.create_task(self._produce())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "0.0.0.0", self.port).start()
+        return {"log": f"{HPARAMS['image_token']} live view on {self.url}"}
+
+    async def stop(self) -> None:
+        if self._producer is not None:
+            self._producer.cancel()
+            await asyncio.gather(self._producer, return_exceptions=True)
+        # wake the streams so they end instead of waiting for a frame that never comes
+        self._closing = True
+        if self._changed is not None:
+            async with self._changed:
+                self._changed.notify_all()
+        await self.runner.cleanup()
+
+
+async def test_liveview(duration: float = 3) -> None:
+    import aiohttp
+
+    from stubs import FakeCapture
+
+    print(f"testing live view with a synthetic camera for {duration}s")
+    camera = OpenCVCam(capture=FakeCapture())
+    view = LiveView(camera)
+    print((await view.start())["log"])
+    view.last_action = HPARAMS["up_token"]
+
+    async def _count(response: aiohttp.ClientResponse, seconds: float) -> int:
+        parts: List[bytes] = []
+
+        async def _read() -> None:
+            while True:
+                line = await response.content.readline()
+                if line.startswith(b"Content-Length"):
+                    await response.content.readline()
+                    parts.append(await response.content.readexactly(int(line.split(b":")[1])))
+
+        try:
+            await asyncio.wait_for(_read(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        for jpeg in parts:
+            assert cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR) is not None
+        return len(parts)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(view.url) as response:
+            assert response.headers["Content-Type"].startswith("multipart/x-mixed-replace")
+            moving: int = await _count(response, duration)
+            # A frozen scene is sent once, then nothing until it changes
+            camera.close()
+            await asyncio.sleep(2 / view.fps)
+            frozen: int = await _count(response, 1)
+    print(
+        f"{HPARAMS['image_token']} {moving / duration:.1f} frames/s received at fps={view.fps}, "
+        f"{frozen} frames sent in 1s of a frozen scene"
+    )
+    await view.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(test_liveview())
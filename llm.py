@@ -1,22 +1,186 @@
+import argparse
+import asyncio
+import re
+import time
+from collections import OrderedDict
 import openai
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Set
 
 from hparams import HPARAMS
 
+# Every action the llm can choose, moves first
+ACTIONS: List[str] = list(HPARAMS["moves"]) + list(HPARAMS["poses"])
+
+
+def action_prompt(
+    prompt: str = HPARAMS["robot_llm_prompt"],
+    moves: Dict[str, Any] = HPARAMS["moves"],
+    poses: Dict[str, Any] = HPARAMS["poses"],
+) -> str:
+    # Add moves and poses to the system prompt
+    for name, move in moves.items():
+        prompt += f"{name}: {move.desc}\n"
+    for name, pose in poses.items():
+        prompt += f"{name}: {pose.desc}\n"
+    return prompt
+
+
+# The action list never changes at runtime, so the system prompt is built once
+ACTION_PROMPT: str = action_prompt()
+
+
+def _normalize(text: str) -> str:
+    # Emoji may arrive with or without the variation selector, e.g. ◀ vs ◀️
+    return text.replace("\ufe0f", "")
+
+
+def match_action(text: str, actions: List[str] = ACTIONS) -> Optional[str]:
+    """First known action name found in text, None if there is none yet."""
+    text = _normalize(text)
+    for action in actions:
+        if _normalize(action) in text:
+            return action
+    return None
+
+
 async def run_llm(
     messages: List[Dict[str, str]],
     model: str = HPARAMS["robot_llm_model"],
     temperature: int = HPARAMS["robot_llm_temperature"],
     max_tokens: int = HPARAMS["robot_llm_max_tokens"],
+    timeout: float = HPARAMS["robot_llm_timeout"],
+    actions: List[str] = ACTIONS,
 ) -> Dict[str, Any]:
     log: str = f"{HPARAMS['llm_token']} LLM using PROMPT: {model}"
-    response = openai.ChatCompletion.create(
+    start_time = time.time()
+    response = await openai.ChatCompletion.acreate(
         messages=messages,
         model=model,
         temperature=temperature,
         max_tokens=max_tokens,
+        request_timeout=timeout,
+        stream=True,
     )
-    reply: str = response.choices[0].message.content
-    log += f" REPLY: {reply}"
+    # Stop reading as soon as the streamed text names an action
+    reply: str = ""
+    action: Optional[str] = None
+    try:
+        async for chunk in response:
+            reply += chunk.choices[0].delta.get("content", "")
+            action = match_action(reply, actions)
+            if action is not None:
+                break
+    finally:
+        await response.aclose()
+    log += f" REPLY: {reply} after {time.time() - start_time:.2f}s"
     print(f"\n{HPARAMS['llm_token']} {log}\n")
-    return {"log": log, "reply": reply}
\ No newline at end of file
+    return {"log": log, "reply": action if action is not None else reply}
+
+
+def action_messages(vlmout: str, system: str = ACTION_PROMPT) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": vlmout},
+    ]
+
+
+# Words that flip or hedge the meaning of a reply, those always go to the llm
+NEGATIONS: Set[str] = {"NOT", "NO", "NEITHER", "NOR", "CANNOT", "CANT", "DONT", "ISNT", "MAYBE", "OR"}
+
+
+class ActionResolver:
+    """Maps vlm replies onto actions, only asking the llm when the reply is not clear.
+
+    A reply is clear when it names exactly one of the vlm keywords (or action names) and has no
+    negation. Everything else goes to run_llm, whose answers are memoized in LRU order.
+    """
+
+    def __init__(
+        self,
+        keywords: Dict[str, str] = HPARAMS["vlm_actions"],
+        memo_size: int = HPARAMS["llm_memo_size"],
+    ):
+        self.keywords, self.memo_size = keywords, memo_size
+        self.memo: OrderedDict = OrderedDict()
+        self.fast_hits: int = 0
+        self.memo_hits: int = 0
+        self.llm_calls: int = 0
+        self.llm_time: float = 0.0
+
+    def resolve_local(self, text: str) -> Optional[str]:
+        words: List[str] = re.findall(r"[A-Z]+", text.upper().replace("'", ""))
+        if NEGATIONS.intersection(words):
+            return None
+        found: Set[str] = {self.keywords[word] for word in words if word in self.keywords}
+        action = match_action(text)
+        if action is not None:
+            found.add(action)
+        return found.pop() if len(found) == 1 else None
+
+    async def resolve(self, text: str, **kwargs: Any) -> Dict[str, Any]:
+        action = self.resolve_local(text)
+        if action is not None:
+            self.fast_hits += 1
+            return {"log": f"{HPARAMS['llm_token']} fast path {text!r} -> {action}, {self.stats()}", "reply": action}
+        key: str = " ".join(text.upper().split())
+        if key in self.memo:
+            self.memo_hits += 1
+            self.memo.move_to_end(key)
+            action = self.memo[key]
+            return {"log": f"{HPARAMS['llm_token']} memo {text!r} -> {action}, {self.stats()}", "reply": action}
+        start_time = time.time()
+        result = await run_llm(action_messages(text), **kwargs)
+        self.llm_time += time.time() - start_time
+        self.llm_calls += 1
+        # Only remember replies that are actual actions
+        if result["reply"] in ACTIONS:
+            self.memo[key] = result["reply"]
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        result["log"] += f", {self.stats()}"
+        return result
+
+    def stats(self) -> str:
+        total = max(self.fast_hits + self.memo_hits + self.llm_calls, 1)
+        mean_llm = self.llm_time / max(self.llm_calls, 1)
+        saved = (self.fast_hits + self.memo_hits) * mean_llm
+        return (
+            f"fast={100 * self.fast_hits / total:.0f}% memo={100 * self.memo_hits / total:.0f}% "
+            f"llm={100 * self.llm_calls / total:.0f}% ({self.llm_calls} calls), ~{saved:.1f}s saved"
+        )
+
+
+async def test_llm(num_requests: int = 10) -> None:
+    from stubs import OpenAIStub
+
+    print("testing streaming llm client against local openai stub")
+    stub = OpenAIStub()
+    await stub.start()
+    openai.api_base, openai.api_key = stub.url, "stub"
+    latencies: List[float] = []
+    for vlmout in ["UP", "DOWN", "LEFT", "RIGHT", "UNSURE"] * (num_requests // 5):
+        start_time = time.time()
+        result = await run_llm(action_messages(vlmout))
+        latencies.append(time.time() - start_time)
+        assert result["reply"] in ACTIONS, result["reply"]
+    full: float = stub.first_token_delay + stub.token_delay * (stub.reply_tokens - 1)
+    print(
+        f"{HPARAMS['llm_token']} {len(latencies)} requests, first action after "
+        f"mean={1000 * sum(latencies) / len(latencies):.1f}ms max={1000 * max(latencies):.1f}ms, "
+        f"full reply would take {1000 * full:.1f}ms"
+    )
+    # Clear replies skip the llm, free-form ones go through it once and are memoized
+    resolver = ActionResolver()
+    vlmouts: List[str] = ["UP", "LEFT.", "The person is on the right", "UNSURE", "not up, more to the left", "not up, more to the left", "up or down"]
+    for vlmout in vlmouts:
+        result = await resolver.resolve(vlmout)
+        print(result["log"])
+    print(f"{HPARAMS['llm_token']} {len(vlmouts)} vlm replies, {resolver.stats()}, {stub.requests - len(latencies)} sent to the llm")
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num", type=int, default=10, help="requests to send to the stub")
+    args = parser.parse_args()
+    asyncio.run(test_llm(args.num))
@@ -0,0 +1,133 @@
+import gzip
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List
+
+from hparams import HPARAMS
+
+
+class LogWriter:
+    """Append-only log file written by a background thread.
+
+    write() only appends to a pending list, the thread flushes it in one batch every
+    flush_interval seconds. The file is rotated once it passes max_bytes or max_age seconds,
+    rotated segments are optionally gzipped and only the newest keep of them are kept.
+    Nothing is ever read back.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = HPARAMS["log_flush_interval"],
+        max_bytes: int = HPARAMS["log_max_bytes"],
+        max_age: float = HPARAMS["log_max_age"],
+        compress: bool = HPARAMS["log_compress"],
+        keep: int = HPARAMS["log_keep"],
+    ):
+        self.path, self.flush_interval = path, flush_interval
+        self.max_bytes, self.max_age, self.compress, self.keep = max_bytes, max_age, compress, keep
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._file = None
+        self._opened: float = 0.0
+        self.bytes_written: int = 0
+        self.flushes: int = 0
+        self.rotations: int = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+        with self._lock:
+            self._pending.append(text)
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a")
+        self._opened = time.time()
+
+    def _segments(self) -> List[str]:
+        directory, name = os.path.split(self.path)
+        directory = directory or "."
+        return sorted(
+            os.path.join(directory, f) for f in os.listdir(directory) if f.startswith(f"{name}.") and f != name
+        )
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._file = None
+        # Timestamped names sort in rotation order
+        segment = f"{self.path}.{time.strftime('%Y%m%d%H%M%S')}.{self.rotations:04d}"
+        os.rename(self.path, segment)
+        if self.compress:
+            with open(segment, "rb") as src, gzip.open(f"{segment}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(segment)
+        self.rotations += 1
+        for old in self._segments()[:-self.keep] if self.keep > 0 else self._segments():
+            os.remove(old)
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        text = "".join(pending)
+        try:
+            if self._file is None:
+                self._open()
+            self._file.write(text)
+            self._file.flush()
+        except OSError:
+            with self._lock:
+                self._pending.insert(0, text)
+            raise
+        self.bytes_written += len(text)
+        self.flushes += 1
+        if self._file.tell() >= self.max_bytes or time.time() - self._opened >= self.max_age:
+            self._rotate()
+
+    def _run(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                # e.g. the disk is full, the pending text is kept for the next try
+                print(f"{HPARAMS['fail_token']} log writer for {self.path} failed with {e}")
+                self._file = None
+
+    def close(self) -> None:
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# One writer per file, shared by everything on a node
+_writers: Dict[str, LogWriter] = {}
+
+
+def get_log_writer(path: str, **kwargs) -> LogWriter:
+    writer = _writers.get(path, None)
+    if writer is None:
+        writer = LogWriter(path, **kwargs)
+        _writers[path] = writer
+    return writer
+
+
+def close_log_writer(path: str) -> None:
+    writer = _writers.pop(path, None)
+    if writer is not None:
+        writer.close()
+
+
+def close_log_writers() -> None:
+    for writer in _writers.values():
+        writer.close()
+    _writers.clear()
@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from hparams import HPARAMS, Coroutine
+from telemetry import TELEMETRY, OK, FAIL, TIMEOUT, CANCELLED, STALE
+
+# Passed on from each stage's input to its result, a frame's trace id, its hops and when it goes stale
+TRACE_KEYS = ("trace", "hops", "expires")
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[[Dict[str, Any]], Coroutine]  # takes upstream result, returns result dict
+    timeout: Optional[float] = 2  # seconds, None waits forever
+    period: Optional[float] = None  # seconds between runs, only for source stages
+    preempt: bool = False  # a new input cancels the running call instead of waiting for it
+    # throughput stats
+    count: int = 0
+    fails: int = 0
+    drops: int = 0
+    stale: int = 0
+    busy: float = 0.0
+    _inq: Optional[asyncio.Queue] = field(default=None, repr=False)
+    _outq: Optional[asyncio.Queue] = field(default=None, repr=False)
+
+
+def put_latest(queue: asyncio.Queue, item: Any) -> bool:
+    """Put without blocking, dropping the oldest item when full. Returns True if one was dropped."""
+    dropped: bool = False
+    if queue.full():
+        queue.get_nowait()
+        dropped = True
+    queue.put_nowait(item)
+    return dropped
+
+
+def _cancelling() -> bool:
+    task = asyncio.current_task()
+    return task is not None and getattr(task, "cancelling", lambda: 0)() > 0
+
+
+class Pipeline:
+    """Chains of stages connected by bounded queues, every stage runs concurrently.
+
+    The first stage of each chain is a source and runs on its own (optionally every period seconds),
+    every following stage consumes the result of the one before it. Full queues drop their oldest
+    item so downstream stages always work on the freshest data, and an item whose expires time
+    (local clock) has passed is dropped instead of being worked on.
+    """
+
+    def __init__(
+        self,
+        chains: List[List[Stage]],
+        node_name: str,
+        maxsize: int = HPARAMS["pipeline_queue_size"],
+        report: bool = HPARAMS["pipeline_report"],
+        report_interval: float = HPARAMS["pipeline_report_interval"],
+    ):
+        self.chains = chains
+        self.node_name: str = node_name
+        self.node_token: str = HPARAMS[f"{node_name}_token"]
+        self.report, self.report_interval = report, report_interval
+        self.logs: List[str] = []
+        for chain in chains:
+            for upstream, downstream in zip(chain[:-1], chain[1:]):
+                queue: asyncio.Queue = asyncio.Queue(maxsize)
+                upstream._outq, downstream._inq = queue, queue
+        self.stages: List[Stage] = [stage for chain in chains for stage in chain]
+
+    def drain_log(self) -> str:
+        log, self.logs = "\n".join(self.logs), []
+        return f"{log}\n" if log else ""
+
+    async def _call(self, stage: Stage, item: Dict[str, Any]) -> None:
+        start_time = time.time()
+        if item.get("expires", None) is not None and start_time > item["expires"]:
+            stage.stale += 1
+            TELEMETRY.record(stage.name, start_time, start_time, STALE, self.node_name)
+            log = f"{self.node_token} {stage.name} dropped trace {item.get('trace', None)}, {start_time - item['expires']:.2f}s too old"
+            print(log)
+            self.logs.append(log)
+            return
+        outcome: int = CANCELLED
+        log: str = f"{self.node_token} {HPARAMS['fail_token']} {stage.name} returned nothing"
+        try:
+            result = await asyncio.wait_for(stage.fn(item), timeout=stage.timeout)
+            # wait_for swallows a cancel that lands as fn finishes (before python 3.12)
+            if _cancelling():
+                raise asyncio.CancelledError()
+            # a stage that returns nothing failed without saying why
+            outcome = OK if result is not None else FAIL
+        except asyncio.TimeoutError:
+            result, outcome = None, TIMEOUT
+            log = f"{self.node_token} {HPARAMS['fail_token']} {stage.name} timed out"
+        except Exception as e:
+            result, outcome = None, FAIL
+            log = f"{self.node_token} {HPARAMS['fail_token']} {stage.name} failed with {e}"
+        finally:
+            end_time = time.time()
+            stage.busy += end_time - start_time
+            TELEMETRY.record(stage.name, start_time, end_time, outcome, self.node_name)
+        if result is None:
+            stage.fails += 1
+            print(log)
+            self.logs.append(log)
+            return
+        stage.count += 1
+        for key in TRACE_KEYS:
+            if key in item and key not in result:
+                result[key] = item[key]
+        if result.get("log", None):
+            print(result["log"])
+            self.logs.append(result["log"])
+        if stage._outq is not None:
+            stage.drops += put_latest(stage._outq, result)
+
+    async def _run_stage(self, stage: Stage) -> None:
+        if stage._inq is None:
+            # Source stage, runs on its own
+            while True:
+                if stage.period is not None and stage.count + stage.fails > 0:
+                    await asyncio.sleep(stage.period)
+                else:
+                    # a source that fails without awaiting would otherwise starve the loop
+                    await asyncio.sleep(0)
+                await self._call(stage, {})
+        item = await stage._inq.get()
+        while True:
+            if not stage.preempt:
+                await self._call(stage, item)
+                item = await stage._inq.get()
+                continue
+            # A newer item cancels the running call, e.g. a new goal for the servos
+            call = asyncio.create_task(self._call(stage, item))
+            getter = asyncio.create_task(stage._inq.get())
+            await asyncio.wait({call, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if not call.done():
+                call.cancel()
+                await asyncio.gather(call, return_exceptions=True)
+                stage.drops += 1
+                log = f"{self.node_token} {stage.name} preempted"
+                print(log)
+                self.logs.append(log)
+            item = await getter
+
+    def stats(self, elapsed: float) -> str:
+        lines: List[str] = [f"{HPARAMS['time_token']} {self.node_token} stage throughput over {elapsed:.1f}s"]
+        for stage in self.stages:
+            rate = stage.count / elapsed if elapsed > 0 else 0.0
+            mean = stage.busy / max(stage.count + stage.fails, 1)
+            # None once the spans are gone, after TELEMETRY.clear() or the ring wrapping past them
+            percentiles = TELEMETRY.percentiles(stage.name, node=self.node_name)
+            p50, p95, p99 = percentiles if percentiles is not None else (0.0, 0.0, 0.0)
+            lines.append(
+                f"  {stage.name}: {rate:.2f}/s mean={mean:.3f}s "
+                f"p50={p50:.3f}s p95={p95:.3f}s p99={p99:.3f}s "
+                f"busy={100 * stage.busy / max(elapsed, 1e-9):.0f}% "
+                f"ok={stage.count} fail={stage.fails} drop={stage.drops} stale={stage.stale}"
+            )
+        return "\n".join(lines)
+
+    async def _report(self) -> None:
+        start_time = time.time()
+        while True:
+            await asyncio.sleep(self.report_interval)
+            log = self.stats(time.time() - start_time)
+            print(log)
+            self.logs.append(log)
+
+    async def run(self) -> None:
+        runners = [self._run_stage(stage) for stage in self.stages]
+        if self.report:
+            runners.append(self._report())
+        await asyncio.gather(*runners)
+
+
+async def test_report(duration: float = 2, report_interval: float = 0.1) -> None:
+    """Reports keep coming while telemetry is cleared under them, as bench.py does after warmup."""
+    print(f"testing pipeline reports for {duration}s with telemetry cleared every {report_interval}s")
+
+    async def _tick(state: Dict[str, Any]) -> Dict[str, Any]:
+        return {"log": ""}
+
+    # Ticks rarer than reports, so most reports find the stage's spans cleared
+    pipeline = Pipeline([[Stage("tick", _tick, period=duration / 4), Stage("tock", _tick)]], "robot", report=True, report_interval=report_interval)
+    runner = asyncio.create_task(pipeline.run())
+    start_time = time.time()
+    while time.time() - start_time < duration:
+        await asyncio.sleep(report_interval / 3)
+        TELEMETRY.clear()
+        assert not runner.done(), runner.exception()
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    reports = sum(log.count("stage throughput") for log in pipeline.logs)
+    assert reports > 0, "no report"
+    print(f"{HPARAMS['time_token']} {reports} reports, {pipeline.stages[0].count} ticks, pipeline still running")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=2, help="seconds to run the report test")
+    args = parser.parse_args()
+    asyncio.run(test_report(args.duration))
@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+from hparams import HPARAMS, Coroutine
+from pipeline import Pipeline, Stage
+
+
+class Profiler:
+    """Where a node spends its time, without editing code.
+
+    Stack sampling: a background thread records the stack of every thread every interval
+    seconds, written out as collapsed stacks (flamegraph.pl, speedscope) and a hot function
+    report. Stage profiling: the next iterations calls of one pipeline stage run under cProfile.
+    Nothing runs while both are off, a stage that is not profiled is not even wrapped.
+    SIGUSR1 toggles sampling, SIGUSR2 re-arms the stage profile.
+    """
+
+    def __init__(
+        self,
+        node_name: str,
+        output_dir: str = None,
+        interval: float = HPARAMS["profile_interval"],
+        stage: str = HPARAMS["profile_stage"],
+        iterations: int = HPARAMS["profile_iterations"],
+        top: int = HPARAMS["profile_top"],
+        sample: bool = HPARAMS["profile"],
+    ):
+        self.sample: bool = sample
+        self.node_name, self.interval, self.stage, self.iterations, self.top = node_name, interval, stage, iterations, top
+        self.output_dir: str = output_dir or HPARAMS[f"{node_name}_data_dir"]
+        self.node_token: str = HPARAMS[f"{node_name}_token"]
+        self.stacks: Counter = Counter()
+        self.samples: int = 0
+        self._started: float = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # stage calls left to profile, and the profile they go into
+        self.calls_left: int = iterations if stage else 0
+        self._profile: Optional[cProfile.Profile] = None
+        self._calls: int = 0
+        self._active: bool = False
+
+    def _path(self, kind: str) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Date and milliseconds, dumps taken in quick succession or days apart must not overwrite
+        now = time.time()
+        stamp = f"{time.strftime('%Y%m%d.%H%M%S', time.localtime(now))}.{int(now % 1 * 1000):03d}"
+        return os.path.join(self.output_dir, f"profile.{self.node_name}.{stamp}.{kind}")
+
+    def _log(self, log: str) -> str:
+        print(log)
+        return log
+
+    # ---- stack sampling
+
+    @property
+    def sampling(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> str:
+        if self.sampling:
+            return ""
+        self.stacks.clear()
+        self.samples, self._started = 0, time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._thread.start()
+        return self._log(f"{HPARAMS['time_token']} {self.node_token} sampling stacks every {1000 * self.interval:.0f}ms")
+
+    def _sample(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack: List[str] = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """One line per distinct stack, root first: 'thread;outer;...;inner count'."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def report(self) -> str:
+        """Hot functions by share of samples, self (on top of the stack) and total (anywhere in it)."""
+        total = max(sum(self.stacks.values()), 1)
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+        lines = [
+            f"{HPARAMS['time_token']} {self.node_token} {self.samples} samples every {1000 * self.interval:.0f}ms "
+            f"over {time.time() - self._started:.1f}s, wall clock over all threads",
+        ]
+        for title, counts in (("on top of the stack (self)", self_counts), ("anywhere in the stack (total)", total_counts)):
+            lines.append(f"  {title}")
+            for name, count in counts.most_common(self.top):
+                lines.append(f"  {100 * count / total:6.1f}%  {name}")
+        return "\n".join(lines) + "\n"
+
+    def stop(self) -> str:
+        if not self.sampling:
+            return ""
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        collapsed_path, report_path = self._path("collapsed.txt"), self._path("top.txt")
+        with open(collapsed_path, "w") as f:
+            f.write(self.collapsed())
+        report = self.report()
+        with open(report_path, "w") as f:
+            f.write(report)
+        return self._log(f"{report}{HPARAMS['save_token']} stacks in {collapsed_path}, report in {report_path}")
+
+    def toggle(self) -> str:
+        return self.stop() if self.sampling else self.start()
+
+    # ---- stage profiling
+
+    def wrap(self, pipeline: Pipeline) -> None:
+        """Put the profiled stage of pipeline under cProfile, per robot stages like run_vlm.<id> included."""
+        if not self.stage:
+            return
+        for stage in pipeline.stages:
+            if stage.name == self.stage or stage.name.split(".")[0] == self.stage:
+                stage.fn = self._profiled(stage)
+
+    def arm(self) -> str:
+        if not self.stage:
+            return self._log(f"{HPARAMS['time_token']}{HPARAMS['fail_token']} {self.node_token} no stage to profile")
+        self.calls_left = self.iterations
+        return self._log(f"{HPARAMS['time_token']} {self.node_token} profiling the next {self.iterations} calls of {self.stage}")
+
+    def _profiled(self, stage: Stage) -> Callable[[Dict[str, Any]], Coroutine]:
+        fn = stage.fn
+
+        async def _call(item: Dict[str, Any]) -> Dict[str, Any]:
+            # cProfile sees one call at a time, concurrent calls (other robots) run unprofiled
+            if self.calls_left <= 0 or self._active:
+                return await fn(item)
+            self._active = True
+            self._profile = self._profile or cProfile.Profile()
+            # Other tasks that run while this call awaits are in the profile too
+            self._profile.enable()
+            try:
+                return await fn(item)
+            finally:
+                self._profile.disable()
+                self._active = False
+                self._calls += 1
+                self.calls_left -= 1
+                if self.calls_left == 0:
+                    self._dump(stage.name)
+
+        return _call
+
+    def _dump(self, name: str) -> str:
+        prof_path, report_path = self._path(f"{name}.prof"), self._path(f"{name}.txt")
+        stats = pstats.Stats(self._profile)
+        stats.dump_stats(prof_path)
+        text = io.StringIO()
+        text.write(f"{HPARAMS['time_token']} {self.node_token} {self._calls} calls of {name}\n")
+        pstats.Stats(self._profile, stream=text).sort_stats("cumulative").print_stats(self.top)
+        with open(report_path, "w") as f:
+            f.write(text.getvalue())
+        self._profile, self._calls = None, 0
+        return self._log(f"{HPARAMS['save_token']} cProfile of {name} in {prof_path}, report in {report_path}")
+
+    # ---- lifecycle
+
+    def install(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, self.toggle)
+        loop.add_signal_handler(signal.SIGUSR2, self.arm)
+        if self.sample:
+            self.start()
+
+    def close(self) -> None:
+        self.stop()
+        if self._profile is not None and self._calls > 0:
+            self._dump(self.stage)
+        loop = asyncio.get_running_loop()
+        loop.remove_signal_handler(signal.SIGUSR1)
+        loop.remove_signal_handler(signal.SIGUSR2)
+
+
+async def test_profiler(duration: float = 3, output_dir: str = "/tmp/igigi.profile") -> None:
+    def _busy(seconds: float) -> None:
+        # plain python work, shows up on top of the stacks
+        end = time.time() + seconds
+        while time.time() < end:
+            sum(i * i for i in range(1000))
+
+    async def _hot(item: Dict[str, Any]) -> Dict[str, Any]:
+        _busy(0.01)
+        await asyncio.sleep(0.01)
+        return {"log": ""}
+
+    async def _run(profiler: Optional[Profiler], seconds: float) -> int:
+        stage = Stage("hot", _hot, period=0)
+        pipeline = Pipeline([[stage]], "robot", report=False)
+        if profiler is not None:
+            profiler.wrap(pipeline)
+        runner = asyncio.create_task(pipeline.run())
+        await asyncio.sleep(seconds)
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        return stage.count
+
+    print(f"testing profiler on a toy pipeline, output in {output_dir}")
+    # Installed but off, versus sampling plus cProfile of the first calls
+    profiler = Profiler("robot", output_dir, stage="hot", iterations=10, sample=False)
+    profiler.calls_left = 0
+    profiler.install()
+    off: int = await _run(profiler, duration)
+    profiler.arm()
+    profiler.start()
+    on: int = await _run(profiler, duration)
+    report = profiler.stop()
+    profiler.close()
+    assert "_busy" in report, report
+    print(f"{HPARAMS['time_token']} loop rate off={off / duration:.1f}/s sampling and cProfile={on / duration:.1f}/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=3, help="seconds per run")
+    args = parser.parse_args()
+    asyncio.run(test_profiler(args.duration))
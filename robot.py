@@ -1,65 +1,153 @@
+import argparse
 import asyncio
-import os
-import shutil
+import itertools
+import time
+from typing import Any, Dict
 
 from hparams import HPARAMS, Task
-from utils import find_file, send_file, task_batch, write_log, clear_data
-from llm import run_llm
+from utils import task_graph, write_log, write_telemetry, clear_data
+from llm import ActionResolver
 from cam import OpenCVCam
+from liveview import LiveView
 from servos import Servos
+from transport import Transport
+from pipeline import Pipeline, Stage
+from logwriter import close_log_writers
+from telemetry import TELEMETRY, OK
+from profiler import Profiler
 
 
-def _loop():
-    servos = Servos()
-    camera = OpenCVCam()
+async def _loop(
+    report: bool = HPARAMS["pipeline_report"],
+    servos: Servos = None,
+    camera: OpenCVCam = None,
+    transport: Transport = None,
+    profiler: Profiler = None,
+):
+    # Off unless asked for by flag or signal, when on from the start setup is in the samples too
+    profiler = profiler or Profiler("robot")
+    profiler.install()
+    # Hardware can be swapped for stand-ins, see bench.py
+    servos = servos or Servos()
+    camera = camera or OpenCVCam()
+    transport = transport or Transport("robot", "brain")
+    # The kiosk watches the capture buffer directly, nothing goes through the sd card
+    liveview = LiveView(camera, servos) if HPARAMS["liveview"] else None
+    # viewr fans frames out to the headsets, the robot sends each frame to it once
+    viewr = Transport("robot", "viewr", port=HPARAMS["viewr_port"]) if HPARAMS["viewr"] else None
+    # Independent, so the head homes while the brain is still coming up
     tasks = [
-        Task("find_file", find_file("robotlog", "robot", read=True)),
-        Task("find_file", find_file("vlmout", "robot", read=True)),
+        Task("set_servos", servos.set_servos("forward"), HPARAMS["set_servo_timeout"] + 1, priority=1),
+        Task("connect", transport.connect(), HPARAMS["transport_connect_timeout"]),
         Task("clear_data", clear_data("robot")),
-        Task("set_servos", servos.set_servos("forward")),
-        Task("take_image", camera.take_image()),
     ]
-    state = asyncio.run(task_batch(tasks, "robot", ordered=True))
-    tasks = []
-    while True:
-        state = asyncio.run(task_batch(tasks, "robot"))
-        # Reset task
-        tasks = []
-        # if log hasn't been saved in a while
-        if state.get("robotlog", None) is None:
-            _clean = (state.get("robotlog_age", 0) > HPARAMS["robotlog_max_age"])
-            tasks.append(Task("write_log", write_log(state["log"], "robot", clean=_clean)))
-        # always check for brainlog
-        tasks.append(Task("find_file", find_file("robotlog", "robot", read=True)))
-        # always capture image
-        tasks.append(Task("take_image", camera.take_image()))
-        # if image, send it to brain
-        if state.get("image_path", None) is not None:
-            tasks.append(Task("send_file", send_file("image", "robot", "brain")))
-        # TODO: if video, send it to viewr
-        # if vlmouts, call llm
-        if state.get("vlmout", None) is not None:
-            # Add moves and poses to vlmouts
-            prompt: str = HPARAMS["robot_llm_prompt"]
-            for name, move in HPARAMS["moves"].items():
-                prompt += f"{name}: {move.desc}\n"
-            for name, pose in HPARAMS["poses"].items():
-                prompt += f"{name}: {pose.desc}\n"
-            messages = [
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": state["vlmout"]},
-            ]
-            tasks.append(Task("run_llm", run_llm(messages), HPARAMS["robot_llm_timeout"]))
-        else:
-            # try and find vlmouts if no vlmout
-            tasks.append(Task("find_file", find_file("vlmout", "robot", read=True)))
-        # always move
-        if state.get("reply", None) is not None:
-            # if action, move servos
-            tasks.append(Task("set_servos", servos.set_servos(state["reply"]), HPARAMS["set_servo_timeout"]))
-        else:
-            tasks.append(Task("set_servos", servos.set_servos("forward"), HPARAMS["set_servo_timeout"]))
+    if liveview is not None:
+        tasks.append(Task("liveview", liveview.start()))
+    state = await task_graph(tasks, "robot")
+    await write_log(state["log"], "robot")
+    # Not in the setup graph, the robot runs fine without anyone watching
+    viewr_connect = asyncio.create_task(viewr.connect()) if viewr is not None else None
+
+    # Every frame gets a trace, its hops are stamped in the robot clock all the way to actuation
+    trace_ids = itertools.count()
+
+    async def _send_image(state: Dict[str, Any]) -> Dict[str, Any]:
+        trace: int = next(trace_ids)
+        hops = [("capture", state["image_time"]), ("send", time.time())]
+        out = await transport.send("image", state["image"], trace=trace, hops=hops)
+        out["log"] += f" trace {trace}"
+        out["image"], out["image_time"] = state["image"], state["image_time"]
+        return out
+
+    async def _send_view(state: Dict[str, Any]) -> Dict[str, Any]:
+        if not viewr.connected:
+            return {"log": ""}
+        # the frame goes out with the head pose at the moment it was captured
+        return await viewr.send(
+            "frame", state["image"], stamp=state["image_time"], pose=servos.pose_at(state["image_time"]), pose_stamp=state["image_time"]
+        )
+
+    async def _recv_reply(state: Dict[str, Any]) -> Dict[str, Any]:
+        out = await transport.recv("vlmout")
+        meta = out["vlmout_meta"]
+        if meta.get("hops", None):
+            out["trace"], out["hops"] = meta.get("trace", None), meta["hops"] + [("arrive", meta["received"])]
+            out["expires"] = meta["hops"][0][1] + HPARAMS["robot_max_action_age"]
+        return out
+
+    # Clear vlm replies skip the llm round trip
+    resolver = ActionResolver()
+
+    async def _resolve_action(state: Dict[str, Any]) -> Dict[str, Any]:
+        out = await resolver.resolve(state["vlmout"].decode("utf-8"))
+        if state.get("hops", None):
+            state["hops"].append(("resolve", time.time()))
+        return out
+
+    async def _set_servos(state: Dict[str, Any]) -> Dict[str, Any]:
+        hops = state.get("hops", None)
+        if hops:
+            hops.append(("actuate", time.time()))
+            # the frame this action was decided on was captured at hops[0]
+            TELEMETRY.record("capture_to_actuation", hops[0][1], hops[-1][1], OK, "robot")
+            TELEMETRY.record_trace(hops, "robot")
+        if liveview is not None:
+            liveview.last_action = state["reply"]
+        # moves are relative to the head pose when the frame they were decided on was captured
+        return await servos.set_servos(state["reply"], frame_time=hops[0][1] if hops else None)
+
+    async def _write_log(state: Dict[str, Any]) -> Dict[str, Any]:
+        await write_telemetry("robot")
+        return await write_log(pipeline.drain_log(), "robot")
+
+    # Frame N+1 is captured and sent while frame N is still in the brain
+    pipeline = Pipeline(
+        [
+            # always capture image and send it to brain, then to viewr
+            [
+                Stage("take_image", lambda _: camera.take_image()),
+                Stage("send", _send_image),
+            ] + ([Stage("send_view", _send_view)] if viewr is not None else []),
+            # each vlmout becomes an action, each action moves the servos
+            [
+                Stage("recv", _recv_reply, None),
+                Stage("resolve_action", _resolve_action, HPARAMS["robot_llm_timeout"]),
+                # set_servos gives up on its own after set_servo_timeout, newer actions preempt it
+                Stage("set_servos", _set_servos, None, preempt=True),
+            ],
+            [Stage("write_log", _write_log, period=HPARAMS["log_period"])],
+        ],
+        "robot",
+        report=report,
+    )
+    profiler.wrap(pipeline)
+    try:
+        await pipeline.run()
+    finally:
+        profiler.close()
+        # flush whatever the log writers still hold, spans since the last write_log included
+        await write_telemetry("robot")
+        close_log_writers()
+        await transport.close()
+        if liveview is not None:
+            await liveview.stop()
+        if viewr is not None:
+            viewr_connect.cancel()
+            await asyncio.gather(viewr_connect, return_exceptions=True)
+            await viewr.close()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--report", action="store_true", help="print per-stage throughput")
+    parser.add_argument("--profile", action="store_true", help="sample stacks from the start, SIGUSR1 toggles")
+    parser.add_argument("--profile-stage", type=str, default=HPARAMS["profile_stage"], help="cProfile this stage, e.g. take_image")
+    parser.add_argument("--profile-iterations", type=int, default=HPARAMS["profile_iterations"], help="calls of the stage to profile")
+    args = parser.parse_args()
     print("Starting robot main loop.")
-    _loop()
+    asyncio.run(_loop(
+        report=args.report or HPARAMS["pipeline_report"],
+        profiler=Profiler(
+            "robot", stage=args.profile_stage, iterations=args.profile_iterations, sample=args.profile or HPARAMS["profile"]
+        ),
+    ))
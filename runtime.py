@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from hparams import HPARAMS
+from servos import Servos, interpolate_pose
+
+# Workers start from a fresh interpreter, nothing of the supervisor's event loop or threads leaks in
+_context = multiprocessing.get_context("spawn")
+# Room for the write counter, keeps the slot sequences and records 8 byte aligned
+HEADER_BYTES: int = 64
+
+
+def frame_dtype(camera=HPARAMS["camera"]) -> np.dtype:
+    return np.dtype([("stamp", np.float64), ("frame", np.uint8, (camera.height, camera.width, 3))])
+
+
+def joint_dtype(num_servos: int = len(HPARAMS["servos"])) -> np.dtype:
+    return np.dtype([
+        ("stamp", np.float64),
+        ("position", np.float32, (num_servos,)),  # degrees
+        ("goal", np.float32, (num_servos,)),  # degrees
+        ("goal_id", np.int64),  # id of the last goal the servo worker took
+        ("done", np.bool_),  # trajectory towards the goal finished
+    ])
+
+
+class ShmRing:
+    """Ring of fixed size records in shared memory, one writer and any number of readers.
+
+    The writer fills slot() in place and commit()s it, readers get a copy of a record. Every slot
+    has a sequence number, odd while the writer is in it and even once committed (a seqlock):
+    a reader copies the record and keeps it only if the number was the same, and the expected
+    one, before and after the copy. So a reader never sees a half written or overwritten record.
+    """
+
+    def __init__(self, dtype: np.dtype, size: int, name: str = None):
+        self.dtype, self.size = dtype, size
+        self.owner: bool = name is None
+        nbytes: int = HEADER_BYTES + size * 8 + size * dtype.itemsize
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name: str = self.shm.name
+        # records ever committed, the next slot written is count % size
+        self._count = np.ndarray((1,), np.int64, self.shm.buf)
+        # record n in its slot is 2n+1 while being written and 2n+2 once committed
+        self._seqs = np.ndarray((size,), np.int64, self.shm.buf, offset=HEADER_BYTES)
+        self.records = np.ndarray((size,), dtype, self.shm.buf, offset=HEADER_BYTES + size * 8)
+        if self.owner:
+            self._count[0] = 0
+            self._seqs[:] = 0
+
+    @property
+    def count(self) -> int:
+        return int(self._count[0])
+
+    def slot(self) -> np.ndarray:
+        """The record the next commit publishes, write into it in place."""
+        count = self.count
+        self._seqs[count % self.size] = 2 * count + 1
+        return self.records[count % self.size]
+
+    def commit(self, **fields: Any) -> int:
+        count = self.count
+        self._seqs[count % self.size] = 2 * count + 1
+        record = self.records[count % self.size]
+        for name, value in fields.items():
+            record[name] = value
+        self._seqs[count % self.size] = 2 * count + 2
+        self._count[0] = count + 1
+        return count
+
+    def snapshot(self, num: int = None) -> Tuple[List[int], np.ndarray]:
+        """Copies of the last num records (all by default) oldest first, with their sequence numbers.
+
+        Records the writer was in, or got to again while they were copied, are left out.
+        """
+        count = self.count
+        seqs = list(range(max(count - min(num or self.size, self.size), 0), count))
+        slots = [seq % self.size for seq in seqs]
+        before = self._seqs[slots].copy()
+        records = self.records[slots]  # fancy indexing copies
+        after = self._seqs[slots]
+        keep = [i for i, seq in enumerate(seqs) if before[i] == after[i] == 2 * seq + 2]
+        return [seqs[i] for i in keep], records[keep]
+
+    def latest(self) -> Tuple[int, Optional[np.ndarray]]:
+        # The newest record is only lost if the writer laps it during the copy, try again then
+        for _ in range(3):
+            seqs, records = self.snapshot(1)
+            if seqs:
+                return seqs[0], records[0]
+            if self.count == 0:
+                break
+        return -1, None
+
+    def close(self) -> None:
+        # Views handed out keep the buffer exported, drop ours and let the rest go with the process
+        self._count, self._seqs, self.records = None, None, None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingCapture:
+    """cv2.VideoCapture stand-in for OpenCVCam, reads the capture worker's frames from a ShmRing.
+
+    read() blocks until a newer frame is committed and returns a copy of it, the capture worker
+    may write the slot again as soon as it comes around. stamp is when that frame was captured.
+    """
+
+    def __init__(self, frames: ShmRing, poll: float = HPARAMS["runtime_poll"]):
+        self.frames, self.poll = frames, poll
+        self._seen: int = -1
+        self._open: bool = True
+        self.stamp: Optional[float] = None
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        while self._open:
+            if self.frames.count - 1 > self._seen:
+                seen, record = self.frames.latest()
+                # None only if the capture worker lapped the slot while it was copied
+                if record is not None:
+                    self._seen, self.stamp = seen, float(record["stamp"])
+                    return True, record["frame"]
+            time.sleep(self.poll)
+        return False, None
+
+    def isOpened(self) -> bool:
+        return self._open
+
+    def set(self, prop: int, value: float) -> bool:
+        return True
+
+    def release(self) -> None:
+        self._open = False
+
+
+class ServoClient:
+    """Servos stand-in for the io worker, goals go to the servo worker over a queue and the
+    joint state comes back through a ShmRing."""
+
+    # Same goal choice and settle wait as in process, only set_goal and the state differ
+    set_servos = Servos.set_servos
+    _lead = Servos._lead
+
+    def __init__(self, joints: ShmRing, commands: Any):
+        self.joints, self.commands = joints, commands
+        # ids from a restarted io worker must not match the state left by the last one
+        self.goal_id: int = os.getpid() << 32
+        self.targets: Deque[Tuple[float, List[float]]] = deque()
+
+    def _state(self) -> Optional[np.ndarray]:
+        return self.joints.latest()[1]
+
+    @property
+    def present_pos(self) -> List[float]:
+        state = self._state()
+        # before the servo worker is up, assume the head is home
+        return state["position"].tolist() if state is not None else list(HPARAMS["poses"][HPARAMS["default_pose"]].angles)
+
+    @property
+    def goal_pos(self) -> List[float]:
+        state = self._state()
+        return state["goal"].tolist() if state is not None else self.present_pos
+
+    def pose_at(self, stamp: float) -> List[float]:
+        # The joint ring is the pose history, oldest record first
+        _, records = self.joints.snapshot()
+        pose = interpolate_pose(zip(records["stamp"].tolist(), records["position"].tolist()), stamp)
+        return pose if pose is not None else self.present_pos
+
+    def set_goal(self, goal_pos: List[float]) -> int:
+        self.goal_id += 1
+        self.commands.put((self.goal_id, list(goal_pos)))
+        return self.goal_id
+
+    def converged(self, tolerance: float = HPARAMS["set_servo_tolerance"]) -> bool:
+        state = self._state()
+        # state from before the worker took our goal says nothing about it
+        return (
+            state is not None and state["goal_id"] == self.goal_id and bool(state["done"])
+            and bool(np.all(np.abs(state["position"] - state["goal"]) <= tolerance))
+        )
+
+
+def _run(main: Coroutine) -> None:
+    # SIGTERM from the supervisor cancels the loop, so finally blocks get to flush and close
+    async def _main() -> None:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await main
+
+    try:
+        asyncio.run(_main())
+    except asyncio.CancelledError:
+        pass
+
+
+def _capture_worker(hparams: Dict[str, Any], frames_name: str, capture_factory: Callable = None) -> None:
+    HPARAMS.update(hparams)
+    import cv2
+
+    camera = HPARAMS["camera"]
+    frames = ShmRing(frame_dtype(camera), HPARAMS["runtime_frame_slots"], frames_name)
+    cap = capture_factory() if capture_factory is not None else cv2.VideoCapture(camera.device)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera.width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera.height)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    if not cap.isOpened():
+        raise ValueError(f"Error opening camera {camera.device}")
+    print(f"{HPARAMS['image_token']} capture worker writing to {frames_name}")
+    failures, retry = 0, HPARAMS["camera_retry"]
+    while True:
+        slot = frames.slot()["frame"]
+        # cv2 decodes straight into shared memory, anything else is copied in once
+        ret, frame = cap.read(slot) if isinstance(cap, cv2.VideoCapture) else cap.read()
+        if not ret:
+            # Back off, and past camera_max_failures exit so the supervisor reopens the device
+            failures += 1
+            if failures >= HPARAMS["camera_max_failures"]:
+                print(f"{HPARAMS['image_token']}{HPARAMS['fail_token']} capture worker stopping after {failures} failed reads")
+                cap.release()
+                sys.exit(1)
+            time.sleep(retry)
+            retry = min(2 * retry, HPARAMS["camera_retry_max"])
+            continue
+        failures, retry = 0, HPARAMS["camera_retry"]
+        if not np.shares_memory(frame, slot):
+            slot[:] = frame
+        frames.commit(stamp=time.time())
+
+
+def _servo_worker(hparams: Dict[str, Any], joints_name: str, commands: Any, port_handler_factory: Callable = None) -> None:
+    HPARAMS.update(hparams)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # servos came in with runtime, before the update, so its defaults are hparams.py's: pass ours
+    servos = Servos(
+        servos=HPARAMS["servos"],
+        protocol_version=HPARAMS["protocol_version"],
+        baudrate=HPARAMS["baudrate"],
+        device_name=HPARAMS["device_name"],
+        port_handler=port_handler_factory() if port_handler_factory is not None else None,
+        control_hz=HPARAMS["servo_control_hz"],
+        profile=HPARAMS["servo_profile"],
+        history=HPARAMS["servo_history"],
+        error_interval=HPARAMS["servo_error_interval"],
+    )
+    joints = ShmRing(joint_dtype(servos.num_servos), HPARAMS["runtime_joint_slots"], joints_name)
+    period: float = 1.0 / HPARAMS["servo_control_hz"]
+    goal_id: int = 0
+    print(f"{HPARAMS['servos_token']} servo worker writing to {joints_name}")
+    try:
+        while True:
+            # A new goal is taken right away, otherwise the state is published every control tick
+            try:
+                goal_id, goal_pos = commands.get(timeout=period)
+                servos.set_goal(goal_pos)
+            except queue.Empty:
+                pass
+            joints.commit(
+                stamp=time.time(), position=servos.present_pos, goal=servos.goal_pos, goal_id=goal_id, done=servos.traj_done
+            )
+    finally:
+        servos.close()
+
+
+def _io_worker(hparams: Dict[str, Any], frames_name: str, joints_name: str, commands: Any, report: bool) -> None:
+    HPARAMS.update(hparams)
+    # Imported after the update, their defaults read HPARAMS at import
+    import robot
+    from cam import OpenCVCam
+
+    frames = ShmRing(frame_dtype(), HPARAMS["runtime_frame_slots"], frames_name)
+    joints = ShmRing(joint_dtype(), HPARAMS["runtime_joint_slots"], joints_name)
+    camera = OpenCVCam(capture=RingCapture(frames))
+    _run(robot._loop(report, servos=ServoClient(joints, commands), camera=camera))
+
+
+@dataclass
+class Worker:
+    name: str
+    target: Callable
+    args: Tuple
+    process: Optional[Any] = None
+    started: float = 0.0
+    restarts: int = 0
+    backoff: float = 0.0  # seconds before the next restart
+    restart_at: Optional[float] = None
+
+
+class Supervisor:
+    """Starts each worker in its own process and restarts the ones that die.
+
+    Restarts back off exponentially, the backoff resets once a worker has run for stable seconds.
+    """
+
+    def __init__(
+        self,
+        workers: List[Worker],
+        check_interval: float = HPARAMS["runtime_check_interval"],
+        backoff: float = HPARAMS["runtime_backoff"],
+        backoff_max: float = HPARAMS["runtime_backoff_max"],
+        stable: float = HPARAMS["runtime_stable"],
+    ):
+        self.workers = workers
+        self.check_interval, self.backoff, self.backoff_max, self.stable = check_interval, backoff, backoff_max, stable
+        self.logs: List[str] = []
+
+    def _log(self, log: str) -> None:
+        print(log)
+        self.logs.append(log)
+
+    def _start(self, worker: Worker) -> None:
+        worker.process = _context.Process(target=worker.target, args=worker.args, name=f"igigi.{worker.name}", daemon=True)
+        worker.process.start()
+        worker.started, worker.restart_at = time.time(), None
+        self._log(f"{HPARAMS['robot_token']} started {worker.name} worker pid {worker.process.pid}")
+
+    def check(self) -> None:
+        now = time.time()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    self._start(worker)
+                continue
+            if worker.process.is_alive():
+                continue
+            worker.backoff = self.backoff if now - worker.started > self.stable else min(2 * worker.backoff or self.backoff, self.backoff_max)
+            worker.restart_at = now + worker.backoff
+            self._log(
+                f"{HPARAMS['robot_token']}{HPARAMS['fail_token']} {worker.name} worker exited with "
+                f"{worker.process.exitcode}, restarting in {worker.backoff:.1f}s"
+            )
+
+    def pids(self) -> Dict[str, int]:
+        return {worker.name: worker.process.pid for worker in self.workers if worker.process is not None and worker.process.is_alive()}
+
+    async def run(self) -> None:
+        for worker in self.workers:
+            self._start(worker)
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self.check()
+
+    def stop(self, timeout: float = 5) -> None:
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.kill()
+
+
+class Runtime:
+    """Robot loop split over three processes: capture, servos, and network/llm (robot._loop).
+
+    The rings and the command queue belong to this process, so they outlive worker restarts.
+    Factories (e.g. stubs.FakeCapture) must be picklable.
+    """
+
+    def __init__(
+        self,
+        report: bool = HPARAMS["pipeline_report"],
+        capture_factory: Callable = None,
+        port_handler_factory: Callable = None,
+    ):
+        self.frames = ShmRing(frame_dtype(), HPARAMS["runtime_frame_slots"])
+        self.joints = ShmRing(joint_dtype(), HPARAMS["runtime_joint_slots"])
+        self.commands = _context.Queue()
+        # Workers get this process's HPARAMS, changes made at runtime included, for whatever reads
+        # HPARAMS after the update. Defaults bound at import of servos (set_servos, converged) stay
+        # those of hparams.py, the servo worker passes its settings explicitly
+        hparams: Dict[str, Any] = dict(HPARAMS)
+        self.supervisor = Supervisor([
+            Worker("capture", _capture_worker, (hparams, self.frames.name, capture_factory)),
+            Worker("servos", _servo_worker, (hparams, self.joints.name, self.commands, port_handler_factory)),
+            Worker("io", _io_worker, (hparams, self.frames.name, self.joints.name, self.commands, report)),
+        ])
+
+    async def run(self) -> None:
+        try:
+            await self.supervisor.run()
+        finally:
+            self.supervisor.stop()
+            self.commands.close()
+            self.frames.close()
+            self.joints.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--report", action="store_true", help="print per-stage throughput")
+    args = parser.parse_args()
+    print("Starting multi-process robot runtime.")
+    asyncio.run(Runtime(report=args.report or HPARAMS["pipeline_report"]).run())
@@ -1,15 +1,19 @@
+import argparse
 import asyncio
-from typing import Any, Dict, List
+import math
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
 import time
-from datetime import timedelta
 
 from hparams import HPARAMS, Servo, Pose, Move
+from telemetry import TELEMETRY, OK, TIMEOUT, CANCELLED
 
 from dynamixel_sdk import (
     PortHandler,
     PacketHandler,
-    GroupBulkWrite,
-    GroupBulkRead,
+    GroupSyncWrite,
+    GroupSyncRead,
     COMM_SUCCESS,
     DXL_LOBYTE,
     DXL_LOWORD,
@@ -30,6 +34,45 @@ def units_to_degrees(position: int) -> int:
     return int(position / DEGREE_TO_UNIT)
 
 
+# Motion profiles map the fraction of trajectory time (0, 1) to the fraction of distance (0, 1)
+def min_jerk(s: float) -> float:
+    return s * s * s * (10 - 15 * s + 6 * s * s)
+
+
+def trapezoid(s: float, accel: float = HPARAMS["servo_trapezoid_accel"]) -> float:
+    # accelerate for the first accel fraction, cruise, then decelerate for the last accel fraction
+    v_max = 1 / (1 - accel)
+    if s < accel:
+        return 0.5 * v_max * s * s / accel
+    if s > 1 - accel:
+        return 1 - 0.5 * v_max * (1 - s) * (1 - s) / accel
+    return 0.5 * v_max * accel + v_max * (s - accel)
+
+
+PROFILES: Dict[str, Callable[[float], float]] = {
+    "min_jerk": min_jerk,
+    "trapezoid": trapezoid,
+    "linear": lambda s: s,
+}
+
+
+def interpolate_pose(history: Iterable[Tuple[float, List[float]]], stamp: float) -> Optional[List[float]]:
+    """Pose at stamp from (stamp, pose) samples oldest first, linear between the two around it.
+
+    Before the oldest sample that pose is returned, after the newest the newest one.
+    """
+    before: Optional[Tuple[float, List[float]]] = None
+    for sample in history:
+        if sample[0] >= stamp:
+            if before is None:
+                return list(sample[1])
+            (t0, p0), (t1, p1) = before, sample
+            weight = (stamp - t0) / (t1 - t0) if t1 > t0 else 1.0
+            return [a + (b - a) * weight for a, b in zip(p0, p1)]
+        before = sample
+    return list(before[1]) if before is not None else None
+
+
 class Servos:
     def __init__(
         self,
@@ -42,6 +85,12 @@ class Servos:
         addr_present_position: int = HPARAMS["addr_present_position"],
         torque_enable: int = HPARAMS["torque_enable"],
         torque_disable: int = HPARAMS["torque_disable"],
+        control: bool = True,
+        port_handler: PortHandler = None,
+        control_hz: float = HPARAMS["servo_control_hz"],
+        profile: str = HPARAMS["servo_profile"],
+        history: float = HPARAMS["servo_history"],
+        error_interval: float = HPARAMS["servo_error_interval"],
     ):
         self.servos: List[Servo] = []
         for name, servo in servos.items():
@@ -71,7 +120,7 @@ class Servos:
         self.torque_disable = torque_disable  # Value to disable the torque
 
         # Initialize DYNAMIXEL communication
-        self.port_handler = PortHandler(self.device_name)
+        self.port_handler = port_handler or PortHandler(self.device_name)
         self.packet_handler = PacketHandler(self.protocol_version)
         if not self.port_handler.openPort():
             print("Failed to open the port")
@@ -79,31 +128,80 @@ class Servos:
         if not self.port_handler.setBaudRate(self.baudrate):
             print("Failed to change the baudrate")
             exit()
-        self.group_bulk_write = GroupBulkWrite(self.port_handler, self.packet_handler)
-        self.group_bulk_read = GroupBulkRead(self.port_handler, self.packet_handler)
+        # The set of servos is fixed, so the sync groups are built once and reused
+        self.group_sync_write = GroupSyncWrite(self.port_handler, self.packet_handler, self.addr_goal_position, 4)
+        self.group_sync_read = GroupSyncRead(self.port_handler, self.packet_handler, self.addr_present_position, 4)
+        for servo in self.servos:
+            if not self.group_sync_write.addParam(servo.id, [0, 0, 0, 0]):
+                raise Exception(f"ERROR: [ID:{servo.id}] groupSyncWrite addparam failed")
+            if not self.group_sync_read.addParam(servo.id):
+                raise Exception(f"ERROR: [ID:{servo.id}] groupSyncRead addparam failed")
+        # Last torque value sent to each servo id, and bus utilisation counters
+        self.torque: Dict[int, int] = {}
+        self.packets: int = 0
+        self.bus_time: float = 0.0
+        self._bus_start: float = time.time()
 
-    def _write_position(self, positions: List[int]) -> str:
-        msg: str = ""
-        # Enable torque for all servos and add goal position to the bulk write parameter storage
-        for i, pos in enumerate(positions):
-            pos = degrees_to_units(pos)
-            dxl_id = self.servos[i].id
-            clipped = min(max(pos, self.servos[i].range[0]), self.servos[i].range[1])
+        # Trajectory state shared with the control thread, guarded by the lock
+        self.control_hz, self.profile = control_hz, profile
+        self._lock = threading.Lock()
+        self.present_pos: List[int] = self._read_pos()
+        # (time read, present_pos) of the last history seconds, appended by the control thread
+        self.history: Deque[Tuple[float, List[int]]] = deque(
+            [(time.time(), self.present_pos)], maxlen=max(int(history * control_hz), 2)
+        )
+        # (frame time, goal) of recent compensated moves, where the target was seen, for its velocity
+        self.targets: Deque[Tuple[float, List[float]]] = deque()
+        self.commanded_pos: List[float] = list(self.present_pos)
+        self.commanded_vel: List[float] = [0.0] * self.num_servos
+        self.goal_pos: List[float] = list(self.present_pos)
+        self.goal_id: int = 0
+        self._traj_from: List[float] = list(self.present_pos)
+        self._traj_vel: List[float] = [0.0] * self.num_servos
+        self._traj_start: float = time.time()
+        self._traj_duration: float = 1e-3
+        self._last_tick: float = time.time()
+        self.traj_done: bool = True
+        self.ticks: int = 0
+        self.overruns: int = 0
+        self.errors: int = 0
+        # a failing bus fails every tick, errors are printed at most every error_interval seconds
+        self.error_interval: float = error_interval
+        self._errors_printed: int = 0
+        self._error_printed_at: float = 0.0
+        self._running: bool = control
+        if control:
+            self._thread = threading.Thread(target=self._control_loop, daemon=True)
+            self._thread.start()
+
+    def _check(self, dxl_comm_result: int, dxl_error: int = 0) -> None:
+        if dxl_comm_result != COMM_SUCCESS:
+            raise Exception(f"ERROR: {self.packet_handler.getTxRxResult(dxl_comm_result)}")
+        elif dxl_error != 0:
+            raise Exception(f"ERROR: {self.packet_handler.getRxPacketError(dxl_error)}")
 
+    def _set_torque(self, value: int) -> None:
+        # Only servos whose torque state differs from the cache get a packet
+        for servo in self.servos:
+            if self.torque.get(servo.id, None) == value:
+                continue
+            start_time = time.time()
             dxl_comm_result, dxl_error = self.packet_handler.write1ByteTxRx(
-                self.port_handler, dxl_id, self.addr_torque_enable, self.torque_enable
+                self.port_handler, servo.id, self.addr_torque_enable, value
             )
-            if dxl_comm_result != COMM_SUCCESS:
-                msg += f"ERROR: {self.packet_handler.getTxRxResult(dxl_comm_result)}"
-                raise Exception(msg)
-            elif dxl_error != 0:
-                msg += f"ERROR: {self.packet_handler.getRxPacketError(dxl_error)}"
-                raise Exception(msg)
-
-            self.group_bulk_write.addParam(
-                dxl_id,
-                self.addr_goal_position,
-                4,
+            self.bus_time += time.time() - start_time
+            self.packets += 1
+            self._check(dxl_comm_result, dxl_error)
+            self.torque[servo.id] = value
+
+    def _write_position(self, positions: List[int]) -> None:
+        self._set_torque(self.torque_enable)
+        # Update the goal position of every servo in the persistent sync write
+        for i, pos in enumerate(positions):
+            pos = degrees_to_units(pos)
+            clipped = min(max(pos, self.servos[i].range[0]), self.servos[i].range[1])
+            self.group_sync_write.changeParam(
+                self.servos[i].id,
                 [
                     DXL_LOBYTE(DXL_LOWORD(clipped)),
                     DXL_HIBYTE(DXL_LOWORD(clipped)),
@@ -111,65 +209,167 @@ class Servos:
                     DXL_HIBYTE(DXL_HIWORD(clipped)),
                 ],
             )
+        # One packet for all servos, sync write has no status packet
+        start_time = time.time()
+        dxl_comm_result = self.group_sync_write.txPacket()
+        self.bus_time += time.time() - start_time
+        self.packets += 1
+        self._check(dxl_comm_result)
 
-        # Write goal position
-        dxl_comm_result = self.group_bulk_write.txPacket()
-        if dxl_comm_result != COMM_SUCCESS:
-            msg += f"ERROR: {self.packet_handler.getTxRxResult(dxl_comm_result)}"
-            raise Exception(msg)
+    def _read_pos(self) -> List[int]:
+        # One packet out, one status packet back from each servo
+        start_time = time.time()
+        dxl_comm_result = self.group_sync_read.txRxPacket()
+        self.bus_time += time.time() - start_time
+        self.packets += 1 + self.num_servos
+        self._check(dxl_comm_result)
+        return [
+            units_to_degrees(self.group_sync_read.getData(servo.id, self.addr_present_position, 4))
+            for servo in self.servos
+        ]
 
-        # Clear bulk write parameter storage
-        self.group_bulk_write.clearParam()
+    def _disable_torque(self) -> None:
+        # Always sent, the servos may have been enabled by a previous process
+        self.torque.clear()
+        try:
+            self._set_torque(self.torque_disable)
+        except Exception as e:
+            print(e)
 
-    def _read_pos(self) -> List[int]:
-        msg: str = ""
-        # Add present position value to the bulk read parameter storage
-        for i in range(self.num_servos):
-            dxl_id = self.servos[i].id
-            dxl_addparam_result = self.group_bulk_read.addParam(
-                dxl_id, self.addr_present_position, 4
-            )
-            if not dxl_addparam_result:
-                msg += f"ERROR: [ID:{dxl_id}] groupBulkRead addparam failed\n"
-                raise Exception(msg)
+    def bus_stats(self) -> str:
+        elapsed = max(time.time() - self._bus_start, 1e-9)
+        return (
+            f"{HPARAMS['servos_token']} bus packets={self.packets} "
+            f"({self.packets / elapsed:.1f}/s) busy={100 * self.bus_time / elapsed:.1f}% "
+            f"ticks={self.ticks} overruns={self.overruns} errors={self.errors}"
+        )
 
-        # Read present position
-        dxl_comm_result = self.group_bulk_read.txRxPacket()
-        if dxl_comm_result != COMM_SUCCESS:
-            msg += f"ERROR: {self.packet_handler.getTxRxResult(dxl_comm_result)}\n"
-            raise Exception(msg)
-
-        # Get present position value
-        positions = []
-        for i in range(self.num_servos):
-            dxl_id = self.servos[i].id
-            dxl_present_position = self.group_bulk_read.getData(
-                dxl_id, self.addr_present_position, 4
-            )
-            positions.append(units_to_degrees(dxl_present_position))
+    def close(self) -> None:
+        if self._running:
+            self._running = False
+            self._thread.join(timeout=1)
+        if self.port_handler.is_open:
+            self._disable_torque()
+            self.port_handler.closePort()
 
-        # Clear bulk read parameter storage
-        self.group_bulk_read.clearParam()
+    def __del__(self, *args, **kwargs) -> None:
+        self.close()
 
-        return positions
 
-    def _disable_torque(self) -> None:
-        for servo in self.servos:
-            dxl_comm_result, dxl_error = self.packet_handler.write1ByteTxRx(
-                self.port_handler,
-                servo.id,
-                self.addr_torque_enable,
-                self.torque_disable,
-            )
-            if dxl_comm_result != COMM_SUCCESS:
-                print(f"ERROR: {self.packet_handler.getTxRxResult(dxl_comm_result)}")
-            elif dxl_error != 0:
-                print(f"ERROR: {self.packet_handler.getRxPacketError(dxl_error)}")
+    def _control_loop(self) -> None:
+        # Runs in its own thread at a fixed rate, the only place that touches the bus
+        period: float = 1.0 / self.control_hz
+        next_tick: float = time.time()
+        while self._running:
+            try:
+                with self._lock:
+                    now = time.time()
+                    fraction = min(max((now - self._traj_start) / self._traj_duration, 0.0), 1.0)
+                    progress = PROFILES[self.profile](fraction)
+                    # blend term carries the velocity of a preempted trajectory and fades it out
+                    blend = fraction * (1 - fraction) ** 3 * self._traj_duration
+                    waypoint = [
+                        round(start + (goal - start) * progress + vel * blend, 2)
+                        for start, goal, vel in zip(self._traj_from, self.goal_pos, self._traj_vel)
+                    ]
+                    self.traj_done = fraction >= 1.0
+                    dt = now - self._last_tick
+                    self.commanded_vel = [
+                        (new - old) / dt if dt > 0 else 0.0
+                        for new, old in zip(waypoint, self.commanded_pos)
+                    ]
+                    self._last_tick = now
+                # Bus io stays outside the lock, the results are published under it
+                if waypoint != self.commanded_pos:
+                    self._write_position(waypoint)
+                    with self._lock:
+                        self.commanded_pos = waypoint
+                present_pos = self._read_pos()
+                with self._lock:
+                    self.present_pos = present_pos
+                    self.history.append((time.time(), present_pos))
+                self.ticks += 1
+            except Exception as e:
+                self.errors += 1
+                # A servo that hit a hardware error dropped its torque, whatever the cache says
+                self.torque.clear()
+                if time.time() - self._error_printed_at >= self.error_interval:
+                    print(
+                        f"{HPARAMS['servos_token']}{HPARAMS['fail_token']} control loop {e} "
+                        f"({self.errors - self._errors_printed} errors since the last print)"
+                    )
+                    self._errors_printed, self._error_printed_at = self.errors, time.time()
+            # Absolute schedule so timing does not drift with the time spent on the bus
+            next_tick += period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.overruns += 1
+                next_tick = time.time()
 
-    def __del__(self, *args, **kwargs) -> None:
-        self._disable_torque()
-        self.port_handler.closePort()
+    def clip(self, positions: List[float]) -> List[float]:
+        """Clip positions in degrees to the range of each servo."""
+        return [
+            min(max(pos, servo.range[0] / DEGREE_TO_UNIT), servo.range[1] / DEGREE_TO_UNIT)
+            for pos, servo in zip(positions, self.servos)
+        ]
 
+    def set_goal(
+        self,
+        goal_pos: List[float],
+        speed: float = HPARAMS["servo_speed"],
+        min_duration: float = HPARAMS["servo_min_duration"],
+        max_duration: float = HPARAMS["set_servo_duration"],
+    ) -> int:
+        """Preempt the current trajectory with one towards goal_pos, safe to call from any thread.
+
+        The new trajectory starts at the last commanded position and velocity so the motion
+        blends instead of jumping. Its duration scales with the distance to travel. Returns
+        the id of the new goal.
+        """
+        goal_pos = self.clip(goal_pos)
+        with self._lock:
+            distance = max(abs(goal - start) for goal, start in zip(goal_pos, self.commanded_pos))
+            self._traj_from = list(self.commanded_pos)
+            self._traj_vel = list(self.commanded_vel)
+            self.goal_pos = goal_pos
+            self._traj_start = time.time()
+            self._traj_duration = min(max(distance / speed, min_duration), max_duration)
+            self.traj_done = False
+            self.goal_id += 1
+            return self.goal_id
+
+    def converged(self, tolerance: float = HPARAMS["set_servo_tolerance"]) -> bool:
+        return self.traj_done and all(
+            abs(present - goal) <= tolerance for present, goal in zip(self.present_pos, self.goal_pos)
+        )
+
+    def pose_at(self, stamp: float) -> List[float]:
+        """Head pose at stamp, e.g. when a frame was captured, from the pose history."""
+        # Copied under the lock, the control thread appends to it
+        with self._lock:
+            history = list(self.history)
+        return interpolate_pose(history, stamp)
+
+    def _lead(self, goal_pos: List[float], frame_time: float, window: float, max_lead: float) -> List[float]:
+        # Each goal is one step from where the target was seen, noisy by a step either way, so its
+        # velocity is the least squares slope over the goals of the last window seconds
+        self.targets.append((frame_time, goal_pos))
+        while frame_time - self.targets[0][0] > window:
+            self.targets.popleft()
+        if len(self.targets) < 3:
+            return goal_pos
+        mean_time = sum(stamp for stamp, _ in self.targets) / len(self.targets)
+        spread = sum((stamp - mean_time) ** 2 for stamp, _ in self.targets)
+        if spread <= 0:
+            return goal_pos
+        delay: float = time.time() - frame_time
+        lead: List[float] = []
+        for i, goal in enumerate(goal_pos):
+            velocity = sum((stamp - mean_time) * target[i] for stamp, target in self.targets) / spread
+            lead.append(goal + min(max(velocity * delay, -max_lead), max_lead))
+        return lead
 
     async def set_servos(
         self,
@@ -178,49 +378,69 @@ class Servos:
         default_pose: str = HPARAMS["default_pose"],
         move_dict: Dict[str, Move] = HPARAMS["moves"],
         speed: int = HPARAMS["set_servo_speed"],
-        duration: int = HPARAMS["set_servo_timeout"],
+        timeout: float = HPARAMS["set_servo_timeout"],
         sleep: float = HPARAMS["set_servo_sleep"],
+        frame_time: float = None,
+        latency_comp: bool = HPARAMS["servo_latency_comp"],
+        extrapolate: bool = HPARAMS["servo_extrapolate"],
+        extrapolate_window: float = HPARAMS["servo_extrapolate_window"],
+        extrapolate_max: float = HPARAMS["servo_extrapolate_max"],
     ) -> Dict[str, Any]:
-        out: Dict[str, Any] = {"log": f"{HPARAMS['robot_token']} taking action {action}"}
         # Pick the goal position
         desired_pose = pose_dict.get(action, None)
+        compensate: bool = latency_comp and frame_time is not None
         if desired_pose is not None:
-            goal_pos = desired_pose.angles
-            out["log"] += f" a pose with angles {goal_pos}"
+            kind, goal_pos = "pose", desired_pose.angles
+            self.targets.clear()
         else:
             desired_move = move_dict.get(action, None)
             if desired_move is not None:
-                move_vector = [x * speed for x in desired_move.vector]
-                out["log"] += f" a move with vector {move_vector}"
-                true_pos = self._read_pos()
+                kind, move_vector = "move", [x * speed for x in desired_move.vector]
+                # The move was decided on a frame taken from wherever the head was back then
+                true_pos = self.pose_at(frame_time) if compensate else self.present_pos
                 goal_pos = [move_vector[i] + true_pos[i] for i in range(len(move_vector))]
+                if compensate:
+                    kind += f" from the pose {time.time() - frame_time:.2f}s ago"
+                    if extrapolate:
+                        goal_pos = self._lead(goal_pos, frame_time, extrapolate_window, extrapolate_max)
+                    goal_pos = [round(pos, 2) for pos in goal_pos]
             else:
-                out["log"] += f"... invalid, set to pose {default_pose}"
-                goal_pos = pose_dict[default_pose].angles
-        out["log"] += f", goal_pos={goal_pos}"
-        # Move to the goal position over timeout seconds
-        duration: timedelta = timedelta(seconds=duration)
+                kind, goal_pos = f"invalid, default pose {default_pose}", pose_dict[default_pose].angles
+                self.targets.clear()
+        # The control thread moves along the trajectory, we only wait until the head settles
+        start_pos = self.present_pos
         start_time = time.time()
-        while True:
-            elapsed_time = time.time() - start_time
-            if elapsed_time > duration.total_seconds():
-                out["log"] += f"... completed! took {elapsed_time}s"
-                break
-            true_pos = self._read_pos()
-            out["log"] += f", true_pos={true_pos}"
-            # Interpolate between the current position and the goal position
-            # based on the fraction of time elapsed
-            fraction = elapsed_time / duration.total_seconds()
-            waypoint = [
-                int((goal_pos[i] - true_pos[i]) * fraction + true_pos[i])
-                for i in range(len(goal_pos))
-            ]
-            out["log"] += f", waypoint={waypoint}"
-            self._write_position(waypoint)
-            await asyncio.sleep(sleep)
-        true_pos = self._read_pos()
-        out["log"] += f", true_pos={true_pos}"
-        out["prev_pos"] = true_pos
+        goal_id = self.set_goal(goal_pos)
+        outcome: int = TIMEOUT
+        try:
+            while True:
+                elapsed_time = time.time() - start_time
+                if self.goal_id != goal_id:
+                    outcome, result = CANCELLED, f"preempted after {elapsed_time:.2f}s"
+                    break
+                if self.converged():
+                    outcome, result = OK, f"settled in {elapsed_time:.2f}s"
+                    break
+                if elapsed_time > timeout:
+                    result = f"did not settle in {timeout}s"
+                    break
+                await asyncio.sleep(sleep)
+        except asyncio.CancelledError:
+            outcome = CANCELLED
+            raise
+        finally:
+            TELEMETRY.record(
+                "move_servos", start_time, time.time(), outcome, "robot",
+                distance=max(abs(goal - pos) for goal, pos in zip(goal_pos, start_pos)),
+                error=max(abs(goal - pos) for goal, pos in zip(goal_pos, self.present_pos)),
+            )
+        # One line per action, the details are in the telemetry
+        out: Dict[str, Any] = {
+            "log": f"{HPARAMS['robot_token']} taking action {action} ({kind}) to {goal_pos}... {result}",
+            "prev_pos": self.present_pos,
+        }
+        if outcome == OK:
+            out["settle_time"] = elapsed_time
         return out
 
 
@@ -239,14 +459,158 @@ async def test_servos() -> None:
         time.sleep(2)    
 
 
+def benchmark_bus(num_commands: int = 100) -> None:
+    from dynamixel_sdk import GroupBulkRead, GroupBulkWrite
+    from stubs import FakePortHandler
+
+    def _legacy(servos: Servos, positions: List[int]) -> None:
+        # The old path: torque packet per servo, bulk groups rebuilt on every command
+        bulk_write = GroupBulkWrite(servos.port_handler, servos.packet_handler)
+        for servo, pos in zip(servos.servos, positions):
+            servos.packet_handler.write1ByteTxRx(servos.port_handler, servo.id, servos.addr_torque_enable, servos.torque_enable)
+            unit = degrees_to_units(pos)
+            bulk_write.addParam(servo.id, servos.addr_goal_position, 4, [DXL_LOBYTE(DXL_LOWORD(unit)), DXL_HIBYTE(DXL_LOWORD(unit)), DXL_LOBYTE(DXL_HIWORD(unit)), DXL_HIBYTE(DXL_HIWORD(unit))])
+        bulk_write.txPacket()
+        bulk_read = GroupBulkRead(servos.port_handler, servos.packet_handler)
+        for servo in servos.servos:
+            bulk_read.addParam(servo.id, servos.addr_present_position, 4)
+        bulk_read.txRxPacket()
+
+    def _sync(servos: Servos, positions: List[int]) -> None:
+        servos._write_position(positions)
+        servos._read_pos()
+
+    print(f"{HPARAMS['time_token']} benchmarking {num_commands} servo commands on a fake bus at {HPARAMS['baudrate']} baud")
+    for name, command in [("legacy", _legacy), ("sync", _sync)]:
+        port = FakePortHandler(realtime=False)
+        servos = Servos(control=False, port_handler=port)
+        port.packets_tx = port.packets_rx = port.bytes_tx = port.bytes_rx = 0
+        port.bus_time = 0.0
+        start_time = time.time()
+        for i in range(num_commands):
+            command(servos, [180, 180 + i % 10, 180 - i % 10])
+        elapsed = time.time() - start_time
+        print(
+            f"{HPARAMS['servos_token']} {name}: "
+            f"{(port.packets_tx + port.packets_rx) / num_commands:.1f} packets/command "
+            f"({port.packets_tx / num_commands:.1f} out, {port.packets_rx / num_commands:.1f} back), "
+            f"{(port.bytes_tx + port.bytes_rx) / num_commands:.0f} bytes/command, "
+            f"simulated bus time {1000 * port.bus_time / num_commands:.2f}ms/command, "
+            f"host time {1000 * elapsed / num_commands:.2f}ms/command"
+        )
+
+
+async def test_tracking(
+    delays: List[float] = [0.25, 0.5, 1.0],
+    duration: float = 15,
+    period: float = 0.5,
+    step: float = HPARAMS["set_servo_speed"],
+    sample: float = 0.05,
+) -> None:
+    """Closed loop tracking of a target on a fake bus, with and without latency compensation.
+
+    The target either moves on a slow lissajous path in tilt and pan, or sits still and jumps to
+    a new spot every few seconds. Every period seconds a frame is taken,
+    the stand-in vlm picks the move towards the target as seen from the head pose at that moment,
+    and its decision arrives delay seconds later, preempting the move before it like the robot loop.
+    Tracking error is the distance between target and head, sampled every sample seconds,
+    reversals count moves that undo the one before, the oscillation.
+    """
+    from stubs import FakePortHandler
+
+    # roll, tilt, pan in degrees, inside the servo ranges
+    spots: List[Tuple[float, float]] = [(150, 175), (130, 215), (170, 140), (140, 200), (160, 150)]
+    paths: Dict[str, Callable[[float], List[float]]] = {
+        "moving": lambda t: [180.0, 150 + 20 * math.sin(2 * math.pi * t / 20), 175 + 40 * math.sin(2 * math.pi * t / 30)],
+        "jumps": lambda t: [180.0, *spots[int(t / 6) % len(spots)]],
+    }
+
+    def _decide(target: List[float], pose: List[float]) -> Optional[str]:
+        # the axis that is further off, nothing once the target is within half a step
+        tilt, pan = target[1] - pose[1], target[2] - pose[2]
+        if max(abs(tilt), abs(pan)) < step / 2:
+            return None
+        if abs(tilt) > abs(pan):
+            return HPARAMS["up_token"] if tilt > 0 else HPARAMS["down_token"]
+        return HPARAMS["left_token"] if pan > 0 else HPARAMS["right_token"]
+
+    async def _run(servos: Servos, path: Callable[[float], List[float]], delay: float, **kwargs: Any) -> Tuple[List[float], int, int]:
+        servos.set_goal(path(time.time()))
+        await asyncio.sleep(2)
+        servos.targets.clear()
+        errors: List[float] = []
+        moves, reversals, last = 0, 0, None
+        move: Optional[asyncio.Task] = None
+        start_time = time.time()
+        next_frame, next_sample = start_time, start_time
+        # decisions on their way: (arrival time, action, frame time)
+        pending: List[Tuple[float, str, float]] = []
+        while time.time() - start_time < duration:
+            now = time.time()
+            if now >= next_frame:
+                action = _decide(path(now), list(servos.present_pos))
+                if action is not None:
+                    pending.append((now + delay, action, now))
+                next_frame += period
+            while pending and pending[0][0] <= now:
+                _, action, frame_time = pending.pop(0)
+                if move is not None:
+                    move.cancel()
+                    await asyncio.gather(move, return_exceptions=True)
+                move = asyncio.create_task(servos.set_servos(action, speed=step, frame_time=frame_time, **kwargs))
+                moves += 1
+                reversals += last is not None and [a + b for a, b in zip(HPARAMS["moves"][action].vector, HPARAMS["moves"][last].vector)] == [0, 0, 0]
+                last = action
+            if now >= next_sample:
+                target, pose = path(now), servos.present_pos
+                errors.append(math.hypot(target[1] - pose[1], target[2] - pose[2]))
+                next_sample += sample
+            await asyncio.sleep(0.005)
+        if move is not None:
+            move.cancel()
+            await asyncio.gather(move, return_exceptions=True)
+        return sorted(errors), moves, reversals
+
+    modes: Dict[str, Dict[str, Any]] = {
+        "present pose": {"latency_comp": False, "extrapolate": False},
+        "capture pose": {"latency_comp": True, "extrapolate": False},
+        "capture pose + lead": {"latency_comp": True, "extrapolate": True},
+    }
+    print(f"{HPARAMS['time_token']} tracking a target for {duration}s per run, a frame every {period}s, {step} degree moves")
+    servos = Servos(port_handler=FakePortHandler())
+    try:
+        for path_name, path in paths.items():
+            for delay in delays:
+                for name, kwargs in modes.items():
+                    errors, moves, reversals = await _run(servos, path, delay, **kwargs)
+                    print(
+                        f"{HPARAMS['servos_token']} {path_name} delay={delay:.2f}s {name:>20}: tracking error "
+                        f"mean={sum(errors) / len(errors):.1f} p50={errors[len(errors) // 2]:.1f} "
+                        f"p95={errors[int(0.95 * (len(errors) - 1))]:.1f} degrees, {moves} moves, {reversals} reversals"
+                    )
+    finally:
+        servos.close()
+
+
 def limp_mode() -> None:
     print("Entering limp mode")
-    servos = Servos()
+    servos = Servos(control=False)
     servos._disable_torque()
     while True:
         print(servos._read_pos())
 
 
 if __name__ == "__main__":
-    asyncio.run(test_servos())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", action="store_true", help="benchmark bus traffic on a fake port")
+    parser.add_argument("--tracking", type=str, default=None, help="tracking error benchmark at these decision delays, e.g. 0.25,0.5,1")
+    parser.add_argument("--duration", type=float, default=15, help="seconds per tracking run")
+    parser.add_argument("--step", type=float, default=HPARAMS["set_servo_speed"], help="degrees per move in the tracking benchmark")
+    args = parser.parse_args()
+    if args.bench:
+        benchmark_bus()
+    elif args.tracking:
+        asyncio.run(test_tracking([float(delay) for delay in args.tracking.split(",")], args.duration, step=args.step))
+    else:
+        asyncio.run(test_servos())
     # limp_mode()
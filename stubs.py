@@ -0,0 +1,378 @@
+import asyncio
+import base64
+import json
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from aiohttp import web
+from dynamixel_sdk import PacketHandler
+
+from hparams import HPARAMS, Camera, Servo
+
+
+class CogStub:
+    """Stands in for the VLM docker container, mimics the Cog /predictions endpoint.
+
+    Like a single GPU it runs one prediction at a time. A batch of n images (input "images" and
+    "prompts" lists) costs delay + batch_delay * (n - 1) seconds.
+    """
+
+    def __init__(
+        self,
+        port: int = HPARAMS["vlm_stub_port"],
+        delay: float = HPARAMS["vlm_stub_delay"],
+        replies: Tuple[str, ...] = ("UP", "DOWN", "LEFT", "RIGHT", "UNSURE"),
+        batch_delay: float = HPARAMS["vlm_stub_batch_delay"],
+        startup: float = HPARAMS["vlm_stub_startup"],
+    ):
+        self.port, self.delay, self.replies, self.batch_delay = port, delay, replies, batch_delay
+        # like a model loading, /health-check reports STARTING until startup seconds after start()
+        self.startup: float = startup
+        self._started: Optional[float] = None
+        self.health_checks: int = 0
+        self.url: str = f"http://localhost:{port}/predictions"
+        self.requests: int = 0
+        self.predictions: int = 0
+        self.gpu_time: float = 0.0
+        self._gpu = asyncio.Lock()
+        self._peers: Set[int] = set()
+        self.app = web.Application()
+        self.app.router.add_post("/predictions", self._predictions)
+        self.app.router.add_get("/health-check", self._health_check)
+        self.runner = web.AppRunner(self.app)
+
+    @property
+    def connections(self) -> int:
+        return len(self._peers)
+
+    @property
+    def ready(self) -> bool:
+        return self._started is not None and time.time() - self._started >= self.startup
+
+    async def _health_check(self, request: web.Request) -> web.Response:
+        self.health_checks += 1
+        return web.json_response({"status": "READY" if self.ready else "STARTING"})
+
+    async def _predictions(self, request: web.Request) -> web.Response:
+        self._peers.add(id(request.transport))
+        if not self.ready:
+            return web.json_response({"status": "failed", "error": "model is starting"}, status=503)
+        body: Dict[str, Any] = await request.json()
+        batched: bool = "images" in body["input"]
+        images: List[str] = body["input"]["images"] if batched else [body["input"]["image"]]
+        for image in images:
+            # Reject anything that is not a base64 data url, like the real container would
+            header, data = image.split(",", 1)
+            if not header.startswith("data:image/") or not header.endswith(";base64"):
+                return web.json_response({"status": "failed", "error": "bad image"}, status=422)
+            base64.b64decode(data, validate=True)
+        async with self._gpu:
+            start_time = time.time()
+            await asyncio.sleep(self.delay + self.batch_delay * (len(images) - 1))
+            self.gpu_time += time.time() - start_time
+        self.predictions += 1
+        replies: List[str] = []
+        for _ in images:
+            replies.append(self.replies[self.requests % len(self.replies)])
+            self.requests += 1
+        # Cog streams llava output as a list of tokens
+        output = [list(reply) for reply in replies] if batched else list(replies[0])
+        return web.json_response({"status": "succeeded", "output": output})
+
+    async def start(self) -> None:
+        self._started = time.time()
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "localhost", self.port).start()
+        print(f"{HPARAMS['vlm_token']} cog stub serving on {self.url}")
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+class OpenAIStub:
+    """Stands in for the OpenAI chat completions API, streams an action then some chatter."""
+
+    def __init__(
+        self,
+        port: int = HPARAMS["llm_stub_port"],
+        first_token_delay: float = HPARAMS["llm_stub_first_token_delay"],
+        token_delay: float = HPARAMS["llm_stub_token_delay"],
+    ):
+        self.port, self.first_token_delay, self.token_delay = port, first_token_delay, token_delay
+        self.url: str = f"http://localhost:{port}/v1"
+        self.requests: int = 0
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self._completions)
+        self.runner = web.AppRunner(self.app)
+        # Words in the vlm reply the stub maps onto actions
+        self.keywords: Dict[str, str] = {
+            "UP": HPARAMS["up_token"],
+            "DOWN": HPARAMS["down_token"],
+            "LEFT": HPARAMS["left_token"],
+            "RIGHT": HPARAMS["right_token"],
+        }
+
+    @property
+    def reply_tokens(self) -> int:
+        return HPARAMS["robot_llm_max_tokens"]
+
+    def _reply(self, content: str) -> List[str]:
+        action: str = HPARAMS["default_pose"]
+        for word, token in self.keywords.items():
+            if word in content.upper():
+                action = token
+        # The action comes first, the rest is what a chatty model adds until max_tokens
+        return ([action] + [" because", " the", " person", " is", " there", ".", ""])[:self.reply_tokens]
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        body: Dict[str, Any] = await request.json()
+        self.requests += 1
+        tokens: List[str] = self._reply(body["messages"][-1]["content"])
+        await asyncio.sleep(self.first_token_delay)
+        if not body.get("stream", False):
+            await asyncio.sleep(self.token_delay * (len(tokens) - 1))
+            return web.json_response({
+                "id": f"stub-{self.requests}",
+                "object": "chat.completion",
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "length"}],
+            })
+        # Server sent events, one chunk per token
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        try:
+            for i, token in enumerate(tokens):
+                if i > 0:
+                    await asyncio.sleep(self.token_delay)
+                chunk = {
+                    "id": f"stub-{self.requests}",
+                    "object": "chat.completion.chunk",
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # the client cancelled the stream once it had its action
+            pass
+        return response
+
+    async def start(self) -> None:
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "localhost", self.port).start()
+        print(f"{HPARAMS['llm_token']} openai stub serving on {self.url}")
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+class FakeCapture:
+    """Stands in for cv2.VideoCapture, a bright square moving over a gradient at a fixed fps."""
+
+    def __init__(
+        self,
+        camera: Camera = HPARAMS["camera"],
+        fps: float = HPARAMS["video_fps"],
+        size: int = 64,
+    ):
+        self.width, self.height, self.fps, self.size = camera.width, camera.height, fps, size
+        gradient = np.linspace(0, 255, self.width, dtype=np.uint8)[None, :, None]
+        self.background = np.repeat(np.repeat(gradient, self.height, axis=0), 3, axis=2)
+        self.frames: int = 0
+        self._next: float = time.time()
+        self._open: bool = True
+
+    def target(self, t: float) -> Tuple[int, int]:
+        # Lissajous path over the whole frame, top left corner of the square
+        x = (0.5 + 0.4 * np.sin(0.7 * t)) * (self.width - self.size)
+        y = (0.5 + 0.4 * np.sin(1.1 * t)) * (self.height - self.size)
+        return int(x), int(y)
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        # Blocks until the next frame is due, like a real device
+        self._next += 1 / self.fps
+        delay = self._next - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self._next = time.time()
+        frame = self.background.copy()
+        x, y = self.target(time.time())
+        frame[y:y + self.size, x:x + self.size] = 255
+        self.frames += 1
+        return True, frame
+
+    def isOpened(self) -> bool:
+        return self._open
+
+    def set(self, prop: int, value: float) -> bool:
+        return True
+
+    def release(self) -> None:
+        self._open = False
+
+
+# Dynamixel protocol 2.0 instructions understood by the fake bus
+INST_PING: int = 0x01
+INST_READ: int = 0x02
+INST_WRITE: int = 0x03
+INST_SYNC_READ: int = 0x82
+INST_SYNC_WRITE: int = 0x83
+INST_BULK_READ: int = 0x92
+INST_BULK_WRITE: int = 0x93
+INST_STATUS: int = 0x55
+BROADCAST_ID: int = 0xFE
+
+
+class FakePortHandler:
+    """Stands in for a dynamixel PortHandler, simulates the servos at the packet level.
+
+    Instruction packets written to the port are decoded against a control table per servo and
+    status packets are queued for readPort. Every packet is charged its time on the wire at the
+    configured baudrate plus a fixed latency, optionally sleeping for it in realtime.
+    """
+
+    def __init__(
+        self,
+        servos: Dict[str, Servo] = HPARAMS["servos"],
+        baudrate: int = HPARAMS["baudrate"],
+        latency: float = HPARAMS["fake_bus_latency"],
+        speed: float = HPARAMS["fake_servo_speed"],
+        realtime: bool = True,
+    ):
+        self.baudrate, self.latency, self.speed, self.realtime = baudrate, latency, speed, realtime
+        self.is_open: bool = False
+        self.is_using: bool = False
+        self.crc = PacketHandler(2.0)
+        # Control table per servo id, present position starts mid range
+        self.table: Dict[int, bytearray] = {}
+        for servo in servos.values():
+            self.table[servo.id] = bytearray(256)
+            self._set(servo.id, HPARAMS["addr_present_position"], (servo.range[0] + servo.range[1]) // 2)
+            self._set(servo.id, HPARAMS["addr_goal_position"], (servo.range[0] + servo.range[1]) // 2)
+        self._rx = bytearray()
+        self._last_step: float = time.time()
+        # Bus counters
+        self.packets_tx: int = 0
+        self.packets_rx: int = 0
+        self.bytes_tx: int = 0
+        self.bytes_rx: int = 0
+        self.bus_time: float = 0.0
+
+    def _get(self, dxl_id: int, address: int) -> int:
+        return int.from_bytes(self.table[dxl_id][address:address + 4], "little")
+
+    def _set(self, dxl_id: int, address: int, value: int) -> None:
+        self.table[dxl_id][address:address + 4] = int(value).to_bytes(4, "little")
+
+    def _step(self) -> None:
+        # Servos with torque on move towards their goal at a fixed speed
+        now = time.time()
+        max_step = self.speed * (now - self._last_step)
+        self._last_step = now
+        for dxl_id in self.table:
+            if not self.table[dxl_id][HPARAMS["addr_torque_enable"]]:
+                continue
+            present = self._get(dxl_id, HPARAMS["addr_present_position"])
+            goal = self._get(dxl_id, HPARAMS["addr_goal_position"])
+            present += max(-max_step, min(max_step, goal - present))
+            self._set(dxl_id, HPARAMS["addr_present_position"], present)
+
+    def _charge(self, num_bytes: int) -> None:
+        # 10 bits per byte on the wire (start, 8 data, stop) plus the servo return delay
+        cost = num_bytes * 10 / self.baudrate + self.latency
+        self.bus_time += cost
+        if self.realtime:
+            time.sleep(cost)
+
+    def _status(self, dxl_id: int, params: bytes = b"") -> None:
+        length = len(params) + 4
+        packet = [0xFF, 0xFF, 0xFD, 0x00, dxl_id, length & 0xFF, length >> 8, INST_STATUS, 0] + list(params)
+        crc = self.crc.updateCRC(0, packet, len(packet))
+        packet += [crc & 0xFF, crc >> 8]
+        self._rx.extend(packet)
+        self.packets_rx += 1
+        self.bytes_rx += len(packet)
+        self._charge(len(packet))
+
+    def writePort(self, packet: List[int]) -> int:
+        self.packets_tx += 1
+        self.bytes_tx += len(packet)
+        self._charge(len(packet))
+        self._step()
+        dxl_id, inst = packet[4], packet[7]
+        length = packet[5] | packet[6] << 8
+        params = bytes(packet[8:8 + length - 3])
+        if inst == INST_PING:
+            self._status(dxl_id, bytes(3))
+        elif inst == INST_READ:
+            address, size = params[0] | params[1] << 8, params[2] | params[3] << 8
+            self._status(dxl_id, bytes(self.table[dxl_id][address:address + size]))
+        elif inst == INST_WRITE:
+            address = params[0] | params[1] << 8
+            self.table[dxl_id][address:address + len(params) - 2] = params[2:]
+            if dxl_id != BROADCAST_ID:
+                self._status(dxl_id)
+        elif inst in (INST_SYNC_READ, INST_SYNC_WRITE):
+            address, size = params[0] | params[1] << 8, params[2] | params[3] << 8
+            if inst == INST_SYNC_READ:
+                for _id in params[4:]:
+                    self._status(_id, bytes(self.table[_id][address:address + size]))
+            else:
+                for i in range(4, len(params), size + 1):
+                    self.table[params[i]][address:address + size] = params[i + 1:i + 1 + size]
+        elif inst == INST_BULK_READ:
+            for i in range(0, len(params), 5):
+                _id, address, size = params[i], params[i + 1] | params[i + 2] << 8, params[i + 3] | params[i + 4] << 8
+                self._status(_id, bytes(self.table[_id][address:address + size]))
+        elif inst == INST_BULK_WRITE:
+            i = 0
+            while i < len(params):
+                _id, address, size = params[i], params[i + 1] | params[i + 2] << 8, params[i + 3] | params[i + 4] << 8
+                self.table[_id][address:address + size] = params[i + 5:i + 5 + size]
+                i += 5 + size
+        return len(packet)
+
+    def readPort(self, length: int) -> List[int]:
+        data, self._rx = list(self._rx[:length]), self._rx[length:]
+        return data
+
+    def isPacketTimeout(self) -> bool:
+        # Responses are queued whole, an empty buffer means nothing more is coming
+        return len(self._rx) == 0
+
+    def openPort(self) -> bool:
+        self.is_open = True
+        return True
+
+    def closePort(self) -> None:
+        self.is_open = False
+
+    def clearPort(self) -> None:
+        self._rx.clear()
+
+    def setBaudRate(self, baudrate: int) -> bool:
+        self.baudrate = baudrate
+        return True
+
+    def getBaudRate(self) -> int:
+        return self.baudrate
+
+    def getBytesAvailable(self) -> int:
+        return len(self._rx)
+
+    def setPacketTimeout(self, packet_length: int) -> None:
+        pass
+
+    def setPacketTimeoutMillis(self, msec: float) -> None:
+        pass
+
+
+if __name__ == "__main__":
+    async def _serve() -> None:
+        stub = CogStub()
+        await stub.start()
+        await asyncio.Event().wait()
+
+    asyncio.run(_serve())
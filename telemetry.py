@@ -0,0 +1,214 @@
+import argparse
+import json
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from hparams import HPARAMS
+
+# Outcome of a span
+OK: int = 0
+FAIL: int = 1
+TIMEOUT: int = 2
+CANCELLED: int = 3
+STALE: int = 4  # dropped unrun, its input was too old
+OUTCOMES: List[str] = ["ok", "fail", "timeout", "cancelled", "stale"]
+
+NUM_FIELDS: int = HPARAMS["telemetry_num_fields"]
+RECORD = np.dtype([
+    ("task", np.uint16),  # index into Telemetry.names
+    ("node", np.uint16),  # index into Telemetry.names
+    ("start", np.float64),
+    ("end", np.float64),
+    ("outcome", np.uint8),
+    ("fields", np.float32, (NUM_FIELDS,)),  # numeric fields, names kept per task
+])
+
+
+class Telemetry:
+    """Preallocated ring buffer of typed span records.
+
+    Recording is a handful of array writes, strings are interned once. Nothing is formatted
+    until a report or dump is asked for. Record from the event loop thread only.
+    """
+
+    def __init__(self, size: int = HPARAMS["telemetry_size"]):
+        self.size: int = size
+        self.records = np.zeros(size, dtype=RECORD)
+        self.count: int = 0  # total records ever written, the slot is count % size
+        self.names: List[str] = []
+        self._ids: Dict[str, int] = {}
+        # numeric field names in slot order for each task id
+        self.fields: Dict[int, List[str]] = {}
+        self._dumped: int = 0
+
+    def _id(self, name: str) -> int:
+        if name not in self._ids:
+            self._ids[name] = len(self.names)
+            self.names.append(name)
+        return self._ids[name]
+
+    def record(
+        self,
+        task: str,
+        start: float,
+        end: float,
+        outcome: int = OK,
+        node: str = "robot",
+        **fields: float,
+    ) -> None:
+        task_id = self._id(task)
+        record = self.records[self.count % self.size]
+        record["task"], record["node"] = task_id, self._id(node)
+        record["start"], record["end"], record["outcome"] = start, end, outcome
+        # The slot held an older record, fields this span does not set must not carry over
+        record["fields"][:] = 0
+        if fields:
+            names = self.fields.setdefault(task_id, [])
+            for name, value in fields.items():
+                if name not in names:
+                    if len(names) == NUM_FIELDS:
+                        continue
+                    names.append(name)
+                record["fields"][names.index(name)] = value
+        self.count += 1
+
+    @contextmanager
+    def span(self, task: str, node: str = "robot") -> Iterator[Dict[str, float]]:
+        """Record the enclosed block, numeric fields can be added to the yielded dict."""
+        fields: Dict[str, float] = {}
+        start = time.time()
+        outcome = OK
+        try:
+            yield fields
+        except BaseException:
+            outcome = FAIL
+            raise
+        finally:
+            self.record(task, start, time.time(), outcome, node, **fields)
+
+    def record_trace(self, hops: List[Tuple[str, float]], node: str = "robot") -> None:
+        """One span per hop of a trace, e.g. hop.capture_to_send, timestamps in one clock."""
+        for (start_name, start), (end_name, end) in zip(hops[:-1], hops[1:]):
+            self.record(f"hop.{start_name}_to_{end_name}", start, end, OK, node)
+
+    def _valid(self) -> np.ndarray:
+        return self.records[:min(self.count, self.size)]
+
+    def _select(self, task: str, node: Optional[str] = None) -> np.ndarray:
+        records = self._valid()
+        mask = records["task"] == self._ids.get(task, -1)
+        if node is not None:
+            mask &= records["node"] == self._ids.get(node, -1)
+        return records[mask]
+
+    def percentiles(
+        self,
+        task: str,
+        quantiles: List[float] = [50, 95, 99],
+        node: Optional[str] = None,
+    ) -> Optional[np.ndarray]:
+        records = self._select(task, node)
+        records = records[records["outcome"] == OK]
+        if len(records) == 0:
+            return None
+        return np.percentile(records["end"] - records["start"], quantiles)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, latency percentiles (seconds), failures and field means per task."""
+        records = self._valid()
+        out: Dict[str, Dict[str, float]] = {}
+        # Stage names repeat across nodes when both run in one process
+        keys = records["node"].astype(np.uint32) << 16 | records["task"]
+        nodes = np.unique(records["node"])
+        for key in np.unique(keys):
+            node_id, task_id = int(key >> 16), int(key & 0xFFFF)
+            task = records[keys == key]
+            ok = task[task["outcome"] == OK]
+            name = self.names[task_id] if len(nodes) == 1 else f"{self.names[node_id]}.{self.names[task_id]}"
+            stats: Dict[str, float] = {"count": len(task)}
+            if len(ok) > 0:
+                stats["p50"], stats["p95"], stats["p99"] = np.percentile(ok["end"] - ok["start"], [50, 95, 99]).tolist()
+            for outcome in range(1, len(OUTCOMES)):
+                stats[OUTCOMES[outcome]] = int(np.sum(task["outcome"] == outcome))
+            for i, field_name in enumerate(self.fields.get(task_id, [])):
+                stats[field_name] = float(np.mean(ok["fields"][:, i])) if len(ok) else 0.0
+            out[name] = stats
+        return out
+
+    def report(self) -> str:
+        """Human readable latency table, only rendered when asked for."""
+        lines: List[str] = [f"{HPARAMS['time_token']} telemetry over {min(self.count, self.size)} spans"]
+        for name, stats in self.summary().items():
+            line = f"  {name}: n={stats['count']}"
+            if "p50" in stats:
+                line += f" p50={1000 * stats['p50']:.1f}ms p95={1000 * stats['p95']:.1f}ms p99={1000 * stats['p99']:.1f}ms"
+            for key, value in stats.items():
+                if key in OUTCOMES and value:
+                    line += f" {key}={value}"
+                elif key not in OUTCOMES and key not in ("count", "p50", "p95", "p99"):
+                    line += f" {key}={value:.3g}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def clear(self) -> None:
+        self.count, self._dumped = 0, 0
+
+    def _to_dict(self, record: np.void) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "task": self.names[record["task"]],
+            "node": self.names[record["node"]],
+            "start": float(record["start"]),
+            "end": float(record["end"]),
+            "outcome": OUTCOMES[record["outcome"]],
+        }
+        for i, name in enumerate(self.fields.get(int(record["task"]), [])):
+            out[name] = float(record["fields"][i])
+        return out
+
+    def drain_jsonl(self) -> str:
+        """The records not yet drained as json lines."""
+        # Records that were overwritten before being drained are lost
+        first = max(self._dumped, self.count - self.size)
+        lines = [json.dumps(self._to_dict(self.records[i % self.size])) + "\n" for i in range(first, self.count)]
+        self._dumped = self.count
+        return "".join(lines)
+
+    def dump_jsonl(self, path: str) -> int:
+        """Append the records not yet drained to path, returns how many were written."""
+        text = self.drain_jsonl()
+        with open(path, "a") as f:
+            f.write(text)
+        return text.count("\n")
+
+    def dump_binary(self, path: str) -> None:
+        """Raw records in time order plus the interned names, loadable with np.load."""
+        order = np.arange(max(0, self.count - self.size), self.count) % self.size
+        np.savez(path, records=self.records[order], names=np.array(self.names), fields=json.dumps(self.fields))
+
+
+# Shared by everything on a node
+TELEMETRY = Telemetry()
+
+
+def load_jsonl(path: str, telemetry: Telemetry = None, since: float = 0.0) -> Telemetry:
+    """Records from a dump, optionally only those started after since and added to telemetry."""
+    telemetry = telemetry or Telemetry()
+    with open(path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["start"] < since:
+                continue
+            task, node, start, end = record.pop("task"), record.pop("node"), record.pop("start"), record.pop("end")
+            outcome = OUTCOMES.index(record.pop("outcome"))
+            telemetry.record(task, start, end, outcome, node, **record)
+    return telemetry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="telemetry jsonl dump to report on")
+    args = parser.parse_args()
+    print(load_jsonl(args.path).report())
@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import struct
+import subprocess
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from hparams import HPARAMS
+from telemetry import TELEMETRY
+
+# Each message on the wire is a fixed header (meta length, payload length)
+# followed by a small json meta blob and the raw payload bytes.
+HEADER = struct.Struct("!II")
+# Remote ids name per-remote data dirs, so nothing that could leave the dir is accepted
+REMOTE_ID = re.compile(r"[\w.@-]+")
+
+
+def valid_id(remote_id: Any) -> bool:
+    return isinstance(remote_id, str) and REMOTE_ID.fullmatch(remote_id) is not None and ".." not in remote_id
+
+
+async def write_msg(
+    writer: asyncio.StreamWriter,
+    name: str,
+    payload: bytes = b"",
+    **meta: Any,
+) -> int:
+    num_bytes = write_msg_nowait(writer, name, payload, **meta)
+    await writer.drain()
+    return num_bytes
+
+
+def write_msg_nowait(
+    writer: asyncio.StreamWriter,
+    name: str,
+    payload: bytes = b"",
+    **meta: Any,
+) -> int:
+    """Buffer a message without waiting for the socket, only for small ones like pings."""
+    meta["name"] = name
+    meta.setdefault("sent", time.time())
+    _meta: bytes = json.dumps(meta).encode("utf-8")
+    writer.write(HEADER.pack(len(_meta), len(payload)) + _meta)
+    # payload is written separately to avoid copying it into the header
+    writer.write(payload)
+    return HEADER.size + len(_meta) + len(payload)
+
+
+async def read_msg(
+    reader: asyncio.StreamReader,
+    max_size: int = HPARAMS["transport_max_msg"],
+) -> Tuple[Dict[str, Any], bytes]:
+    header = await reader.readexactly(HEADER.size)
+    meta_len, payload_len = HEADER.unpack(header)
+    if meta_len + payload_len > max_size:
+        raise ValueError(f"message of {meta_len + payload_len} bytes exceeds {max_size}")
+    meta: Dict[str, Any] = json.loads(await reader.readexactly(meta_len))
+    payload: bytes = await reader.readexactly(payload_len) if payload_len else b""
+    return meta, payload
+
+
+class Transport:
+    """Long-lived socket between two nodes, the brain serves and the robot connects.
+
+    Both ends ping each other to estimate the offset between their clocks, NTP style: of the
+    last few ping round trips the shortest is trusted most. to_local and to_remote convert
+    timestamps carried in messages between the two clocks.
+    """
+
+    def __init__(
+        self,
+        local_name: str = "robot",
+        remote_name: str = "brain",
+        port: int = HPARAMS["transport_port"],
+        max_size: int = HPARAMS["transport_max_msg"],
+        retry: float = HPARAMS["transport_retry"],
+        retry_max: float = HPARAMS["transport_retry_max"],
+        local_id: str = None,
+        ping_interval: float = HPARAMS["transport_ping_interval"],
+        clock_samples: int = HPARAMS["transport_clock_samples"],
+        clock: Callable[[], float] = time.time,
+    ):
+        self.local_name, self.remote_name = local_name, remote_name
+        # sent on connect so the brain can tell robots apart
+        self.local_id: str = local_id or HPARAMS.get(f"{local_name}_id", local_name)
+        self.port, self.max_size, self.retry, self.retry_max = port, max_size, retry, retry_max
+        # set by connect, the client side reconnects to it whenever the link drops
+        self.host: Optional[str] = None
+        # seconds before the next attempt, reset once the remote has sent something
+        self._backoff: float = retry
+        # opens the connection in the background, outlives a connect() that timed out
+        self._connect_task: Optional[asyncio.Task] = None
+        self._closing: bool = False
+        # set by the hub, tells sessions apart in telemetry
+        self.remote_id: Optional[str] = None
+        self.ping_interval, self.clock = ping_interval, clock
+        # (round trip, offset) of the last pings, offset is remote clock minus local clock
+        self._clock_samples: Deque[Tuple[float, float]] = deque(maxlen=clock_samples)
+        self.clock_offset: float = 0.0
+        self.rtt: Optional[float] = None
+        self._sync_task: Optional[asyncio.Task] = None
+        self.local_token: str = HPARAMS[f"{local_name}_token"]
+        self.remote_token: str = HPARAMS[f"{remote_name}_token"]
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._handler: Optional[asyncio.Task] = None
+        # latest message received for each name, (meta, payload)
+        self.inbox: Dict[str, Tuple[Dict[str, Any], bytes]] = {}
+        self._arrived: Dict[str, asyncio.Event] = {}
+        # sequence number of the last message handed out by recv for each name
+        self._seen: Dict[str, int] = {}
+        self._seq: int = 0
+        # messages overwritten before recv handed them out, per name
+        self.dropped: Dict[str, int] = {}
+        self._connected = asyncio.Event()
+
+    def _event(self, name: str) -> asyncio.Event:
+        if name not in self._arrived:
+            self._arrived[name] = asyncio.Event()
+        return self._arrived[name]
+
+    async def serve(self, host: str = "0.0.0.0") -> Dict[str, Any]:
+        self.server = await asyncio.start_server(self._on_connect, host, self.port)
+        return {"log": f"{self.local_token} serving transport on port {self.port}"}
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # A new connection replaces the old one, the remote reconnected
+        if self.writer is not None:
+            self.writer.close()
+        self.reader, self.writer = reader, writer
+        self._handler = asyncio.current_task()
+        self._connected.set()
+        self._start_sync()
+        print(f"{self.local_token} transport connected to {self.remote_token}")
+        await self._read_loop(reader)
+
+    async def _open(self) -> None:
+        # Retries with backoff until the remote is up, the remote may be restarting
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                await write_msg(writer, "hello", id=self.local_id, sent=self.clock())
+                break
+            except OSError:
+                await asyncio.sleep(self._backoff)
+                self._backoff = min(2 * self._backoff, self.retry_max)
+        if self.writer is not None:
+            self.writer.close()
+        self.reader, self.writer = reader, writer
+        self._connected.set()
+        self._start_sync()
+        self._read_task = asyncio.create_task(self._read_loop(reader))
+
+    async def connect(self, host: str = None) -> Dict[str, Any]:
+        self.host = host or HPARAMS[f"{self.remote_name}_ip"]
+        out: Dict[str, Any] = {"log": f"{self.local_token} connecting transport to {self.remote_token}"}
+        # Only the wait is cancelled by a caller's timeout, the attempts go on and send/recv
+        # pick up once the remote is up
+        if self._connect_task is None or self._connect_task.done():
+            self._connect_task = asyncio.create_task(self._open())
+        await self._connected.wait()
+        out["log"] += f"... connected to {self.host}:{self.port} as {self.local_id}"
+        return out
+
+    async def _reconnect(self) -> None:
+        # A remote that drops us right away (restarting, or rejecting us) is not hammered
+        await asyncio.sleep(self._backoff)
+        self._backoff = min(2 * self._backoff, self.retry_max)
+        await self._open()
+        print(f"{self.local_token} transport reconnected to {self.remote_token} at {self.host}:{self.port}")
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def to_local(self, remote_time: float) -> float:
+        return remote_time - self.clock_offset
+
+    def to_remote(self, local_time: float) -> float:
+        return local_time + self.clock_offset
+
+    def _start_sync(self) -> None:
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync_loop())
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await self._connected.wait()
+            try:
+                write_msg_nowait(self.writer, "ping", sent=self.clock())
+            except (ConnectionError, RuntimeError):
+                self._connected.clear()
+            await asyncio.sleep(self.ping_interval)
+
+    def _on_pong(self, meta: Dict[str, Any]) -> None:
+        # ping sent (local), ping received (remote), pong sent (remote), pong received (local)
+        t0, t1, t2, t3 = meta["ping_sent"], meta["ping_received"], meta["sent"], meta["received"]
+        rtt: float = (t3 - t0) - (t2 - t1)
+        self._clock_samples.append((rtt, ((t1 - t0) + (t2 - t3)) / 2))
+        # the shortest round trip had the least room for asymmetric delay
+        self.rtt, self.clock_offset = min(self._clock_samples)
+        name: str = "ping" if self.remote_id is None else f"ping.{self.remote_id}"
+        TELEMETRY.record(name, t0, t3, node=self.local_name, offset=self.clock_offset)
+
+    def _deliver(self, meta: Dict[str, Any], payload: bytes) -> None:
+        meta.setdefault("received", self.clock())
+        self._seq += 1
+        meta["seq"] = self._seq
+        name: str = meta["name"]
+        # The inbox is a latest-only slot, a message nobody took is stale now
+        if name in self.inbox and self.inbox[name][0]["seq"] != self._seen.get(name):
+            self.dropped[name] = self.dropped.get(name, 0) + 1
+        self.inbox[name] = (meta, payload)
+        self._event(name).set()
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                meta, payload = await read_msg(reader, self.max_size)
+                meta["received"] = self.clock()
+                self._backoff = self.retry
+                # Clock sync is answered right here, it never goes through the inbox
+                if meta["name"] == "ping":
+                    write_msg_nowait(self.writer, "pong", ping_sent=meta["sent"], ping_received=meta["received"], sent=self.clock())
+                elif meta["name"] == "pong":
+                    self._on_pong(meta)
+                else:
+                    self._deliver(meta, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f"{self.local_token}{HPARAMS['fail_token']} transport lost {self.remote_token}")
+            if reader is self.reader:
+                self._connected.clear()
+                # The side that connected connects again, send and recv pick up once it is back
+                if self.host is not None and not self._closing:
+                    self._connect_task = asyncio.create_task(self._reconnect())
+
+    async def send(self, name: str, payload: bytes, **meta: Any) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"log": f"{HPARAMS['send_token']} sending {name} from {self.local_token} to {self.remote_token}"}
+        await self._connected.wait()
+        try:
+            num_bytes = await write_msg(self.writer, name, payload, sent=self.clock(), **meta)
+        except ConnectionError:
+            self._connected.clear()
+            out["log"] += "... failed"
+            return out
+        out["log"] += f" {num_bytes} bytes"
+        return out
+
+    async def recv(self, name: str, fresh: bool = True) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"log": f"{HPARAMS['find_token']} looking for {name} from {self.remote_token}"}
+        # when fresh, only hand out a message that has not been returned before
+        while name not in self.inbox or (fresh and self.inbox[name][0]["seq"] == self._seen.get(name)):
+            self._event(name).clear()
+            await self._event(name).wait()
+        meta, payload = self.inbox[name]
+        self._seen[name] = meta["seq"]
+        age: float = self.clock() - self.to_local(meta["sent"])
+        out["log"] += f"... found sent {age:.2f}s ago"
+        out[name] = payload
+        out[f"{name}_age"] = age
+        out[f"{name}_meta"] = meta
+        return out
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._connect_task is not None:
+            self._connect_task.cancel()
+            await asyncio.gather(self._connect_task, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+        if self.writer is not None:
+            self.writer.close()
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+        if self._read_task is not None:
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+        # Server side handler exits on its own once the connection is closed
+        if self._handler is not None:
+            await asyncio.gather(self._handler, return_exceptions=True)
+
+
+class Hub:
+    """Serves many remotes at once, one Transport session per remote id.
+
+    A remote that reconnects with the same id gets its old session back, so state kept per
+    session survives the reconnect. New sessions are handed out by accept(). A remote without
+    a hello has a new address, so a new id, on every connection: its session is closed once it
+    disconnects and its id handed out by gone(). At most max_sessions remotes are served.
+    """
+
+    def __init__(
+        self,
+        local_name: str = "brain",
+        remote_name: str = "robot",
+        port: int = HPARAMS["transport_port"],
+        max_size: int = HPARAMS["transport_max_msg"],
+        max_sessions: int = HPARAMS["transport_max_sessions"],
+    ):
+        self.local_name, self.remote_name = local_name, remote_name
+        self.port, self.max_size, self.max_sessions = port, max_size, max_sessions
+        self.local_token: str = HPARAMS[f"{local_name}_token"]
+        self.sessions: Dict[str, Transport] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._new: asyncio.Queue = asyncio.Queue()
+        self._gone: asyncio.Queue = asyncio.Queue()
+
+    async def serve(self, host: str = "0.0.0.0") -> Dict[str, Any]:
+        self.server = await asyncio.start_server(self._on_connect, host, self.port)
+        return {"log": f"{self.local_token} serving transport hub on port {self.port}"}
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            meta, payload = await read_msg(reader, self.max_size)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+        # Remotes that do not say hello are told apart by address
+        remote_id: str = meta.get("id", None) if meta["name"] == "hello" else None
+        hello: bool = remote_id is not None
+        remote_id = remote_id or "{}-{}".format(*writer.get_extra_info("peername")[:2]).replace(":", ".")
+        if not valid_id(remote_id):
+            print(f"{self.local_token}{HPARAMS['fail_token']} rejected transport from {self.remote_name} with id {remote_id!r}")
+            writer.close()
+            return
+        session = self.sessions.get(remote_id, None)
+        if session is None and len(self.sessions) >= self.max_sessions:
+            print(f"{self.local_token}{HPARAMS['fail_token']} rejected transport from {self.remote_name} {remote_id}, {self.max_sessions} sessions already")
+            writer.close()
+            return
+        if session is None:
+            session = Transport(self.local_name, self.remote_name, self.port, self.max_size)
+            session.remote_id = remote_id
+            self.sessions[remote_id] = session
+            self._new.put_nowait((remote_id, session))
+        if meta["name"] not in ("hello", "ping", "pong"):
+            session._deliver(meta, payload)
+        await session._on_connect(reader, writer)
+        if not hello:
+            # Nobody can come back to this session, its next connection gets a new id
+            del self.sessions[remote_id]
+            session._handler = None
+            await session.close()
+            self._gone.put_nowait(remote_id)
+
+    async def accept(self) -> Tuple[str, Transport]:
+        return await self._new.get()
+
+    async def gone(self) -> str:
+        """Id of the next session closed for good, whatever was kept for it can go."""
+        return await self._gone.get()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        await asyncio.gather(*[session.close() for session in self.sessions.values()], return_exceptions=True)
+
+
+def _stats(latencies: List[float], duration: float) -> str:
+    latencies = sorted(latencies)
+    if not latencies:
+        return "no frames"
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return (
+        f"{len(latencies) / duration:.1f} frames/s, latency "
+        f"mean={1000 * sum(latencies) / len(latencies):.1f}ms "
+        f"p50={1000 * p50:.1f}ms p95={1000 * p95:.1f}ms"
+    )
+
+
+async def benchmark(
+    num_frames: int = 50,
+    frame_size: int = 224 * 448 * 3,
+    scp_host: str = "localhost",
+    scp_dir: str = "/tmp",
+) -> None:
+    print(f"{HPARAMS['time_token']} benchmarking transport with {num_frames} frames of {frame_size} bytes")
+    frame: bytes = os.urandom(frame_size)
+    # Socket path over loopback, latency is until the frame is in the remote inbox
+    brain = Transport("brain", "robot")
+    await brain.serve("127.0.0.1")
+    robot = Transport("robot", "brain")
+    await robot.connect("127.0.0.1")
+    latencies: List[float] = []
+    start_time = time.time()
+    for i in range(num_frames):
+        sent = time.time()
+        await robot.send("image", frame)
+        await brain.recv("image")
+        latencies.append(time.time() - sent)
+    print(f"{HPARAMS['send_token']} socket: {_stats(latencies, time.time() - start_time)}")
+    await robot.close()
+    await brain.close()
+    # scp path, one file write plus one ssh handshake per frame
+    _path = os.path.join(scp_dir, f"bench.{HPARAMS['image_filename']}")
+    latencies = []
+    start_time = time.time()
+    for _ in range(num_frames):
+        sent = time.time()
+        with open(_path, "wb") as f:
+            f.write(frame)
+        result = subprocess.run(
+            ["/usr/bin/scp", "-q", _path, f"{scp_host}:{_path}.remote"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if result.returncode != 0:
+            print(f"{HPARAMS['send_token']}{HPARAMS['fail_token']} scp to {scp_host} failed, skipping")
+            break
+        latencies.append(time.time() - sent)
+    print(f"{HPARAMS['send_token']} scp: {_stats(latencies, time.time() - start_time)}")
+
+
+async def test_clock(skew: float = 3.0, num_pings: int = 10) -> None:
+    print(f"{HPARAMS['time_token']} testing clock offset estimation with the robot clock {skew}s ahead")
+    brain = Transport("brain", "robot", ping_interval=0.05)
+    await brain.serve("127.0.0.1")
+    robot = Transport("robot", "brain", ping_interval=0.05, clock=lambda: time.time() + skew)
+    await robot.connect("127.0.0.1")
+    await asyncio.sleep(num_pings * 0.05)
+    # A message stamped in the robot clock is only as old as it really is
+    await robot.send("image", b"")
+    age: float = (await brain.recv("image"))["image_age"]
+    print(
+        f"{HPARAMS['time_token']} offset seen by brain={brain.clock_offset:+.4f}s robot={robot.clock_offset:+.4f}s "
+        f"rtt={1000 * brain.rtt:.2f}ms, message age={1000 * age:.2f}ms (would be {1000 * (age - skew):.0f}ms uncorrected)"
+    )
+    assert abs(brain.clock_offset - skew) < 0.01 and abs(robot.clock_offset + skew) < 0.01
+    await robot.close()
+    await brain.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clock-skew", type=float, default=None, help="test clock offset estimation with this skew")
+    args = parser.parse_args()
+    if args.clock_skew is not None:
+        asyncio.run(test_clock(args.clock_skew))
+    else:
+        asyncio.run(benchmark())
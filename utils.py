@@ -5,132 +5,161 @@ from typing import Any, Dict, List
 import shutil
 
 from hparams import HPARAMS, Task
+from telemetry import TELEMETRY, OK, FAIL, TIMEOUT, CANCELLED
+from logwriter import get_log_writer
 
 
-async def time_it(task: Task) -> Dict[str, Any]:
-    prefix: str = f"{HPARAMS['time_token']} started {task.name}"
-    print(prefix)
+async def time_it(
+    task: Task,
+    node_name: str = "robot",
+    results: Dict[str, Dict[str, Any]] = None,
+    timeout: float = None,
+) -> Dict[str, Any]:
+    coro = task.coro(results or {}) if callable(task.coro) else task.coro
     start_time = time.time()
-    result = await asyncio.wait_for(task.coro, timeout=task.timeout)
-    elapsed_time = time.time() - start_time
-    suffix: str = f"{HPARAMS['time_token']} finished {task.name} took {elapsed_time:.2f}s"
-    print(suffix)
-    result["log"] = f"{prefix}\n{result['log']}\n{suffix}"
+    outcome: int = FAIL
+    try:
+        result = await asyncio.wait_for(coro, timeout=task.timeout if timeout is None else timeout)
+        outcome = OK
+    except asyncio.TimeoutError:
+        outcome = TIMEOUT
+        raise
+    except asyncio.CancelledError:
+        outcome = CANCELLED
+        raise
+    finally:
+        TELEMETRY.record(task.name, start_time, time.time(), outcome, node_name)
     return result
 
-async def task_batch(task_batch: List[Task], node_name: str, ordered: bool = False) -> Dict[str, Any]:
-    node_token: str = HPARAMS[f"{node_name}_token"]
-    if len(task_batch) == 0:
-        log: str = f"{node_token} no tasks to run."
-        print(log)
-        return {"log": log}
-    prefix: str = f"{node_token} started batch of {len(task_batch)} tasks"
-    if ordered:
-        prefix += " in order"
-    prefix += f" at {time.strftime(HPARAMS['time_format'])}"
-    print(prefix)
-    out: Dict[str, Any] = {"log": f"{prefix}\n"}
-    # HACK: gross way of toggling in-order, forgive my sins.
-    if ordered:
-        results = []
-        for task in task_batch:
-            try:
-                result = await time_it(task)
-            except Exception as e:
-                result = e
-            results.append(result)
-    else:
-        results = await asyncio.gather(*[time_it(task) for task in task_batch], return_exceptions=True)
-    for i, result in enumerate(results):
-        if isinstance(result, Exception):
-            if isinstance(result, asyncio.TimeoutError):
-                log = f"{node_token} {HPARAMS['fail_token']} {task_batch[i].name} timed out"
-            else:
-                log = f"{node_token} {HPARAMS['fail_token']} {task_batch[i].name} failed with {result}"
-            print(log)
-            out["log"] += f"{log}\n"
-            continue
-        for name, value in result.items():
-            if name == "log":
-                log = f"{result['log']}\n"
-                print(log)
-                out["log"] += log
-            else:
-                out[name] = value
-    suffix: str = f"{node_token} finished batch of {len(task_batch)} tasks"
-    print(suffix)
-    out["log"] += f"{suffix}\n"
-    return out
+
+def _skip(task: Task, node_name: str, reason: str) -> str:
+    # Never started, close the coroutine so it is not reported as never awaited
+    if not callable(task.coro) and hasattr(task.coro, "close"):
+        task.coro.close()
+    now = time.time()
+    TELEMETRY.record(task.name, now, now, CANCELLED, node_name)
+    return f"{HPARAMS[f'{node_name}_token']} {HPARAMS['fail_token']} {task.name} {reason}"
+
+
+def _check_graph(tasks: List[Task]) -> None:
+    names: Dict[str, Task] = {task.name: task for task in tasks}
+    if len(names) != len(tasks) or "log" in names:
+        raise ValueError("task names must be unique and not log")
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in names:
+                raise ValueError(f"{task.name} depends on unknown task {dep}")
+    # Kahn's algorithm, whatever is left over is in a cycle
+    remaining: Dict[str, set] = {task.name: set(task.deps) for task in tasks}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"dependency cycle between {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
 
 
-async def find_file(
-    file_name: str,
+async def task_graph(
+    tasks: List[Task],
     node_name: str,
-    sleep: float = HPARAMS["find_file_sleep"],
-    read: bool = False,
+    limit: int = None,
 ) -> Dict[str, Any]:
-    filename: str = HPARAMS[f"{file_name}_filename"]
-    directory: str = HPARAMS[f"{node_name}_data_dir"]
-    node_token: str = HPARAMS[f"{node_name}_token"]
-    out: Dict[str, Any] = {"log": f"{HPARAMS['find_token']} looking for {filename} in {node_token}"}
-    while True:
-        if filename in os.listdir(directory):
-            out["log"] += "... found"
-            full_path = os.path.join(directory, filename)
-            file_time = os.path.getmtime(full_path)
-            file_age = time.time() - file_time
-            out["log"] += f" last modified {file_age:.2f}s ago"
-            out[f"{file_name}_path"] = full_path
-            out[f"{file_name}_age"] = file_age
-            if read:
-                with open(full_path, "r") as f:
-                    out[file_name] = f.read()
-            break
-        await asyncio.sleep(sleep)
-    return out
+    """Runs tasks as soon as their deps succeeded, at most limit at a time.
 
-
-async def send_file(
-    file_name: str,
-    local_name: str = HPARAMS["robot_username"],
-    remote_name: str = HPARAMS["brain_username"],
-    _filename: str = None,
-) -> dict:
-    filename: str = HPARAMS[f"{file_name}_filename"]
-    if _filename:
-        filename = _filename
-    local_dir_path: str = HPARAMS[f"{local_name}_data_dir"]
-    remote_dir_path: str = HPARAMS[f"{remote_name}_data_dir"]
-    remote_username: str = HPARAMS[f"{remote_name}_username"]
-    remote_ip: str = HPARAMS[f"{remote_name}_ip"]
-    local_token = HPARAMS[f"{local_name}_token"]
-    remote_token = HPARAMS[f"{remote_name}_token"]
-    out: dict = {"log": f"{HPARAMS['send_token']} sending {filename} from {local_token} to {remote_token}"}
-    cmd = [
-        "/usr/bin/scp",
-        os.path.join(local_dir_path, filename),
-        f"{remote_username}@{remote_ip}:{os.path.join(remote_dir_path, filename)}",
-    ]
-    result = os.system(" ".join(cmd))
-    if result != 0:
-        out["log"] += "... failed"
+    Ready tasks start in priority order. A task is cancelled once it runs past its timeout or the
+    batch runs past its deadline, and tasks depending on a failed one are skipped. Results are
+    namespaced by task name, the logs are merged under "log".
+    """
+    try:
+        _check_graph(tasks)
+    except ValueError:
+        for task in tasks:
+            _skip(task, node_name, "not run")
+        raise
+    node_token: str = HPARAMS[f"{node_name}_token"]
+    start_time = time.time()
+    logs: List[str] = [f"{node_token} started {len(tasks)} tasks at {time.strftime(HPARAMS['time_format'])}"]
+    results: Dict[str, Dict[str, Any]] = {}
+    failed: set = set()
+    pending: List[Task] = sorted(tasks, key=lambda task: -task.priority)
+    running: Dict[asyncio.Task, Task] = {}
+    try:
+        while pending or running:
+            for task in list(pending):
+                if failed.intersection(task.deps):
+                    pending.remove(task)
+                    failed.add(task.name)
+                    logs.append(_skip(task, node_name, f"skipped, {sorted(failed.intersection(task.deps))} failed"))
+                    continue
+                if not all(dep in results for dep in task.deps):
+                    continue
+                if limit is not None and len(running) >= limit:
+                    break
+                timeout: float = task.timeout
+                if task.deadline is not None:
+                    timeout = min(timeout, task.deadline - (time.time() - start_time))
+                    if timeout <= 0:
+                        pending.remove(task)
+                        failed.add(task.name)
+                        logs.append(_skip(task, node_name, "missed its deadline"))
+                        continue
+                pending.remove(task)
+                running[asyncio.create_task(time_it(task, node_name, results, timeout))] = task
+            if not running:
+                continue
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    result = future.result()
+                except asyncio.TimeoutError:
+                    failed.add(task.name)
+                    logs.append(f"{node_token} {HPARAMS['fail_token']} {task.name} timed out")
+                    continue
+                except asyncio.CancelledError:
+                    # Raised by the task itself, the graph being cancelled raises at the wait above
+                    failed.add(task.name)
+                    logs.append(f"{node_token} {HPARAMS['fail_token']} {task.name} was cancelled")
+                    continue
+                except Exception as e:
+                    failed.add(task.name)
+                    logs.append(f"{node_token} {HPARAMS['fail_token']} {task.name} failed with {e}")
+                    continue
+                if result.get("log", None):
+                    logs.append(result["log"])
+                results[task.name] = {name: value for name, value in result.items() if name != "log"}
+    finally:
+        # The caller gave up on the batch, nothing it started should keep running
+        for task in pending:
+            _skip(task, node_name, "cancelled")
+        for future in running:
+            future.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+    logs.append(f"{node_token} finished {len(results)}/{len(tasks)} tasks in {time.time() - start_time:.2f}s")
+    out: Dict[str, Any] = {"log": "\n".join(logs) + "\n"}
+    out.update(results)
+    print(out["log"])
     return out
 
 
 async def write_log(
     log: str,
     node_name: str,
-    clean: bool = False,
 ) -> Dict[str, Any]:
     node_token: str = HPARAMS[f"{node_name}_token"]
     filename: str = HPARAMS[f"{node_name}log_filename"]
     directory: str = HPARAMS[f"{node_name}_data_dir"]
-    full_path: str = os.path.join(directory, filename)
-    out: Dict[str, Any] = {"log": f"{HPARAMS['save_token']} saving log for {node_token}"}
-    _mode = "w" if clean else "a"
-    with open(full_path, _mode) as f:
-        f.write(log)
-    return out
+    # Only queued here, the writer thread flushes and rotates the file
+    get_log_writer(os.path.join(directory, filename)).write(log)
+    return {"log": f"{HPARAMS['save_token']} saving log for {node_token}"}
+
+async def write_telemetry(node_name: str) -> Dict[str, Any]:
+    full_path: str = os.path.join(HPARAMS[f"{node_name}_data_dir"], HPARAMS["telemetry_filename"])
+    text: str = TELEMETRY.drain_jsonl()
+    get_log_writer(full_path).write(text)
+    return {"log": f"{HPARAMS['save_token']} saving {text.count(chr(10))} spans for {HPARAMS[f'{node_name}_token']}"}
 
 async def clear_data(
     node_name: str,
@@ -141,3 +170,45 @@ async def clear_data(
         shutil.rmtree(directory)
     os.makedirs(directory, exist_ok=True)
     return {"log": f"{HPARAMS['clean_token']} clear data {node_token}"}
+
+
+async def test_task_graph() -> None:
+    print("testing task graph")
+
+    async def _sleep(seconds: float, fail: bool = False, cancel: bool = False) -> Dict[str, Any]:
+        await asyncio.sleep(seconds)
+        if fail:
+            raise RuntimeError("failed on purpose")
+        if cancel:
+            raise asyncio.CancelledError()
+        return {"log": "", "slept": seconds}
+
+    async def _sum(results: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        return {"log": "", "total": results["a"]["slept"] + results["b"]["slept"]}
+
+    out = await task_graph([
+        Task("a", _sleep(0.01)),
+        Task("b", _sleep(0.02)),
+        Task("sum", _sum, deps=("a", "b")),
+        Task("broken", _sleep(0.01, fail=True)),
+        Task("after_broken", _sleep(0.01), deps=("broken",)),
+        Task("cancelled", _sleep(0.01, cancel=True)),
+        Task("slow", _sleep(1), deadline=0.1),
+        Task("late", _sleep(0.01), deps=("slow",), deadline=0.1),
+    ], "robot")
+    # Results are kept under their task's name, deps get them by name too
+    assert out["a"] == {"slept": 0.01} and out["sum"]["total"] == 0.03, out
+    assert "after_broken" not in out and "skipped, ['broken'] failed" in out["log"], out["log"]
+    assert "cancelled" not in out and "cancelled was cancelled" in out["log"], out["log"]
+    assert "slow" not in out and "slow timed out" in out["log"], out["log"]
+    assert "late" not in out and "late skipped" in out["log"], out["log"]
+    try:
+        await task_graph([Task("x", _sleep(0), deps=("y",)), Task("y", _sleep(0), deps=("x",))], "robot")
+        raise AssertionError("cycle not rejected")
+    except ValueError as e:
+        assert "cycle" in str(e), e
+    print(f"{HPARAMS['time_token']} task graph ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(test_task_graph())
@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import json
+import struct
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from hparams import HPARAMS
+from pipeline import put_latest
+from transport import Transport
+
+# Each websocket message is the meta length, a json meta blob and the jpeg of the stereo pair
+PACKET_HEADER = struct.Struct("!I")
+PAGE: str = """<html><body style="margin:0;background:#000">
+<img id="view" style="width:100%"><pre id="meta" style="color:#fff;position:fixed;top:0"></pre>
+<script>
+const ws = new WebSocket(`ws://${location.host}/ws`);
+ws.binaryType = "arraybuffer";
+ws.onmessage = (event) => {
+  const length = new DataView(event.data).getUint32(0);
+  const meta = JSON.parse(new TextDecoder().decode(new Uint8Array(event.data, 4, length)));
+  const view = document.getElementById("view");
+  URL.revokeObjectURL(view.src);
+  view.src = URL.createObjectURL(new Blob([new Uint8Array(event.data, 4 + length)], {type: "image/jpeg"}));
+  document.getElementById("meta").textContent = `pose ${meta.pose} age ${(Date.now() / 1000 - meta.stamp).toFixed(3)}s`;
+};
+document.getElementById("view").onload = () => ws.send("ack");
+</script></body></html>"""
+
+
+def pack(meta: Dict[str, Any], jpeg: bytes) -> bytes:
+    _meta: bytes = json.dumps(meta).encode("utf-8")
+    return PACKET_HEADER.pack(len(_meta)) + _meta + jpeg
+
+
+def unpack(packet: bytes) -> Tuple[Dict[str, Any], bytes]:
+    (length,) = PACKET_HEADER.unpack_from(packet)
+    return json.loads(packet[PACKET_HEADER.size:PACKET_HEADER.size + length]), packet[PACKET_HEADER.size + length:]
+
+
+@dataclass
+class Client:
+    queue: asyncio.Queue
+    # frames the client may have in flight, given back by its acks
+    credits: asyncio.Semaphore
+    # frames sent and not acked yet, acks beyond these give no credit
+    inflight: int = 0
+    sent: int = 0
+    dropped: int = 0
+
+
+class Viewr:
+    """Takes the robot's frames and head pose once and fans them out to any number of websocket clients.
+
+    Frame and pose arrive together with the capture time, and go out as one packet so a headset
+    never pairs a frame with another moment's pose. Every client has its own short queue, a
+    slow client loses its oldest frames while the robot and the other clients carry on.
+    A client acks each frame it has shown, and is sent at most window frames ahead of its acks:
+    browsers read websockets eagerly, without acks a slow one would queue up lag on its side.
+    """
+
+    def __init__(
+        self,
+        port: int = HPARAMS["viewr_port"],
+        ws_port: int = HPARAMS["viewr_ws_port"],
+        client_queue: int = HPARAMS["viewr_client_queue"],
+        window: int = HPARAMS["viewr_client_window"],
+    ):
+        self.ws_port, self.client_queue, self.window = ws_port, client_queue, window
+        self.transport = Transport("viewr", "robot", port=port)
+        self.clients: Dict[int, Client] = {}
+        # totals over all clients, past ones included
+        self.frames, self.sent, self.dropped = 0, 0, 0
+        self._producer: Optional[asyncio.Task] = None
+        self.app = web.Application()
+        self.app.router.add_get("/", self._index)
+        self.app.router.add_get("/ws", self._ws)
+        self.runner = web.AppRunner(self.app)
+
+    @property
+    def url(self) -> str:
+        return f"http://localhost:{self.ws_port}/ws"
+
+    async def _produce(self) -> None:
+        while True:
+            out = await self.transport.recv("frame")
+            meta = out["frame_meta"]
+            # Stamps come in the robot clock, clients get ours
+            packet = pack(
+                {
+                    "stamp": self.transport.to_local(meta["stamp"]),
+                    "pose": meta["pose"],
+                    "pose_stamp": self.transport.to_local(meta["pose_stamp"]),
+                    "frame": self.frames,
+                },
+                out["frame"],
+            )
+            self.frames += 1
+            # One encode for everyone, the same bytes go in every queue
+            for client in self.clients.values():
+                dropped: bool = put_latest(client.queue, packet)
+                client.dropped += dropped
+                self.dropped += dropped
+
+    async def _index(self, request: web.Request) -> web.Response:
+        return web.Response(text=PAGE, content_type="text/html")
+
+    async def _ws(self, request: web.Request) -> web.WebSocketResponse:
+        # jpeg does not deflate, and compressing would cost a pass over every frame per client
+        ws = web.WebSocketResponse(compress=False)
+        await ws.prepare(request)
+        client = Client(asyncio.Queue(self.client_queue), asyncio.Semaphore(self.window))
+        self.clients[id(ws)] = client
+
+        async def _send() -> None:
+            while not ws.closed:
+                # Frames wait for credit in the queue, where newer ones replace them
+                await client.credits.acquire()
+                packet = await client.queue.get()
+                client.inflight += 1
+                await ws.send_bytes(packet)
+                client.sent += 1
+                self.sent += 1
+
+        sender = asyncio.create_task(_send())
+        try:
+            # Reading also notices a closed client, the sender may be waiting on an empty queue
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT and message.data == "ack" and client.inflight > 0:
+                    client.inflight -= 1
+                    client.credits.release()
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            del self.clients[id(ws)]
+        return ws
+
+    async def start(self) -> Dict[str, Any]:
+        out = await self.transport.serve()
+        self._producer = asyncio.create_task(self._produce())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "0.0.0.0", self.ws_port).start()
+        out["log"] += f", websocket clients on {self.url}"
+        return out
+
+    def stats(self) -> str:
+        return (
+            f"{HPARAMS['viewr_token']} {self.frames} frames to {len(self.clients)} clients, "
+            f"sent={self.sent} dropped={self.dropped}"
+        )
+
+    async def stop(self) -> None:
+        if self._producer is not None:
+            self._producer.cancel()
+            await asyncio.gather(self._producer, return_exceptions=True)
+        await self.runner.cleanup()
+        await self.transport.close()
+
+
+async def run_viewr(report_interval: float = HPARAMS["pipeline_report_interval"]) -> None:
+    viewr = Viewr()
+    print((await viewr.start())["log"])
+    try:
+        while True:
+            await asyncio.sleep(report_interval)
+            print(viewr.stats())
+    finally:
+        await viewr.stop()
+
+
+async def load_test(
+    num_clients: List[int] = [1, 10, 50, 100],
+    duration: float = 5,
+    fps: float = HPARAMS["video_fps"],
+    slow: float = 0.2,
+    slow_delay: float = 0.2,
+) -> None:
+    """A fake robot streams at fps while N clients read, a slow fraction of them taking slow_delay per frame."""
+    import cv2
+
+    from stubs import FakeCapture
+
+    _, frame = FakeCapture().read()
+    jpeg: bytes = cv2.imencode(".jpg", frame)[1].tobytes()
+    viewr = Viewr()
+    await viewr.start()
+    robot = Transport("robot", "viewr", port=HPARAMS["viewr_port"])
+    await robot.connect("localhost")
+    published: List[float] = []
+
+    async def _robot() -> None:
+        while True:
+            stamp = time.time()
+            await robot.send("frame", jpeg, stamp=stamp, pose=[180, 180, 180], pose_stamp=stamp)
+            published.append(stamp)
+            await asyncio.sleep(1 / fps)
+
+    async def _client(session: aiohttp.ClientSession, delay: float, latencies: List[float], counts: List[int], i: int) -> None:
+        async with session.ws_connect(viewr.url, max_msg_size=0) as ws:
+            async for message in ws:
+                meta, _ = unpack(message.data)
+                latencies.append(time.time() - meta["stamp"])
+                counts[i] += 1
+                if delay:
+                    await asyncio.sleep(delay)
+                await ws.send_str("ack")
+
+    def _p95(latencies: List[float]) -> float:
+        return sorted(latencies)[int(0.95 * (len(latencies) - 1))] if latencies else 0.0
+
+    producer = asyncio.create_task(_robot())
+    async with aiohttp.ClientSession() as session:
+        for num in num_clients:
+            num_slow = int(num * slow)
+            fast_latencies: List[float] = []
+            slow_latencies: List[float] = []
+            counts: List[int] = [0] * num
+            clients = [
+                asyncio.create_task(_client(session, slow_delay if i < num_slow else 0, slow_latencies if i < num_slow else fast_latencies, counts, i))
+                for i in range(num)
+            ]
+            await asyncio.sleep(1)
+            # Measure once everyone is connected
+            published.clear()
+            counts[:] = [0] * num
+            fast_latencies.clear()
+            slow_latencies.clear()
+            await asyncio.sleep(duration)
+            rate_in = len(published) / duration
+            fast = sorted(counts[num_slow:]) or [0]
+            slow_counts = counts[:num_slow] or [0]
+            print(
+                f"{HPARAMS['viewr_token']} {num:3d} clients ({num_slow} slow): robot {rate_in:.1f} frames/s, "
+                f"fast clients min={fast[0] / duration:.1f}/s mean={sum(fast) / len(fast) / duration:.1f}/s "
+                f"latency p95={1000 * _p95(fast_latencies):.1f}ms, slow clients mean={sum(slow_counts) / len(slow_counts) / duration:.1f}/s "
+                f"latency p95={1000 * _p95(slow_latencies):.1f}ms"
+            )
+            for client in clients:
+                client.cancel()
+            await asyncio.gather(*clients, return_exceptions=True)
+    producer.cancel()
+    await asyncio.gather(producer, return_exceptions=True)
+    print(viewr.stats())
+    await robot.close()
+    await viewr.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test", type=str, default=None, help="load test with these client counts, e.g. 1,10,50,100")
+    parser.add_argument("--duration", type=float, default=5, help="seconds measured per client count")
+    args = parser.parse_args()
+    if args.test:
+        asyncio.run(load_test([int(num) for num in args.test.split(",")], duration=args.duration))
+    else:
+        asyncio.run(run_viewr())
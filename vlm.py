@@ -1,56 +1,530 @@
+import argparse
+import asyncio
 import os
 import subprocess
 import time
 import base64
-from typing import Any, Dict
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from collections import OrderedDict
 
 from hparams import HPARAMS
-import requests
+from telemetry import TELEMETRY
+import aiohttp
+import cv2
+import numpy as np
+
+# data url subtype for each image format
+MIME_SUBTYPE: Dict[str, str] = {"jpg": "jpeg"}
+
 
 class VLMDocker:
+    """Brings up the VLM container, reusing one that is already up and healthy.
 
-    def __init__(self, name: str = 'llava13b', port: str = '5000', warmup: int = 25):
-        self.nuke()
-        self.name, self.port, self.warmup = name, port, warmup
-        self.proc = subprocess.Popen([
-            "docker", "run", "--rm", 
-            "-v", "/home/oop/dev/LLaVA/llava-v1.5-13b:/src/liuhaotian/llava-v1.5-13b", 
-            "-p", f"{port}:{port}", 
-            "--gpus=all", 
-            name
-        ])
-        time.sleep(self.warmup)
+    Readiness is polled on the Cog /health-check endpoint with exponential backoff, then a warmup
+    prediction is sent with its own, longer, timeout. Only containers carrying our label are ever
+    stopped, and nothing is torn down on exit so the next brain start finds the model already
+    loaded. launch can replace docker, e.g. with stubs.CogStub.start.
+    """
+
+    def __init__(
+        self,
+        name: str = HPARAMS["vlm_docker_image"],
+        port: str = '5000',
+        url: str = HPARAMS["vlm_docker_url"],
+        label: str = HPARAMS["vlm_docker_label"],
+        ready_timeout: float = HPARAMS["vlm_ready_timeout"],
+        backoff: float = HPARAMS["vlm_ready_backoff"],
+        backoff_max: float = HPARAMS["vlm_ready_backoff_max"],
+        warmup_timeout: float = HPARAMS["vlm_warmup_timeout"],
+        launch: Optional[Callable[[], Awaitable[Any]]] = None,
+    ):
+        self.name, self.port, self.url, self.label = name, port, url, label
+        self.ready_timeout, self.backoff, self.backoff_max = ready_timeout, backoff, backoff_max
+        self.warmup_timeout: float = warmup_timeout
+        self.health_url: str = url.rsplit("/", 1)[0] + "/health-check"
+        self.launch = launch or self._docker_run
+        self.reused: bool = False
+        self.health_checks: int = 0
+        self.time_to_first_inference: Optional[float] = None
+
+    async def _docker(self, *args: str, check: bool = False) -> str:
+        # A subprocess the event loop waits on, the brain keeps serving while docker works
+        process = await asyncio.create_subprocess_exec(
+            "docker", *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, ["docker", *args])
+        return stdout.decode("utf-8")
+
+    async def _docker_run(self) -> None:
+        # A labelled container that is still loading is waited for, not replaced
+        if await self._own_containers():
+            return
+        await self._docker(
+            "run", "-d", "--rm",
+            "--label", f"{self.label}={self.name}",
+            "-v", "/home/oop/dev/LLaVA/llava-v1.5-13b:/src/liuhaotian/llava-v1.5-13b",
+            "-p", f"{self.port}:{self.port}",
+            "--gpus=all",
+            self.name,
+            check=True,
+        )
+
+    async def _own_containers(self) -> List[str]:
+        return (await self._docker("ps", "-aq", "--filter", f"label={self.label}={self.name}")).split()
+
+    async def health(self, session: aiohttp.ClientSession) -> Optional[str]:
+        """Cog status (READY, STARTING, ...) or None when nothing answers."""
+        self.health_checks += 1
+        try:
+            async with session.get(self.health_url) as response:
+                return (await response.json()).get("status", None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+
+    async def wait_ready(self, session: aiohttp.ClientSession) -> None:
+        delay: float = self.backoff
+        deadline: float = time.time() + self.ready_timeout
+        while await self.health(session) != "READY":
+            if time.time() + delay > deadline:
+                raise TimeoutError(f"{self.name} not ready after {self.ready_timeout}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.backoff_max)
 
-    def nuke(self):
-        containers = os.popen("docker ps -aq").read().strip()
+    async def start(self, client: "VLMClient" = None) -> Dict[str, Any]:
+        start_time = time.time()
+        log: str = f"{HPARAMS['vlm_token']} VLM container {self.name}"
+        timeout = aiohttp.ClientTimeout(total=HPARAMS["vlm_timeout"])
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            self.reused = await self.health(session) == "READY"
+            if self.reused:
+                log += " already up, reusing it"
+            else:
+                await self.launch()
+                await self.wait_ready(session)
+                log += f" ready after {time.time() - start_time:.1f}s ({self.health_checks} health checks)"
+        # The first prediction pays for lazy init on the GPU, better here than on a robot frame
+        # A client of its own, the caller's timeout is sized for warm predictions
+        url: str = client.docker_url if client is not None else self.url
+        warmup = VLMClient(url, timeout=self.warmup_timeout, pool_size=1)
+        gradient = np.linspace(0, 255, 64, dtype=np.uint8)[None, :, None]
+        image: bytes = cv2.imencode(".jpg", np.repeat(np.repeat(gradient, 64, 0), 3, 2))[1].tobytes()
+        try:
+            await warmup.predict(image, image_format="jpg")
+        finally:
+            await warmup.close()
+        self.time_to_first_inference = time.time() - start_time
+        TELEMETRY.record("vlm_ready", start_time, time.time(), node="brain", reused=float(self.reused))
+        log += f", first inference after {self.time_to_first_inference:.1f}s"
+        return {"log": log, "time_to_first_inference": self.time_to_first_inference, "reused": self.reused}
+
+    async def nuke(self) -> None:
+        # Only ours, other containers on the host are none of our business
+        containers = await self._own_containers()
         if containers:
-            os.system(f"docker stop {containers}")
-            os.system(f"docker kill {containers}")
-            os.system(f"docker rm {containers}")
-        os.system("docker container prune -f")
+            await self._docker("stop", *containers)
+            await self._docker("rm", "-f", *containers)
+
+
+def _data_url(image: bytes, image_format: str) -> bytes:
+    return b"".join([
+        f'"data:image/{MIME_SUBTYPE.get(image_format, image_format)};base64,'.encode("utf-8"),
+        base64.b64encode(image),
+        b'"',
+    ])
+
+
+class VLMClient:
+    """Async client for the Cog /predictions endpoint that keeps its connections alive."""
+
+    def __init__(
+        self,
+        docker_url: str = HPARAMS["vlm_docker_url"],
+        timeout: float = HPARAMS["vlm_timeout"],
+        pool_size: int = HPARAMS["vlm_pool_size"],
+    ):
+        self.docker_url, self.timeout, self.pool_size = docker_url, timeout, pool_size
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _session(self) -> aiohttp.ClientSession:
+        # Created lazily, a session has to live on the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def predict(
+        self,
+        image: bytes,
+        prompt: str = HPARAMS["vlm_prompt"],
+        image_format: str = HPARAMS["image_format"],
+    ) -> str:
+        # Build the json body as bytes, the base64 image is never decoded into a str
+        body: bytes = b"".join([
+            b'{"input": {"prompt": ',
+            json.dumps(prompt).encode("utf-8"),
+            b', "image": ',
+            _data_url(image, image_format),
+            b'}}',
+        ])
+        result = await self._post(body)
+        return "".join(result["output"])
+
+    async def predict_batch(
+        self,
+        images: List[bytes],
+        prompts: List[str],
+        image_format: str = HPARAMS["image_format"],
+    ) -> List[str]:
+        """One prediction for several (image, prompt) pairs, the backend must accept lists."""
+        body: bytes = b"".join([
+            b'{"input": {"prompts": ',
+            json.dumps(prompts).encode("utf-8"),
+            b', "images": [',
+            b", ".join(_data_url(image, image_format) for image in images),
+            b']}}',
+        ])
+        result = await self._post(body)
+        return ["".join(output) for output in result["output"]]
+
+    async def _post(self, body: bytes) -> Dict[str, Any]:
+        # Cancelling the awaiting task (e.g. a stage timeout) aborts the request
+        async with self._session().post(
+            self.docker_url,
+            data=body,
+            headers={"Content-Type": "application/json"},
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+
+def dhash(image: bytes, hash_size: int = HPARAMS["vlm_cache_hash_size"]) -> Optional[int]:
+    """Difference hash of an encoded image, similar scenes differ in only a few bits."""
+    # Decoding at 1/8 scale in grayscale is far cheaper than a full decode
+    gray = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        return None
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class VLMCache:
+    """Reuses VLM replies for near-identical images with the same prompt.
+
+    Entries are kept in LRU order and expire after ttl seconds. A lookup hits when the
+    hamming distance between image hashes is at most threshold bits, and returns the
+    reply of the nearest image.
+    """
+
+    def __init__(
+        self,
+        size: int = HPARAMS["vlm_cache_size"],
+        ttl: float = HPARAMS["vlm_cache_ttl"],
+        threshold: int = HPARAMS["vlm_cache_threshold"],
+    ):
+        self.size, self.ttl, self.threshold = size, ttl, threshold
+        # (prompt, hash) -> (time stored, reply), most recently used last
+        self.entries: OrderedDict = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def get(self, image_hash: int, prompt: str) -> Optional[str]:
+        now = time.time()
+        # The nearest image within the threshold wins, the most recently used on a tie
+        match, best = None, self.threshold + 1
+        for key, (stored, reply) in list(self.entries.items()):
+            if now - stored > self.ttl:
+                del self.entries[key]
+                self.evictions += 1
+            elif key[0] == prompt:
+                distance = bin(key[1] ^ image_hash).count("1")
+                if distance <= best:
+                    match, best = key, distance
+        if match is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(match)
+        return self.entries[match][1]
+
+    def put(self, image_hash: int, prompt: str, reply: str) -> None:
+        self.entries[(prompt, image_hash)] = (time.time(), reply)
+        self.entries.move_to_end((prompt, image_hash))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> str:
+        total = max(self.hits + self.misses, 1)
+        return f"cache hits={self.hits} misses={self.misses} rate={100 * self.hits / total:.0f}% evictions={self.evictions}"
+
+
+class VLMBatcher:
+    """Gathers concurrent VLM requests into batches and fans the replies back out.
+
+    A batch is dispatched once it holds max_batch requests or window seconds after its first
+    request, with at most max_inflight batches at the backend. Each batch takes at most one
+    request per key (e.g. robot id), oldest first, so a busy robot cannot starve the others.
+    Batched backends get one predict_batch call, others get the requests concurrently over
+    the client's connection pool. Requests whose caller gave up are dropped before dispatch.
+    """
+
+    def __init__(
+        self,
+        client: VLMClient,
+        window: float = HPARAMS["vlm_batch_window"],
+        max_batch: int = HPARAMS["vlm_batch_max"],
+        batched: bool = HPARAMS["vlm_batched"],
+        max_inflight: int = HPARAMS["vlm_batch_inflight"],
+    ):
+        self.client, self.window, self.max_batch, self.batched = client, window, max_batch, batched
+        self.max_inflight: int = max_inflight
+        # (future, image, prompt, image_format, key) waiting for the next dispatch, oldest first
+        self._pending: List[Any] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._dispatches: set = set()
+        self.batches: int = 0
+        self.requests: int = 0
+        self.busy: float = 0.0
+        # requests served per key
+        self.served: Dict[Any, int] = {}
+
+    async def submit(
+        self,
+        image: bytes,
+        prompt: str = HPARAMS["vlm_prompt"],
+        image_format: str = HPARAMS["image_format"],
+        key: Any = None,
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future = loop.create_future()
+        self._pending.append((future, image, prompt, image_format, key))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = [request for request in self._pending if not request[0].done()]
+        # Anything left waits for a dispatch to finish, it will have grown into a bigger batch
+        while self._pending and len(self._dispatches) < self.max_inflight:
+            batch: List[Any] = []
+            keys: set = set()
+            for request in self._pending:
+                if len(batch) == self.max_batch:
+                    break
+                if request[4] is None or request[4] not in keys:
+                    batch.append(request)
+                    keys.add(request[4])
+            taken = {id(request) for request in batch}
+            self._pending = [request for request in self._pending if id(request) not in taken]
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatched)
+
+    def _dispatched(self, task: asyncio.Future) -> None:
+        self._dispatches.discard(task)
+        if self._pending:
+            self._flush()
+
+    async def _dispatch(self, batch: List[Any]) -> None:
+        start_time = time.time()
+        try:
+            # a batch call takes one image format, mixed formats go in separate calls
+            formats = {request[3] for request in batch}
+            if self.batched and len(formats) == 1:
+                replies = await self.client.predict_batch(
+                    [request[1] for request in batch], [request[2] for request in batch], formats.pop()
+                )
+            else:
+                replies = await asyncio.gather(
+                    *[self.client.predict(image, prompt, fmt) for _, image, prompt, fmt, _ in batch]
+                )
+        except Exception as e:
+            for future, *_ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.busy += time.time() - start_time
+            self.batches += 1
+            self.requests += len(batch)
+            for request in batch:
+                self.served[request[4]] = self.served.get(request[4], 0) + 1
+        for (future, *_), reply in zip(batch, replies):
+            if not future.done():
+                future.set_result(reply)
+
+    def stats(self) -> str:
+        return (
+            f"batches={self.batches} mean size={self.requests / max(self.batches, 1):.2f} "
+            f"backend time per request={1000 * self.busy / max(self.requests, 1):.1f}ms"
+        )
+
+
+# Shared client used when run_vlm is not given one
+_client: Optional[VLMClient] = None
 
-    def __del__(self):
-        self.proc.terminate()
-        self.nuke()
 
 async def run_vlm(
+    image: bytes = None,
+    image_format: str = HPARAMS["image_format"],
     prompt: str = HPARAMS["vlm_prompt"],
-    docker_url: str = HPARAMS["vlm_docker_url"],
+    client: VLMClient = None,
+    cache: VLMCache = None,
+    batcher: VLMBatcher = None,
+    key: Any = None,
 ) -> Dict[str, Any]:
+    global _client
     log: str = f"{HPARAMS['vlm_token']} VLM using PROMPT: {prompt}"
-    _path = os.path.join(HPARAMS["brain_data_dir"], HPARAMS["image_filename"])
-    with open(_path, "rb") as img_file:
-        response = requests.post(
-            docker_url,
-            headers={"Content-Type": "application/json"},
-            json={
-                "input": {
-                    "image": f"data:image/png;base64,{base64.b64encode(img_file.read()).decode('utf-8')}",
-                    "prompt": prompt,
-                },
-            },
-        )
-    reply = ''.join(response.json()["output"])
+    if image is None:
+        _path = os.path.join(HPARAMS["brain_data_dir"], HPARAMS["image_filename"])
+        with open(_path, "rb") as img_file:
+            image = img_file.read()
+    if client is None:
+        if _client is None:
+            _client = VLMClient()
+        client = _client
+    image_hash: Optional[int] = dhash(image) if cache is not None else None
+    if image_hash is not None:
+        reply = cache.get(image_hash, prompt)
+        if reply is not None:
+            log += f" CACHED REPLY: {reply}, {cache.stats()}"
+            print(f"\n{HPARAMS['vlm_token']} {log}\n")
+            return {"log": log, "reply": reply}
+    if batcher is not None:
+        reply: str = await batcher.submit(image, prompt, image_format, key)
+    else:
+        reply: str = await client.predict(image, prompt, image_format)
+    if image_hash is not None:
+        cache.put(image_hash, prompt, reply)
     log += f" REPLY: {reply}"
     print(f"\n{HPARAMS['vlm_token']} {log}\n")
     return {"log": log, "reply": reply}
+
+
+async def test_vlm(
+    num_requests: int = 10,
+    image_path: str = None,
+) -> None:
+    from stubs import CogStub
+
+    print("testing vlm client against local cog stub")
+    stub = CogStub()
+    await stub.start()
+    client = VLMClient(docker_url=stub.url)
+    if image_path is not None:
+        with open(image_path, "rb") as f:
+            image = f.read()
+    else:
+        # Smooth synthetic scene so the image hash is meaningful
+        gradient = np.linspace(0, 255, 448, dtype=np.uint8)[None, :, None]
+        image = cv2.imencode(".jpg", np.repeat(np.repeat(gradient, 224, 0), 3, 2))[1].tobytes()
+    latencies: List[float] = []
+    for _ in range(num_requests):
+        start_time = time.time()
+        result = await run_vlm(image, client=client)
+        latencies.append(time.time() - start_time)
+    connections: int = stub.connections
+    # requests that outlive vlm_timeout are cancelled by the client
+    slow = VLMClient(docker_url=stub.url, timeout=stub.delay / 2)
+    try:
+        await slow.predict(image)
+        print(f"{HPARAMS['vlm_token']}{HPARAMS['fail_token']} timeout was not enforced")
+    except asyncio.TimeoutError:
+        print(f"{HPARAMS['vlm_token']} timeout enforced at {slow.timeout:.2f}s")
+    await slow.close()
+    overhead = [latency - stub.delay for latency in latencies]
+    print(
+        f"{HPARAMS['vlm_token']} {num_requests} requests over {connections} connection(s), "
+        f"client overhead mean={1000 * sum(overhead) / num_requests:.1f}ms "
+        f"max={1000 * max(overhead):.1f}ms"
+    )
+    # Identical frames reuse the previous reply instead of going to the container
+    cache = VLMCache()
+    for _ in range(num_requests):
+        await run_vlm(image, client=client, cache=cache)
+    print(f"{HPARAMS['vlm_token']} {num_requests} identical frames, {cache.stats()}")
+    await client.close()
+    await stub.stop()
+
+
+async def test_batching(num_callers: int = 8, rounds: int = 5) -> None:
+    from stubs import CogStub
+
+    print(f"testing batched vlm against local cog stub with {num_callers} concurrent callers")
+    stub = CogStub()
+    await stub.start()
+    client = VLMClient(docker_url=stub.url, timeout=60)
+    gradient = np.linspace(0, 255, 448, dtype=np.uint8)[None, :, None]
+    image = cv2.imencode(".jpg", np.repeat(np.repeat(gradient, 224, 0), 3, 2))[1].tobytes()
+
+    async def _caller(batcher: Optional[VLMBatcher]) -> float:
+        start_time = time.time()
+        result = await run_vlm(image, client=client, batcher=batcher)
+        assert result["reply"] in stub.replies, result["reply"]
+        return time.time() - start_time
+
+    for batcher in [None, VLMBatcher(client, batched=True)]:
+        stub.gpu_time, stub.predictions, stub.requests = 0.0, 0, 0
+        latencies: List[float] = []
+        for _ in range(rounds):
+            latencies += await asyncio.gather(*[_caller(batcher) for _ in range(num_callers)])
+        print(
+            f"{HPARAMS['vlm_token']} {'batched' if batcher else 'one by one'}: {stub.requests} requests in "
+            f"{stub.predictions} predictions, gpu time per request={1000 * stub.gpu_time / stub.requests:.1f}ms, "
+            f"latency mean={1000 * sum(latencies) / len(latencies):.1f}ms max={1000 * max(latencies):.1f}ms"
+            + (f", {batcher.stats()}" if batcher else "")
+        )
+    await client.close()
+    await stub.stop()
+
+
+async def test_docker(startup: float = 2) -> None:
+    from stubs import CogStub
+
+    print(f"testing vlm container lifecycle against a local cog stub that loads for {startup}s")
+    stub = CogStub(startup=startup)
+    client = VLMClient(docker_url=stub.url)
+    # Cold start, the stub stands in for docker run
+    cold = VLMDocker(url=stub.url, launch=stub.start)
+    print((await cold.start(client))["log"])
+    # Restart with the container still up
+    warm = VLMDocker(url=stub.url, launch=stub.start)
+    print((await warm.start(client))["log"])
+    assert warm.reused and not cold.reused
+    print(
+        f"{HPARAMS['vlm_token']} time to first inference cold={cold.time_to_first_inference:.2f}s "
+        f"(startup {startup}s, fixed sleep was 25s) reused={warm.time_to_first_inference:.2f}s"
+    )
+    await client.close()
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", type=str, default=None, help="image to send to the stub")
+    parser.add_argument("--batch", type=int, default=0, help="test batching with this many concurrent callers")
+    parser.add_argument("--docker-test", action="store_true", help="test container readiness and reuse against the stub")
+    args = parser.parse_args()
+    if args.docker_test:
+        asyncio.run(test_docker())
+    elif args.batch:
+        asyncio.run(test_batching(args.batch))
+    else:
+        asyncio.run(test_vlm(image_path=args.image))